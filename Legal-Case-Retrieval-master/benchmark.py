@@ -0,0 +1,349 @@
+#!/usr/bin/python
+import os
+import sys
+import csv
+import json
+import time
+import random
+import queue
+import getopt
+import shutil
+import platform
+import tempfile
+import traceback
+import resource
+import contextlib
+import subprocess
+import multiprocessing
+import numpy as np
+
+# vocabulary of the synthetic corpus: legal terms, the most frequent, then pseudo-words built from syllables
+LEGAL_TERMS = [
+    "court", "appeal", "judge", "jury", "trial", "evidence", "witness", "plaintiff", "defendant", "claim", "damages",
+    "negligence", "duty", "care", "breach", "contract", "statute", "section", "act", "law", "liability", "injury",
+    "harm", "property", "estate", "trust", "will", "theft", "murder", "sentence", "verdict", "tribunal", "police",
+    "reasonable", "doubt", "fertility", "treatment", "car", "accident", "insurance", "employer", "employee",
+    "dismissal", "compensation", "tenant", "landlord", "lease", "mortgage", "bank", "fraud", "conviction", "charge",
+    "offence", "bail", "custody", "child", "marriage", "divorce", "order", "injunction", "costs", "counsel",
+    "solicitor", "barrister", "hearing", "application", "respondent", "appellant", "judgment", "decision", "finding",
+    "fact", "principle", "precedent", "authority", "jurisdiction", "constitution", "rights", "freedom", "privacy",
+    "defamation", "copyright", "patent", "trademark", "company", "director", "shareholder", "partnership",
+    "bankruptcy", "creditor", "debt", "loan", "tax", "revenue", "customs", "immigration", "visa", "citizen",
+]
+STOP_WORDS = ["the", "of", "and", "to", "in", "a", "that", "is", "was", "for", "by", "on", "with", "as", "be", "it"]
+SYLLABLES = ["ba", "ri", "ton", "le", "gal", "mar", "den", "so", "vi", "cor", "pel", "tra", "mi", "nus", "ex", "ord"]
+COURTS = ["High Court", "Court of Appeal", "District Court", "Supreme Court", "Magistrates Court"]
+
+WORKLOADS = ("free", "expanded", "boolean")
+# number of (phrase, term) pairs sampled from the corpus for Boolean queries
+MAX_SAMPLES = 1000
+# seconds between checks that a benchmark step's process is still alive
+POLL_SECONDS = 1.0
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -o results.json [-n corpus-sizes] [-l words-per-document] [-v vocabulary-size] "
+                                    "[-q queries-per-workload] [-k top-k] [-s] [-w workers] [-f format-version] "
+                                    "[-r seed] [-t tmp-dir]")
+
+
+def build_vocabulary(size, rng):
+    """
+    Builds the vocabulary of the synthetic corpus
+    :param size: number of words
+    :param rng: random.Random
+    :return: list of words, by decreasing frequency rank
+    """
+    words = list(LEGAL_TERMS)
+    seen = set(words)
+    while len(words) < size:
+        word = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words[:size]
+
+
+def generate_corpus(path, n_docs, doc_len=300, vocabulary_size=5000, seed=0):
+    """
+    Writes a synthetic legal-style corpus in the csv format read by Indexer.index. Word frequencies follow a Zipf law,
+    with stop words interleaved like in real text.
+    :param path: the csv file to write
+    :param n_docs: number of documents
+    :param doc_len: mean number of words per document
+    :param vocabulary_size: number of distinct words (besides stop words)
+    :param seed: random seed, the same arguments always give the same corpus
+    :return: a tuple of (the vocabulary by decreasing frequency rank, a sample of (phrase, term) pairs found together in
+        a document, for Boolean queries that match)
+    """
+    rng = random.Random(seed)
+    sample_rng = random.Random(seed + 1)
+    samples = []
+    vocabulary = build_vocabulary(vocabulary_size, rng)
+    cum_weights = np.cumsum(1 / np.arange(1, len(vocabulary) + 1)).tolist()
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["document_id", "title", "content", "date_posted", "court"])
+        for doc_id in range(1, n_docs + 1):
+            n_words = max(10, int(rng.gauss(doc_len, doc_len / 4)))
+            words = rng.choices(vocabulary, cum_weights=cum_weights, k=n_words)
+            sentences = []
+            phrases = []
+            for start in range(0, n_words, 12):
+                sentence = []
+                for word in words[start:start + 12]:
+                    if sentence and sentence[-1] not in STOP_WORDS:
+                        phrases.append((sentence[-1], word))
+                    sentence.append(word)
+                    if rng.random() < 0.4:
+                        sentence.append(rng.choice(STOP_WORDS))
+                sentences.append(" ".join(sentence).capitalize() + ".")
+            if len(samples) < MAX_SAMPLES and phrases:
+                samples.append((" ".join(sample_rng.choice(phrases)), sample_rng.choice(words)))
+            writer.writerow([doc_id, "Case {}".format(doc_id), " ".join(sentences),
+                             "{}-{:02d}-{:02d}".format(rng.randint(1990, 2019), rng.randint(1, 12), rng.randint(1, 28)),
+                             rng.choice(COURTS)])
+    return vocabulary, samples
+
+
+def generate_queries(vocabulary, samples, n_queries, workload, seed=0):
+    """
+    Generates a query workload. Free text query terms are drawn from the head of the vocabulary, where the legal terms
+    are. Boolean queries are mostly built from phrases found in the corpus, the others likely match nothing.
+    :param vocabulary: the corpus vocabulary, by decreasing frequency rank
+    :param samples: (phrase, term) pairs found in the corpus, see generate_corpus
+    :param n_queries: number of queries
+    :param workload: "free" (free text), "expanded" (free text, run with query expansion) or "boolean" (a phrase AND a
+        term)
+    :param seed: random seed
+    :return: list of query strings
+    """
+    rng = random.Random("{}-{}".format(seed, workload))
+    head = vocabulary[:max(50, len(vocabulary) // 10)]
+    queries = []
+    for _ in range(n_queries):
+        if workload == "boolean":
+            if samples and rng.random() < 0.8:
+                phrase, term = rng.choice(samples)
+            else:
+                phrase, term = " ".join(rng.sample(head, 2)), rng.choice(head)
+            queries.append('"{}" AND {}'.format(phrase, term))
+        else:
+            queries.append(" ".join(rng.sample(head, rng.randint(1, 6))))
+    return queries
+
+
+def peak_rss():
+    """
+    :return: peak resident set size of this process in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def percentile(latencies, p):
+    return float(np.percentile(latencies, p)) if latencies else None
+
+
+def _index_run(input_file, postings_path, dictionary_path, streaming, workers, format_version):
+    """
+    Builds an index (runs in its own process, so peak RSS is that of the build alone)
+    """
+    from index import Indexer
+    from query_parser import Parser
+    parser = Parser()
+    indexer = Indexer(preprocess=parser.preprocess, tokenize=parser.tokenize, format_version=format_version)
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if streaming:
+            indexer.index_streaming(input_file, postings_path, dictionary_path, workers=workers)
+        else:
+            indexer.index(input_file)
+            indexer.save(postings_path, dictionary_path)
+    return {"seconds": time.perf_counter() - start, "peak_rss_bytes": peak_rss()}
+
+
+def _query_run(dictionary_path, postings_path, workloads, top_k):
+    """
+    Runs query workloads on one SearchEngine (runs in its own process)
+    """
+    from search import SearchEngine
+    start = time.perf_counter()
+    engine = SearchEngine(dictionary_path, postings_path)
+    report = {"startup_seconds": time.perf_counter() - start, "workloads": {}}
+    with engine, open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for workload, queries in workloads.items():
+            expand = workload == "expanded"
+            conjunctive = workload == "boolean"
+            # warm up, so the first queries do not pay for page faults and lazy loading
+            for query in queries[:10]:
+                engine.query(query, expand=expand, top_k=top_k, conjunctive=conjunctive)
+            latencies = []
+            n_results = 0
+            total_start = time.perf_counter()
+            for query in queries:
+                query_start = time.perf_counter()
+                n_results += len(engine.query(query, expand=expand, top_k=top_k, conjunctive=conjunctive))
+                latencies.append((time.perf_counter() - query_start) * 1000)
+            total = time.perf_counter() - total_start
+            report["workloads"][workload] = {
+                "queries": len(queries),
+                "latency_ms": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+                               "p99": percentile(latencies, 99), "mean": float(np.mean(latencies))},
+                "qps": len(queries) / total if total else None,
+                "mean_results": n_results / len(queries),
+            }
+    report["peak_rss_bytes"] = peak_rss()
+    return report
+
+
+def _run_step(target, args, results):
+    """
+    Runs a benchmark step in the child process, reporting its result or its traceback to the parent
+    """
+    try:
+        results.put((True, target(*args)))
+    except Exception:
+        results.put((False, traceback.format_exc()))
+
+
+def run_in_process(target, *args):
+    """
+    Runs a benchmark step in a fresh process
+    :return: the dict the step reported
+    :raise RuntimeError: if the step raised an exception or its process died
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_step, args=(target, args, results))
+    process.start()
+    try:
+        reply = None
+        while reply is None:
+            # checked before waiting, so a process found dead has had the time to put its result
+            alive = process.is_alive()
+            try:
+                reply = results.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                if not alive:
+                    raise RuntimeError("benchmark step {} died with exit code {}".format(target.__name__,
+                                                                                        process.exitcode))
+    finally:
+        process.join()
+    succeeded, report = reply
+    if not succeeded:
+        raise RuntimeError("benchmark step {} failed:\n{}".format(target.__name__, report))
+    return report
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(corpus_sizes, doc_len=300, vocabulary_size=5000, n_queries=200, top_k=None, streaming=False,
+                  workers=None, format_version=None, seed=0, tmp_dir=None):
+    """
+    Runs the benchmark suite: for every corpus size, generates a corpus, indexes it and runs the query workloads
+    :param corpus_sizes: list of numbers of documents
+    :param top_k: top_k passed to SearchEngine.query
+    :param streaming: index with Indexer.index_streaming instead of Indexer.index
+    :param format_version: postings format version, the latest by default
+    :return: dict of results, see main
+    """
+    import postings_format
+    if format_version is None:
+        format_version = postings_format.LATEST_VERSION
+    report = {
+        "config": {"corpus_sizes": corpus_sizes, "words_per_document": doc_len, "vocabulary_size": vocabulary_size,
+                   "queries_per_workload": n_queries, "top_k": top_k, "streaming": streaming, "workers": workers,
+                   "format_version": format_version, "seed": seed},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count(), "git_revision": git_revision()},
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "runs": [],
+    }
+    work_dir = tempfile.mkdtemp(dir=tmp_dir)
+    try:
+        for n_docs in corpus_sizes:
+            input_file = os.path.join(work_dir, "corpus_{}.csv".format(n_docs))
+            postings_path = os.path.join(work_dir, "postings_{}.txt".format(n_docs))
+            dictionary_path = os.path.join(work_dir, "dictionary_{}.txt".format(n_docs))
+            vocabulary, samples = generate_corpus(input_file, n_docs, doc_len, vocabulary_size, seed)
+            print("Indexing {} documents...".format(n_docs))
+            indexing = run_in_process(_index_run, input_file, postings_path, dictionary_path, streaming, workers,
+                                      format_version)
+            indexing["docs_per_second"] = n_docs / indexing["seconds"]
+            indexing["postings_bytes"] = os.path.getsize(postings_path)
+            indexing["dictionary_bytes"] = os.path.getsize(dictionary_path)
+            indexing["corpus_bytes"] = os.path.getsize(input_file)
+            workloads = {workload: generate_queries(vocabulary, samples, n_queries, workload, seed)
+                         for workload in WORKLOADS}
+            print("Querying {} documents...".format(n_docs))
+            querying = run_in_process(_query_run, dictionary_path, postings_path, workloads, top_k)
+            report["runs"].append({"documents": n_docs, "indexing": indexing, "search": querying})
+            for name, result in querying["workloads"].items():
+                print("{} docs, {}: p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms, {:.1f} QPS".format(
+                    n_docs, name, result["latency_ms"]["p50"], result["latency_ms"]["p95"],
+                    result["latency_ms"]["p99"], result["qps"]))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+if __name__ == "__main__":
+    output_file = tmp_dir = None
+    corpus_sizes = [1000, 10000]
+    doc_len = 300
+    vocabulary_size = 5000
+    n_queries = 200
+    top_k = None
+    streaming = False
+    workers = None
+    format_version = None
+    seed = 0
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'o:n:l:v:q:k:sw:f:r:t:')
+    except getopt.GetoptError as err:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-o':  # results file
+            output_file = a
+        elif o == '-n':  # comma separated corpus sizes
+            corpus_sizes = [int(size) for size in a.split(",")]
+        elif o == '-l':
+            doc_len = int(a)
+        elif o == '-v':
+            vocabulary_size = int(a)
+        elif o == '-q':
+            n_queries = int(a)
+        elif o == '-k':
+            top_k = int(a)
+        elif o == '-s':  # streaming (SPIMI) build
+            streaming = True
+        elif o == '-w':
+            workers = int(a)
+        elif o == '-f':
+            format_version = int(a)
+        elif o == '-r':
+            seed = int(a)
+        elif o == '-t':
+            tmp_dir = a
+        else:
+            assert False, "unhandled option"
+
+    if not output_file:
+        usage()
+        sys.exit(2)
+
+    results = run_benchmark(corpus_sizes, doc_len, vocabulary_size, n_queries, top_k, streaming, workers,
+                            format_version, seed, tmp_dir)
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results saved to {}".format(output_file))
@@ -0,0 +1,50 @@
+# Biword (phrase) index: pairs of adjacent terms found in at least a given number of documents are indexed as terms of
+# their own, "first second", whose postings hold the documents and positions (of the first term) of the pair. A phrase
+# whose adjacent pairs are all indexed is then matched over the short biword postings instead of the postings of its
+# terms; a pair missing from the dictionary may still occur in the documents, so any other phrase is matched by
+# position. Terms never contain spaces, so biwords cannot collide with them.
+SEPARATOR = " "
+
+
+def biword(first, second):
+    """
+    :return: the biword term of a pair of adjacent terms
+    """
+    return first + SEPARATOR + second
+
+
+def is_biword(term):
+    return SEPARATOR in term
+
+
+def is_word(term):
+    """
+    Only pairs of words are mined, a pair with a punctuation token is never phrase-searched for
+    :return: whether a term contains a letter or a digit
+    """
+    return any(char.isalnum() for char in term)
+
+
+def phrase_biwords(tokens):
+    """
+    :param tokens: the terms of a phrase
+    :return: list of the biwords of the adjacent pairs of the phrase, the i-th one starts at offset i
+    """
+    return [biword(tokens[i], tokens[i + 1]) for i in range(len(tokens) - 1)]
+
+
+def add_biwords(term_positions, terms):
+    """
+    Adds the pairs of adjacent words of a document to its term positions
+    :param term_positions: maps term -> list of positions, of the terms of the document
+    :param terms: the terms of the document, in order
+    :return: nothing
+    """
+    words = {term: is_word(term) for term in term_positions}
+    for pos in range(len(terms) - 1):
+        if words[terms[pos]] and words[terms[pos + 1]]:
+            pair = biword(terms[pos], terms[pos + 1])
+            if pair in term_positions:
+                term_positions[pair].append(pos)
+            else:
+                term_positions[pair] = [pos]
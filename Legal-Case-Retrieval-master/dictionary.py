@@ -1,4 +1,84 @@
+import mmap
 import pickle
+import struct
+import numpy as np
+
+# Dictionaries are saved as named arrays that can be memory-mapped (see ArrayDictionary):
+#   [magic (4 bytes), format version (4 bytes), number of arrays (4 bytes), padding (4 bytes),
+#   array table: (name (16 bytes), dtype (8 bytes), file offset (8 bytes), length (8 bytes)) per array,
+#   array data, each aligned to 8 bytes]
+# Dictionaries saved with pickle (the original format) are still loaded by load_dictionary.
+DICT_MAGIC = b"LCRD"
+DICT_VERSION = 1
+DICT_HEADER = struct.Struct("<4sIII")
+DICT_ARRAY = struct.Struct("<16s8sQQ")
+
+
+def encode_strings(strings):
+    """
+    Packs a list of strings into a blob of utf-8 bytes and an offsets array
+    :param strings: list of strings
+    :return: a tuple of (uint8 array blob, int64 offsets array of length len(strings) + 1)
+    """
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def write_arrays(path, arrays):
+    """
+    Writes named NumPy arrays in the memory-mappable dictionary format
+    :param path: the path to the save file
+    :param arrays: list of (name, array) pairs
+    :return: nothing
+    """
+    arrays = [(name, np.ascontiguousarray(array)) for name, array in arrays]
+    offset = DICT_HEADER.size + DICT_ARRAY.size * len(arrays)
+    table = []
+    for name, array in arrays:
+        offset = (offset + 7) // 8 * 8
+        table.append(DICT_ARRAY.pack(name.encode("ascii"), array.dtype.str.encode("ascii"), offset, len(array)))
+        offset += array.nbytes
+    with open(path, "wb") as f:
+        f.write(DICT_HEADER.pack(DICT_MAGIC, DICT_VERSION, len(arrays), 0))
+        for entry in table:
+            f.write(entry)
+        for (name, array), entry in zip(arrays, table):
+            f.write(b"\0" * (DICT_ARRAY.unpack(entry)[2] - f.tell()))
+            f.write(array.tobytes())
+
+
+def read_arrays(buffer):
+    """
+    Maps the named arrays of a buffer written by write_arrays, without copying
+    :param buffer: a buffer (e.g. an mmap) holding the file contents
+    :return: dict of name -> array
+    """
+    magic, version, n_arrays, _ = DICT_HEADER.unpack_from(buffer, 0)
+    if magic != DICT_MAGIC or version > DICT_VERSION:
+        raise ValueError("unsupported dictionary format")
+    arrays = {}
+    for i in range(n_arrays):
+        name, dtype, offset, length = DICT_ARRAY.unpack_from(buffer, DICT_HEADER.size + i * DICT_ARRAY.size)
+        name = name.rstrip(b"\0").decode("ascii")
+        arrays[name] = np.frombuffer(buffer, dtype=np.dtype(dtype.rstrip(b"\0").decode("ascii")), count=length,
+                                     offset=offset)
+    return arrays
+
+
+def load_dictionary(path):
+    """
+    Loads a dictionary saved in either format
+    :param path: the dictionary file
+    :return: an ArrayDictionary, or a Dictionary for pickled dictionaries
+    """
+    with open(path, "rb") as f:
+        is_array_format = f.read(len(DICT_MAGIC)) == DICT_MAGIC
+        if not is_array_format:
+            f.seek(0)
+            return pickle.load(f)
+    return ArrayDictionary(path)
 
 
 class Dictionary(object):
@@ -16,6 +96,8 @@ class Dictionary(object):
         self.__construct_stoi()
         # index to pointers in file
         self.itop = None
+        # index to pointers of positions (relative to the positions region, for postings stored in the split layout)
+        self.itopp = None
         self.doc_ids = doc_ids
         self.doc_order = {}
         for idx, doc_id in enumerate(doc_ids):
@@ -23,6 +105,10 @@ class Dictionary(object):
         self.doc_len = None
         self.dfs = None
         self.cfs = None
+        # maps stem -> termIDs of its in-vocabulary synonyms (precomputed query expansion)
+        self.synonyms = None
+        # maps token -> max document weight (1 + log(tf)) / doc_len over its postings
+        self.max_weights = None
 
     def __getitem__(self, key):
         """
@@ -35,6 +121,24 @@ class Dictionary(object):
         else:
             return None
 
+    def __contains__(self, key):
+        return key in self.stoi
+
+    def __len__(self):
+        return len(self.itos)
+
+    def get_position_pointer(self, key):
+        """
+        Looks up the positions pointer of a token
+        :param key: the token to look up
+        :return: pointer relative to the positions region, or None if positions are stored with the postings
+        """
+        itopp = getattr(self, "itopp", None)
+        if key in self.stoi and itopp:
+            return itopp[self.stoi[key]]
+        else:
+            return None
+
     def __construct_stoi(self):
         """
         Internal method for constructing stoi mapping from itos mapping
@@ -51,6 +155,44 @@ class Dictionary(object):
         """
         return self.itos[idx]
 
+    def get_df(self, key):
+        """
+        Looks up the document frequency of a token
+        :param key: the token to look up
+        :return: document frequency (0 if the token is not in the dictionary)
+        """
+        return self.dfs.get(key, 0)
+
+    def get_max_weight(self, key):
+        """
+        Looks up the max document weight of a token (see Indexer.__max_weight)
+        :param key: the token to look up
+        :return: the max document weight, or None if the dictionary does not store them
+        """
+        max_weights = getattr(self, "max_weights", None)
+        if not max_weights or key not in max_weights:
+            return None
+        return max_weights[key]
+
+    def num_docs(self):
+        return len(self.doc_ids)
+
+    def top_df_terms(self, n):
+        """
+        Returns the tokens with the highest document frequencies
+        :param n: number of tokens
+        :return: list of tokens, by descending document frequency
+        """
+        return sorted(self.dfs.keys(), key=lambda token: (-self.dfs[token], token))[:n]
+
+    def get_doc_arrays(self):
+        """
+        Returns the docIDs in ascending order and their document vector norms
+        :return: a tuple of (int64 array of docIDs, float64 array of norms)
+        """
+        doc_ids = np.array(sorted(self.doc_ids), dtype=np.int64)
+        return doc_ids, np.array([self.doc_len[doc_id] for doc_id in doc_ids.tolist()], dtype=np.float64)
+
     def add_dfs(self, dfs):
         self.dfs = dfs
 
@@ -60,14 +202,235 @@ class Dictionary(object):
     def add_pointers(self, ptrs):
         self.itop = ptrs
 
+    def add_position_pointers(self, ptrs):
+        self.itopp = ptrs
+
     def add_cfs(self, cfs):
         self.cfs = cfs
 
-    def save(self, path):
+    def add_max_weights(self, max_weights):
+        self.max_weights = max_weights
+
+    def add_synonyms(self, synonyms):
+        self.synonyms = synonyms
+
+    def get_synonyms(self, key):
+        """
+        Looks up the precomputed synonyms of a stem
+        :param key: the stem to look up
+        :return: list of synonym tokens, or None if the dictionary has no synonym table
+        """
+        synonyms = getattr(self, "synonyms", None)
+        if synonyms is None:
+            return None
+        return [self.itos[idx] for idx in synonyms.get(key, ())]
+
+    def synonym_table(self):
+        """
+        :return: dict of stem -> list of synonym tokens, or None if the dictionary has no synonym table
+        """
+        synonyms = getattr(self, "synonyms", None)
+        if synonyms is None:
+            return None
+        return {key: self.get_synonyms(key) for key in synonyms}
+
+    def save(self, path, pickled=False):
         """
         Save the dictionary itself to disk
         :param path: the path to the save file
+        :param pickled: save with pickle (the original format) instead of the memory-mappable array format
+        :return: nothing
+        """
+        if pickled:
+            with open(path, "wb") as f:
+                pickle.dump(self, f)
+            return
+        # terms are stored sorted, so that they can be looked up by binary search
+        order = sorted(range(len(self.itos)), key=lambda idx: self.itos[idx])
+        new_ids = {old_id: new_id for new_id, old_id in enumerate(order)}
+        terms = [self.itos[idx] for idx in order]
+        term_blob, term_offsets = encode_strings(terms)
+        itopp = getattr(self, "itopp", None) or {}
+        max_weights = getattr(self, "max_weights", None) or {}
+        doc_ids, doc_norms = self.get_doc_arrays()
+        arrays = [
+            ("term_blob", term_blob),
+            ("term_offsets", term_offsets),
+            ("dfs", np.array([self.dfs[term] for term in terms], dtype=np.int64)),
+            ("cfs", np.array([self.cfs.get(term, 0) if self.cfs else 0 for term in terms], dtype=np.int64)),
+            ("ptrs", np.array([self.itop[idx] for idx in order], dtype=np.int64)),
+            ("pos_ptrs", np.array([-1 if itopp.get(idx) is None else itopp[idx] for idx in order], dtype=np.int64)),
+            ("max_weights", np.array([max_weights.get(term, np.nan) for term in terms], dtype=np.float64)),
+            ("doc_ids", doc_ids),
+            ("doc_norms", doc_norms),
+        ]
+        synonyms = getattr(self, "synonyms", None)
+        if synonyms is not None:
+            keys = sorted(synonyms.keys())
+            key_blob, key_offsets = encode_strings(keys)
+            indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+            np.cumsum([len(synonyms[key]) for key in keys], out=indptr[1:])
+            arrays += [
+                ("syn_key_blob", key_blob),
+                ("syn_key_offsets", key_offsets),
+                ("syn_indptr", indptr),
+                ("syn_ids", np.array([new_ids[idx] for key in keys for idx in synonyms[key]], dtype=np.int64)),
+            ]
+        write_arrays(path, arrays)
+
+    def close(self):
+        pass
+
+
+class ArrayDictionary(object):
+    """
+    Read-only dictionary memory-mapped from the array format written by Dictionary.save. Terms are a sorted utf-8
+    blob with an offsets array, looked up by binary search; df, cf, postings pointers and max weights are parallel
+    arrays indexed by termID, and docIDs and norms are dense arrays. Nothing is deserialized when loading.
+    """
+    def __init__(self, path):
+        """
+        :param path: the dictionary file
+        """
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        arrays = read_arrays(self.mmap)
+        self.term_blob = arrays["term_blob"]
+        self.term_offsets = arrays["term_offsets"]
+        self.dfs = arrays["dfs"]
+        self.cfs = arrays["cfs"]
+        self.ptrs = arrays["ptrs"]
+        self.pos_ptrs = arrays["pos_ptrs"]
+        self.max_weights = arrays["max_weights"]
+        self.doc_ids = arrays["doc_ids"]
+        self.doc_norms = arrays["doc_norms"]
+        self.syn_key_blob = arrays.get("syn_key_blob")
+        self.syn_key_offsets = arrays.get("syn_key_offsets")
+        self.syn_indptr = arrays.get("syn_indptr")
+        self.syn_ids = arrays.get("syn_ids")
+
+    def __search(self, blob, offsets, key):
+        """
+        Binary search of a string in a sorted string blob
+        :return: the index of the string, or None if it is absent
+        """
+        key = key.encode("utf-8")
+        lo = 0
+        hi = len(offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if blob[offsets[mid]:offsets[mid + 1]].tobytes() < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(offsets) - 1 and blob[offsets[lo]:offsets[lo + 1]].tobytes() == key:
+            return lo
+        return None
+
+    def term_id(self, key):
+        """
+        Looks up the termID of a token
+        :param key: the token to look up
+        :return: termID, or None if the token is not in the dictionary
+        """
+        return self.__search(self.term_blob, self.term_offsets, key)
+
+    def __contains__(self, key):
+        return self.term_id(key) is not None
+
+    def __getitem__(self, key):
+        """
+        Implements [] operator, looks up file pointer of a token
+        :param key: the token to look up
+        :return: file pointer
+        """
+        idx = self.term_id(key)
+        return None if idx is None else int(self.ptrs[idx])
+
+    def __len__(self):
+        return len(self.term_offsets) - 1
+
+    def get_token(self, idx):
+        """
+        Looks up the token of a termID in dictionary
+        :param idx: the index to loop up
+        :return: token
+        """
+        return self.term_blob[self.term_offsets[idx]:self.term_offsets[idx + 1]].tobytes().decode("utf-8")
+
+    def get_position_pointer(self, key):
+        """
+        Looks up the positions pointer of a token
+        :param key: the token to look up
+        :return: pointer relative to the positions region, or None if positions are stored with the postings
+        """
+        idx = self.term_id(key)
+        if idx is None or self.pos_ptrs[idx] < 0:
+            return None
+        return int(self.pos_ptrs[idx])
+
+    def get_df(self, key):
+        idx = self.term_id(key)
+        return 0 if idx is None else int(self.dfs[idx])
+
+    def get_max_weight(self, key):
+        idx = self.term_id(key)
+        if idx is None or np.isnan(self.max_weights[idx]):
+            return None
+        return float(self.max_weights[idx])
+
+    def get_synonyms(self, key):
+        """
+        Looks up the precomputed synonyms of a stem
+        :param key: the stem to look up
+        :return: list of synonym tokens, or None if the dictionary has no synonym table
+        """
+        if self.syn_indptr is None:
+            return None
+        idx = self.__search(self.syn_key_blob, self.syn_key_offsets, key)
+        if idx is None:
+            return []
+        return [self.get_token(term_id) for term_id in self.syn_ids[self.syn_indptr[idx]:self.syn_indptr[idx + 1]]]
+
+    def synonym_table(self):
+        """
+        :return: dict of stem -> list of synonym tokens, or None if the dictionary has no synonym table
+        """
+        if self.syn_indptr is None:
+            return None
+        table = {}
+        for idx in range(len(self.syn_indptr) - 1):
+            key = self.syn_key_blob[self.syn_key_offsets[idx]:self.syn_key_offsets[idx + 1]].tobytes().decode("utf-8")
+            term_ids = self.syn_ids[self.syn_indptr[idx]:self.syn_indptr[idx + 1]]
+            table[key] = [self.get_token(term_id) for term_id in term_ids]
+        return table
+
+    def num_docs(self):
+        return len(self.doc_ids)
+
+    def top_df_terms(self, n):
+        """
+        Returns the tokens with the highest document frequencies
+        :param n: number of tokens
+        :return: list of tokens, by descending document frequency
+        """
+        # terms are sorted, so a stable sort breaks ties by token like Dictionary.top_df_terms
+        order = np.argsort(-self.dfs, kind="stable")[:n]
+        return [self.get_token(idx) for idx in order]
+
+    def get_doc_arrays(self):
+        """
+        Returns the docIDs in ascending order and their document vector norms
+        :return: a tuple of (int64 array of docIDs, float64 array of norms), views of the mapping
+        """
+        return self.doc_ids, self.doc_norms
+
+    def close(self):
+        """
+        Releases the mapping (once the arrays handed out are no longer used)
         :return: nothing
         """
-        with open(path, "wb") as f:
-            pickle.dump(self, f)
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass
@@ -0,0 +1,201 @@
+import mmap
+import zlib
+import struct
+import numpy as np
+
+# A document store holds the text of every document, so a document can be read without loading the corpus:
+#   [magic (4 bytes), version (1 byte), flags (1 byte), reserved (2 bytes), file offset of the document table (8 bytes)]
+#   [document texts (UTF-8), or zlib-compressed blocks of consecutive texts if FLAG_COMPRESSED is set]
+#   [document table: number of documents, number of blocks (8 bytes each), then int64 arrays of the docIDs (ascending),
+#    the block of each document (-1 if not compressed), its offset (in the file, or in its decompressed block) and its
+#    length, then the file offset and length of each block]
+STORE_MAGIC = b"LCRS"
+STORE_VERSION = 1
+STORE_HEADER = struct.Struct("<4sBBHQ")
+TABLE_HEADER = struct.Struct("<QQ")
+
+FLAG_COMPRESSED = 0x1
+
+# uncompressed size of a compressed block, documents are not split across blocks
+BLOCK_SIZE = 64 * 2**10
+
+
+class DocumentStoreWriter(object):
+    """
+    Writes a document store, documents can be added in any docID order
+    """
+    def __init__(self, path, compress=False, block_size=BLOCK_SIZE):
+        """
+        :param path: the path of the document store
+        :param compress: whether to compress documents, in blocks of about block_size bytes
+        :param block_size: uncompressed size of a block
+        """
+        self.compress = compress
+        self.block_size = block_size
+        self.f = open(path, "wb")
+        self.f.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, FLAG_COMPRESSED if compress else 0, 0, 0))
+        self.doc_ids = []
+        self.blocks = []
+        self.offsets = []
+        self.lengths = []
+        self.block_offsets = []
+        self.block_lengths = []
+        self.block = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, doc_id, text):
+        """
+        Adds a document
+        :param doc_id: the docID
+        :param text: the text of the document (missing texts, e.g. NaN read by pandas, are stored as empty)
+        :return: nothing
+        """
+        data = text.encode("utf-8") if isinstance(text, str) else b""
+        self.doc_ids.append(doc_id)
+        self.lengths.append(len(data))
+        if not self.compress:
+            self.blocks.append(-1)
+            self.offsets.append(self.f.tell())
+            self.f.write(data)
+            return
+        self.blocks.append(len(self.block_offsets))
+        self.offsets.append(len(self.block))
+        self.block += data
+        if len(self.block) >= self.block_size:
+            self.__flush_block()
+
+    def __flush_block(self):
+        if not self.block:
+            return
+        compressed = zlib.compress(bytes(self.block))
+        self.block_offsets.append(self.f.tell())
+        self.block_lengths.append(len(compressed))
+        self.f.write(compressed)
+        self.block = bytearray()
+
+    def close(self):
+        """
+        Writes the document table and closes the file
+        :return: nothing
+        """
+        if self.f is None:
+            return
+        self.__flush_block()
+        table_offset = self.f.tell()
+        order = np.argsort(np.array(self.doc_ids, dtype=np.int64), kind="stable")
+        self.f.write(TABLE_HEADER.pack(len(self.doc_ids), len(self.block_offsets)))
+        for values in (self.doc_ids, self.blocks, self.offsets, self.lengths):
+            self.f.write(np.array(values, dtype=np.int64)[order].tobytes())
+        for values in (self.block_offsets, self.block_lengths):
+            self.f.write(np.array(values, dtype=np.int64).tobytes())
+        self.f.seek(0)
+        self.f.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, FLAG_COMPRESSED if self.compress else 0, 0,
+                                       table_offset))
+        self.f.close()
+        self.f = None
+
+
+class DocumentStore(object):
+    """
+    Memory-mapped document store, see DocumentStoreWriter. Only the document table is loaded, texts are read (and
+    blocks decompressed) on demand.
+    """
+    def __init__(self, path):
+        """
+        :param path: the path of the document store
+        """
+        with open(path, "rb") as f:
+            magic, version, flags, _, table_offset = STORE_HEADER.unpack(f.read(STORE_HEADER.size))
+            if magic != STORE_MAGIC:
+                raise ValueError("{} is not a document store".format(path))
+            if version > STORE_VERSION:
+                raise ValueError("unsupported document store version {}".format(version))
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.compressed = bool(flags & FLAG_COMPRESSED)
+        n_docs, n_blocks = TABLE_HEADER.unpack(self.mmap[table_offset:table_offset + TABLE_HEADER.size])
+        table = np.frombuffer(self.mmap, dtype=np.int64, count=4 * n_docs + 2 * n_blocks,
+                              offset=table_offset + TABLE_HEADER.size)
+        self.doc_ids, self.blocks, self.offsets, self.lengths = table[:4 * n_docs].reshape(4, n_docs)
+        self.block_offsets, self.block_lengths = table[4 * n_docs:].reshape(2, n_blocks)
+        # the last decompressed block, consecutive lookups often hit the same block
+        self.__block_id = None
+        self.__block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        return self.__locate([doc_id])[0] >= 0
+
+    def __locate(self, doc_ids):
+        """
+        :param doc_ids: list of docIDs
+        :return: int array of the index of each document in the table, -1 for unknown docIDs
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if not len(self.doc_ids):
+            return np.full(len(doc_ids), -1, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.doc_ids, doc_ids), len(self.doc_ids) - 1)
+        return np.where(self.doc_ids[idx] == doc_ids, idx, -1)
+
+    def __get_block(self, block_id):
+        if block_id != self.__block_id:
+            start = int(self.block_offsets[block_id])
+            self.__block = zlib.decompress(self.mmap[start:start + int(self.block_lengths[block_id])])
+            self.__block_id = block_id
+        return self.__block
+
+    def get_document(self, doc_id):
+        """
+        :param doc_id: the docID
+        :return: the text of the document, or None if it is not in the store
+        """
+        return self.get_documents([doc_id])[0]
+
+    def get_documents(self, doc_ids):
+        """
+        Reads several documents, e.g. the top results of a query. Documents are read in file order, so each compressed
+        block is decompressed once.
+        :param doc_ids: list of docIDs
+        :return: list of texts in the same order as doc_ids, None for docIDs not in the store
+        """
+        idx = self.__locate(doc_ids)
+        texts = [None] * len(idx)
+        found = np.flatnonzero(idx >= 0)
+        rows = idx[found]
+        for i in np.lexsort((self.offsets[rows], self.blocks[rows])).tolist():
+            row = int(rows[i])
+            offset, length = int(self.offsets[row]), int(self.lengths[row])
+            if self.compressed:
+                data = self.__get_block(int(self.blocks[row]))[offset:offset + length]
+            else:
+                data = self.mmap[offset:offset + length]
+            texts[int(found[i])] = data.decode("utf-8")
+        return texts
+
+    def close(self):
+        """
+        Releases the mapping
+        :return: nothing
+        """
+        if self.mmap is not None:
+            self.doc_ids = self.blocks = self.offsets = self.lengths = None
+            self.block_offsets = self.block_lengths = None
+            self.__block = None
+            try:
+                self.mmap.close()
+            except BufferError:
+                # views handed out are still alive, the mapping is released when they are garbage collected
+                pass
+            self.mmap = None
@@ -1,53 +1,90 @@
 import argparse
+import numpy as np
 
-parser = argparse.ArgumentParser(description='parse filename')
-parser.add_argument('--ans', type=str, help='answer')
-parser.add_argument('--res', type=str, help='result')
 
-args = parser.parse_args()
+def f_score(precision, recall):
+    return 1 / (1 / precision + 1 / recall)
 
-MY_RESULT = args.res
-GIVEN_RESULT = args.ans
 
-l1 = []
-r2 = set()
+def relevant_hits(ranking, relevant):
+    """
+    Marks the ranks of a result list at which a relevant document is retrieved for the first time, up to the rank at
+    which every relevant document of the list has been found
+    :param ranking: list of docIDs, best first, possibly with duplicates
+    :param relevant: set of relevant docIDs
+    :return: bool array (ranks), truncated after the last relevant document found
+    """
+    hits = np.zeros(len(ranking), dtype=bool)
+    n_found = len(relevant.intersection(ranking))
+    seen = set()
+    for rank, doc_id in enumerate(ranking):
+        if len(seen) == n_found:
+            return hits[:rank]
+        if doc_id in relevant and doc_id not in seen:
+            seen.add(doc_id)
+            hits[rank] = True
+    return hits
 
-with open(MY_RESULT, 'r') as f:
-    for line in f:
-        for token in line.strip().split(' '):
-            l1.append(int(token))
 
-with open(GIVEN_RESULT, 'r') as f:
-    for line in f:
-        for token in line.strip().split(' '):
-            r2.add(int(token))
+def hit_metrics(hits, n_relevant):
+    """
+    Precision, recall and F-score at the rank of every relevant document retrieved, for one or several rankings
+    :param hits: bool array (rankings x ranks), whether the document at each rank is relevant
+    :param n_relevant: number of relevant documents
+    :return: a tuple of float arrays (precisions, recalls, fscores) shaped like hits, 0 where hits is False
+    """
+    hits = np.atleast_2d(hits)
+    count = np.cumsum(hits, axis=1)
+    ranks = np.arange(1, hits.shape[1] + 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precisions = np.where(hits, count / ranks, 0)
+        recalls = np.where(hits, count / n_relevant, 0)
+        fscores = np.where(hits, f_score(precisions, recalls), 0)
+    return precisions, recalls, fscores
 
-get_them = set(l1) & r2  # intersection
 
-def f_score(precision, recall):
-    return 1 / (1 / precision + 1 / recall)
+def average_metrics(hits, n_relevant):
+    """
+    Average precision, recall and F-score over the relevant documents retrieved, for one or several rankings
+    :param hits: see hit_metrics
+    :param n_relevant: number of relevant documents
+    :return: a tuple of float arrays (avg precisions, avg recalls, avg fscores), one per ranking, 0 for rankings
+        without any relevant document
+    """
+    hits = np.atleast_2d(hits)
+    n_hits = np.maximum(hits.sum(axis=1), 1)
+    return tuple(metric.sum(axis=1) / n_hits for metric in hit_metrics(hits, n_relevant))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='parse filename')
+    parser.add_argument('--ans', type=str, help='answer')
+    parser.add_argument('--res', type=str, help='result')
+
+    args = parser.parse_args()
+
+    MY_RESULT = args.res
+    GIVEN_RESULT = args.ans
+
+    l1 = []
+    r2 = set()
+
+    with open(MY_RESULT, 'r') as f:
+        for line in f:
+            for token in line.strip().split(' '):
+                l1.append(int(token))
+
+    with open(GIVEN_RESULT, 'r') as f:
+        for line in f:
+            for token in line.strip().split(' '):
+                r2.add(int(token))
 
-precisions = []
-recalls = []
-fscores = []
-count = 0
-for i in range(len(l1)):
-    if count == len(get_them):
-        break
-    if l1[i] in r2:
-        count += 1
-        
-        precision = count / (i + 1)
-        recall = count / len(r2)
-
-        precisions.append(precision)
-        recalls.append(recall)
-        fscores.append(f_score(precision, recall))
-
-print('precisions:   ', precisions)
-print('recalls:      ', recalls)
-print('F-scores:     ', fscores)
-print('avg precision:   ', sum(precisions) / len(fscores))
-print('avg recall:      ', sum(recalls) / len(fscores))
-print('avg F-score:     ', sum(fscores) / len(fscores))
+    hits = relevant_hits(l1, r2)
+    precisions, recalls, fscores = (metric[0][hits].tolist() for metric in hit_metrics(hits, len(r2)))
 
+    print('precisions:   ', precisions)
+    print('recalls:      ', recalls)
+    print('F-scores:     ', fscores)
+    print('avg precision:   ', sum(precisions) / len(fscores))
+    print('avg recall:      ', sum(recalls) / len(fscores))
+    print('avg F-score:     ', sum(fscores) / len(fscores))
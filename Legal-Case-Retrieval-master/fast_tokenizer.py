@@ -0,0 +1,57 @@
+import re
+
+# Single-pattern tokenizer giving the token boundaries of nltk.word_tokenize (Punkt sentence splitting followed by the
+# Treebank word tokenizer) for the text found in judgments and queries, without splitting sentences first:
+#   - double quotes become `` when they open a quotation (at the start or after a space or an opening bracket) and ''
+#     otherwise, like Treebank, so Parser.parse_query still detects phrases
+#   - ; @ # $ % & ? ! * brackets, curly quotes, dashes and ellipses are tokens of their own, and so are , and : unless
+#     a digit follows (1,000 and 12:30 stay whole)
+#   - clitics are split from the word before them (do n't, court 's, judges '), and opening single quotes from
+#     the word after them
+#   - a period ending a sentence (followed by the end of the text, or by a space and a word not starting with a
+#     lowercase letter) is split, other periods stay in their token (U.S., No.5, 3.5)
+#   - cannot, gonna, gotta, wanna, gimme and lemme are split in two
+# Punkt's abbreviation heuristics are not reproduced; tokenizer_parity.py measures how often the tokens differ.
+_SEP = r"\s;@#$%&?!*()\[\]{}<>\"`«“‘„»”’\u2012-\u2015"
+_END = r"(?:[{sep}]|[,:](?!\d)|--|\.\.|''|\Z)".format(sep=_SEP)
+_CLITIC = r"(?:n't|N'T|'ll|'LL|'re|'RE|'ve|'VE|'[sSmMdD]|')"
+_FINAL_PERIOD = r"\.(?=[\]\)}>\"'»”’]*(?:\s*\Z|\s+[^a-z\s]))"
+
+TOKEN_PATTERN = re.compile(r"""
+    (?P<open>(?<![^\s(\[{{<])"|(?<=[\s(\[{{<])'')  # opening double quote, at the start or after a space or bracket
+  | (?P<close>"|'')                             # closing double quote
+  | ``
+  | \.{{2,}} | --
+  | [;@#$%&?!*()\[\]{{}}<>«“‘„»”’`\u2012-\u2015]
+  | (?<!\w)'(?!(?i:re|ve|ll|m|t|s|d|n)\b)(?=\w)  # opening single quote
+  | [,:](?!\d)
+  | {clitic}(?={end}|{final_period})
+  | (?i:can(?=not\b)|gon(?=na\b)|wan(?=na(?:\s|\Z))|got(?=ta\b)|gim(?=me\b)|lem(?=me\b))
+  | (?:[A-Za-z]\.){{2,}}(?![\w.])               # dotted abbreviations
+  | {final_period}
+  | (?:[^{sep},:]|[,:](?=\d))+?(?={clitic}(?:{end}|{final_period})|{final_period}|{end})
+""".format(sep=_SEP, end=_END, clitic=_CLITIC, final_period=_FINAL_PERIOD), re.VERBOSE)
+
+
+def iter_tokens(text):
+    """
+    Tokenizes a text lazily
+    :param text: the text
+    :return: generator of tokens
+    """
+    for match in TOKEN_PATTERN.finditer(text):
+        if match.lastgroup == "open":
+            yield "``"
+        elif match.lastgroup == "close":
+            yield "''"
+        else:
+            yield match.group()
+
+
+def tokenize(text):
+    """
+    Tokenizes a text, see iter_tokens
+    :param text: the text
+    :return: list of tokens
+    """
+    return list(iter_tokens(text))
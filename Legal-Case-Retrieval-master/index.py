@@ -2,26 +2,266 @@
 import math
 import nltk
 import sys
+import os
+import array
 import getopt
 import heapq
 import pickle
+import itertools
+import collections
+import tempfile
+import multiprocessing
+import numpy as np
 import pandas as pd
+from nltk.corpus import wordnet as wn
+import postings_format
 from dictionary import Dictionary
-from query_parser import Parser
+from doc_store import DocumentStoreWriter
+from biwords import biword, is_biword, is_word, add_biwords
+from query_parser import Parser, STEMS_SUFFIX
+
+# rough number of bytes a buffered posting item (docID or position) costs in memory, used to enforce memory budgets
+BYTES_PER_ITEM = 40
+# the in-memory build reports its progress every this many documents
+PROGRESS_INTERVAL = 1000
 
 
 def usage():
-    print("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file")
+    print("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file "
+                                    "[-s] [-w workers] [-m memory-budget-MB] [-c chunk-size] [-f format-version] "
+                                    "[-e] [-k synonyms-per-term] [-t] [-q] [-o document-store-file] [-z] [-a] "
+                                    "[-b biword-min-df]")
+
+
+# tokenize / preprocess functions used by the worker processes of the streaming build
+_worker_tokenize = None
+_worker_preprocess = None
+_worker_stem_cache = None
+_worker_biwords = False
+
+
+def _init_worker(tokenize, preprocess, stem_cache=None, biwords=False):
+    global _worker_tokenize, _worker_preprocess, _worker_stem_cache, _worker_biwords
+    _worker_tokenize = tokenize
+    _worker_preprocess = preprocess
+    _worker_stem_cache = stem_cache
+    _worker_biwords = biwords
+
+
+def _process_chunk(rows):
+    """
+    Tokenizes and preprocesses a chunk of documents (runs in a worker process).
+    :param rows: list of (docID, content) pairs
+    :return: a tuple of (list of (docID, term positions, document vector norm), stems), where term positions maps
+        term -> list of positions (biwords included if the worker mines them, see biwords) and stems holds the
+        surface form -> stem entries the worker's stem cache learned (None without a stem cache)
+    """
+    result = []
+    for doc_id, content in rows:
+        term_positions = {}
+        terms = _worker_preprocess(_worker_tokenize(content))
+        if _worker_biwords:
+            # the terms are read twice
+            terms = list(terms)
+        for pos, term in enumerate(terms):
+            if term in term_positions:
+                term_positions[term].append(pos)
+            else:
+                term_positions[term] = [pos]
+        norm = 0
+        # summed in term order, like PostingsAccumulator.build, so both builds give identical norms
+        for term in sorted(term_positions):
+            tfidf = 1 + math.log(len(term_positions[term]), 10)
+            norm += tfidf * tfidf
+        if _worker_biwords:
+            # every pair of words is a candidate, the ones in too few documents are dropped when the runs are merged
+            add_biwords(term_positions, terms)
+        result.append((doc_id, term_positions, math.sqrt(norm)))
+    return result, _worker_stem_cache.take_new() if _worker_stem_cache is not None else None
+
+
+def _read_run(path):
+    """
+    Reads back a run written by the streaming build, one (term, postings) record at a time.
+    :param path: path to the run file
+    :return: generator of (term, list of (docID, positions)) in term order
+    """
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                break
+
+
+class PostingsAccumulator(object):
+    """
+    In-memory postings of the documents indexed by Indexer.index, accumulated in typed arrays: terms get a termID the
+    first time they are seen and every token costs a 4-byte termID (its document and position follow from the document
+    lengths). build() sorts the occurrences by termID once to produce the postings of every term.
+    """
+    def __init__(self):
+        # term -> termID, in order of first occurrence
+        self.term_ids = {}
+        # termID of every token, documents one after the other
+        self.occurrences = array.array("i")
+        self.doc_ids = []
+        # number of tokens of each document
+        self.doc_lengths = array.array("q")
+        self.term_starts = None
+        self.posting_doc_ids = None
+        self.tfs = None
+        self.position_starts = None
+        self.positions = None
+
+    def add(self, doc_id, terms):
+        """
+        Adds the terms of a document
+        :param doc_id: the docID
+        :param terms: iterable of the document's terms, in order
+        :return: nothing
+        """
+        term_ids = self.term_ids
+        n_tokens = len(self.occurrences)
+        self.occurrences.extend(term_ids.setdefault(term, len(term_ids)) for term in terms)
+        self.doc_ids.append(doc_id)
+        self.doc_lengths.append(len(self.occurrences) - n_tokens)
+
+    def __mine_biwords(self, occurrences, doc_lengths, min_df):
+        """
+        Finds the pairs of adjacent words found in at least min_df documents and gives them termIDs (see biwords)
+        :param occurrences: termIDs of the tokens
+        :param doc_lengths: number of tokens of each document
+        :param min_df: minimum document frequency of a biword
+        :return: a tuple of (termIDs of the biword occurrences, index of the first token of each occurrence), in token
+            order
+        """
+        n_terms = len(self.term_ids)
+        terms = list(self.term_ids.keys())
+        words = np.array([is_word(term) for term in terms], dtype=bool)
+        doc_starts = np.cumsum(doc_lengths) - doc_lengths
+        # a token forms a pair with the next one if both are words of the same document
+        starts_doc = np.zeros(len(occurrences), dtype=bool)
+        starts_doc[doc_starts[doc_lengths > 0]] = True
+        pairs = np.flatnonzero(words[occurrences[:-1]] & words[occurrences[1:]] & ~starts_doc[1:])
+        codes = occurrences[pairs].astype(np.int64) * n_terms + occurrences[pairs + 1]
+        pair_docs = np.repeat(np.arange(len(doc_lengths)), doc_lengths)[pairs]
+        # document frequency of each pair, from the pair occurrences sorted by pair (in document order within a pair)
+        order = np.argsort(codes, kind="stable")
+        sorted_codes, sorted_docs = codes[order], pair_docs[order]
+        new_doc = np.ones(len(order), dtype=np.int64)
+        new_doc[1:] = (sorted_codes[1:] != sorted_codes[:-1]) | (sorted_docs[1:] != sorted_docs[:-1])
+        unique_codes, code_starts = np.unique(sorted_codes, return_index=True)
+        dfs = np.add.reduceat(new_doc, code_starts) if len(code_starts) else np.zeros(0, dtype=np.int64)
+        frequent = unique_codes[dfs >= min_df]
+        # the termIDs of the biwords follow the termIDs of the words
+        for code in frequent.tolist():
+            self.term_ids[biword(terms[code // n_terms], terms[code % n_terms])] = len(self.term_ids)
+        idx = np.searchsorted(frequent, codes)
+        keep = idx < len(frequent)
+        keep[keep] = frequent[idx[keep]] == codes[keep]
+        return n_terms + idx[keep], pairs[keep]
+
+    def build(self, biword_min_df=None):
+        """
+        Sorts the occurrences into postings, ordered by termID then document then position
+        :param biword_min_df: if given, the pairs of adjacent words found in at least this many documents are added as
+            terms of their own (see biwords), they do not count in the document vector norms
+        :return: a tuple of (document frequencies, collection frequencies, document vector norms), arrays indexed by
+            termID for the first two and by document (in order of addition) for the norms
+        """
+        occurrences = np.frombuffer(self.occurrences, dtype=np.intc)
+        doc_lengths = np.frombuffer(self.doc_lengths, dtype=np.longlong)
+        n_docs = len(doc_lengths)
+        n_words = len(self.term_ids)
+        terms = occurrences
+        tokens = None
+        if biword_min_df:
+            biword_terms, biword_tokens = self.__mine_biwords(occurrences, doc_lengths, biword_min_df)
+            terms = np.concatenate([occurrences, biword_terms])
+            tokens = np.concatenate([np.arange(len(occurrences)), biword_tokens])
+        # occurrences are in (document, position) order, a stable sort by termID keeps that order within each term
+        order = np.argsort(terms, kind="stable")
+        terms = terms[order]
+        # index of the token of each occurrence (of the first token of a biword)
+        tokens = order if tokens is None else tokens[order]
+        del order
+        docs = np.repeat(np.arange(n_docs, dtype=np.int32), doc_lengths)[tokens]
+        # position of an occurrence = its index - the index of the first token of its document
+        tokens -= (np.cumsum(doc_lengths) - doc_lengths)[docs]
+        self.positions = tokens.astype(np.int32)
+        del tokens
+        # one posting per run of occurrences of the same term in the same document
+        starts = np.ones(len(terms), dtype=bool)
+        starts[1:] = (terms[1:] != terms[:-1]) | (docs[1:] != docs[:-1])
+        self.position_starts = np.append(np.flatnonzero(starts), len(terms))
+        self.tfs = np.diff(self.position_starts).astype(np.int32)
+        posting_terms = terms[self.position_starts[:-1]]
+        posting_docs = docs[self.position_starts[:-1]]
+        self.term_starts = np.searchsorted(posting_terms, np.arange(len(self.term_ids) + 1))
+        self.posting_doc_ids = np.array(self.doc_ids, dtype=np.int64)[posting_docs]
+        cfs = np.bincount(terms, minlength=len(self.term_ids))
+        self.occurrences = None
+        # the weights are computed like the rest of the indexer (math.log, for identical rounding) and summed per
+        # document in term order (as _process_chunk does), over the words only
+        tfidf_table = np.array([0.0] + [1 + math.log(tf, 10) for tf in range(1, int(self.tfs.max(initial=0)) + 1)])
+        tfidfs = tfidf_table[self.tfs]
+        term_ranks = np.empty(n_words, dtype=np.int64)
+        term_ranks[sorted(range(n_words), key=list(self.term_ids.keys()).__getitem__)] = np.arange(n_words)
+        words = np.flatnonzero(posting_terms < n_words)
+        words = words[np.argsort(term_ranks[posting_terms[words]], kind="stable")]
+        norms = np.sqrt(np.bincount(posting_docs[words], weights=tfidfs[words] * tfidfs[words], minlength=n_docs))
+        return np.diff(self.term_starts), cfs, norms
+
+    def get_postings(self, term):
+        """
+        :return: a tuple of (list of docIDs, list of term frequencies) of a term
+        """
+        term_id = self.term_ids[term]
+        start, end = self.term_starts[term_id], self.term_starts[term_id + 1]
+        return self.posting_doc_ids[start:end].tolist(), self.tfs[start:end].tolist()
+
+    def get_positions(self, term):
+        """
+        :return: list of the position lists of a term, one per posting
+        """
+        term_id = self.term_ids[term]
+        start, end = self.term_starts[term_id], self.term_starts[term_id + 1]
+        first, last = self.position_starts[start], self.position_starts[end]
+        positions = self.positions[first:last].tolist()
+        offsets = (self.position_starts[start:end + 1] - first).tolist()
+        return [positions[offsets[i]:offsets[i + 1]] for i in range(end - start)]
 
 
 class Indexer(object):
 
-    def __init__(self, preprocess=None, tokenize=None):
+    def __init__(self, preprocess=None, tokenize=None, format_version=postings_format.LATEST_VERSION,
+                 synonyms=False, synonym_top_k=None, stem_cache=None, impacts=False, biword_min_df=None):
+        """
+        :param preprocess: function normalizing an iterable of tokens into an iterable of terms, documents are
+                           streamed through tokenize and preprocess if they return iterators (see Parser.iter_tokens)
+        :param format_version: postings file format version to write (see postings_format)
+        :param synonyms: whether to precompute the WordNet synonym table used for query expansion
+        :param synonym_top_k: if given, only keep the k synonyms of each term most similar to it
+                              (see Parser.top_k_similarity)
+        :param stem_cache: the StemCache used by preprocess, if given the stems learned by worker processes of the
+                           streaming build are collected into it
+        :param impacts: whether to store quantized document weights (impacts) in the postings, see postings_format
+        :param biword_min_df: if given, the pairs of adjacent words found in at least this many documents are indexed as
+                              terms of their own, to match phrases (see biwords)
+        """
+        self.format_version = format_version
+        self.synonyms = synonyms
+        self.synonym_top_k = synonym_top_k
+        self.stem_cache = stem_cache
+        self.impacts = impacts
+        self.biword_min_df = biword_min_df
+        self.doc_len = None
         self.dictionary = None
         self.postings = None
-        self.positions = None
         self.byte_repr = b""
         self.repr_ptrs = []
+        self.repr_pos_ptrs = []
         self.vocabulary = None
         self.dfs = None
         if preprocess:
@@ -38,141 +278,314 @@ class Indexer(object):
     def __build_postings(self, doc_tokens):
         """
         Builds postings from document tokens.
-        :param doc_tokens: list of document tokens, where each element is a list of tokens in a document
-        :return: post_dict: maps term -> (list of postings, list of term frequency)
+        :param doc_tokens: iterable of (docID, list of tokens in the document)
+        :return: postings: a PostingsAccumulator holding the postings and positions of every term
                  df_dict: maps term -> document frequency
                  doc_len_dict: maps docID -> document vector norm
+                 cf_dict: maps term -> collection frequency
         """
-        post_dict = {}
-        tf_dict = {}
-        pos_dict = {}
-        df_dict = {}
-        cf_dict = {}
-        doc_len_dict = {}
-        count = 0
-        # get tf information
-        for doc in doc_tokens:
-            doc_id, term_list = doc
-            tf_dict[doc_id] = {}
-            pos_dict[doc_id] = {}
-            doc_len_dict[doc_id] = 0
-            # tfs
-            for pos, term in enumerate(term_list):
-                if term in cf_dict:
-                    cf_dict[term] += 1
-                else:
-                    cf_dict[term] = 0
-                tf_dict[doc_id][term] = tf_dict[doc_id].get(term, 0) + 1
-                orig_pos = pos_dict[doc_id].get(term, [])
-                orig_pos.append(pos)
-                pos_dict[doc_id][term] = orig_pos
-                # postings
-                # if postings list is empty or does not contain this doc_id
-                if term not in post_dict:
-                    post_dict[term] = [doc_id]
-                elif post_dict[term][-1] != doc_id:
-                    post_dict[term].append(doc_id)
-            count += 1
-            print("Building postings for doc {} out of {}...".format(count, len(doc_tokens)))
-
-        # build vocabulary
-        self.vocabulary = [term for term in post_dict.keys()]
-
-        # restructure tf for each term in each documents
-        for term in self.vocabulary:
-            # calculate df
-            df_dict[term] = len(post_dict[term])
-            # get tf
-            tfs = []
-            for doc_id in post_dict[term]:
-                tfidf = 1 + math.log(tf_dict[doc_id][term], 10)
-                tfs.append(tf_dict[doc_id][term])
-                doc_len_dict[doc_id] += tfidf*tfidf
-            post_dict[term] = (post_dict[term], tfs)
-
-        for key, value in doc_len_dict.items():
-            doc_len_dict[key] = math.sqrt(value)
-        return post_dict, df_dict, doc_len_dict, pos_dict, cf_dict
+        postings = PostingsAccumulator()
+        for doc_id, term_list in doc_tokens:
+            postings.add(doc_id, term_list)
+        dfs, cfs, norms = postings.build(self.biword_min_df)
+        terms = list(postings.term_ids.keys())
+        df_dict = dict(zip(terms, dfs.tolist()))
+        cf_dict = dict(zip(terms, cfs.tolist()))
+        doc_len_dict = dict(zip(postings.doc_ids, norms.tolist()))
+        return postings, df_dict, doc_len_dict, cf_dict
 
-    def __save_byte_repr(self, postings_path, encoding_length=3):
+    def __build_synonyms(self, vocabulary):
         """
-        Construct the byte representation of this index. Entries are stored consecutively, and each entry is formatted
-        as follows:
-            [length of entry (number of items), term_id, length of postings (integer count),
-            postings: docID1, docID2, ..., tf1, tf2 ...,
-            positions: length1, pos1_1, pos1_2, ..., length2, pos2_1, ...]
-        :param encoding_length: integer encoding length
-        :return: nothing
+        Precomputes the synonyms used for query expansion. Keys are the vocabulary and the stems of all WordNet lemma
+        names, values are the synonyms found in the vocabulary, computed the same way as query-time expansion. Other
+        stems WordNet has synsets for (inflected forms resolved by morphy, e.g. "criteria") are looked up in WordNet at
+        query time.
+        :param vocabulary: the sorted vocabulary
+        :return: dict mapping stem -> tuple of termIDs of its synonyms
+        """
+        stoi = {token: idx for idx, token in enumerate(vocabulary)}
+        keys = set(token for token in vocabulary if not is_biword(token))
+        keys.update(self.__preprocess([lemma for lemma in wn.all_lemma_names() if "_" not in lemma]))
+        ranker = Parser() if self.synonym_top_k else None
+        table = {}
+        for key in sorted(keys):
+            result = set()
+            for synset in wn.synsets(key):
+                name, = self.__preprocess([synset.name().split(".")[0]])
+                if name in stoi:
+                    result.add(name)
+            if ranker and len(result) > self.synonym_top_k:
+                result = set(word for word, sim in ranker.top_k_similarity(key, list(result), self.synonym_top_k))
+            if result:
+                table[key] = tuple(sorted(stoi[name] for name in result))
+        print("Built synonym table for {} stems...".format(len(table)))
+        return table
+
+    def __max_weight(self, tfs, doc_ids, doc_len_dict):
+        """
+        Upper bound of the document weight of a term, used for dynamic pruning at query time
+        :param tfs: term frequencies of the term
+        :param doc_ids: corresponding docIDs
+        :param doc_len_dict: maps docID -> document vector norm
+        :return: max over the postings of (1 + log(tf)) / document norm, or of the dequantized impacts if the postings
+            store impacts
         """
+        if self.impacts:
+            (low, high), impacts = self.__impacts(tfs, doc_ids, doc_len_dict)
+            return postings_format.dequantize_impact(max(impacts), low, high)
+        return max((1 + math.log(tf, 10)) / doc_len_dict[doc_id] for tf, doc_id in zip(tfs, doc_ids))
 
-        def to_byte_rep(x): return x.to_bytes(encoding_length, byteorder="little")
+    def __impacts(self, tfs, doc_ids, doc_len_dict):
+        """
+        Quantized document weights of the postings of a term
+        :param tfs: term frequencies of the term
+        :param doc_ids: corresponding docIDs
+        :param doc_len_dict: maps docID -> document vector norm
+        :return: a tuple of (impact range, list of impacts), see postings_format.quantize_impacts, or None if the
+            postings do not store impacts
+        """
+        if not self.impacts:
+            return None
+        return postings_format.quantize_impacts([(1 + math.log(tf, 10)) / doc_len_dict[doc_id]
+                                                 for tf, doc_id in zip(tfs, doc_ids)])
 
-        file_ptr = 0
+    def __save_byte_repr(self, postings_path, encoding_length=3):
+        """
+        Construct the byte representation of this index. Entries are stored consecutively, see postings_format for the
+        format of each entry.
+        :param encoding_length: integer encoding length (format version 1 only)
+        :return: nothing
+        """
         ptrs = {}
-        with open(postings_path, "wb") as f:
+        pos_ptrs = {}
+        with postings_format.PostingsWriter(postings_path, self.format_version, encoding_length,
+                                            self.impacts) as writer:
             for term_id, token in enumerate(self.vocabulary):
-                ptrs[term_id] = file_ptr
-                doc_ids, tfs = self.postings[token]
-                # construct byte representation of each entry
-                # calculate length of positions
-                len_positions = 0
-                for doc_id in doc_ids:
-                    len_positions += len(self.positions[doc_id][token]) + 1
-                # length of entry
-                f.write(to_byte_rep(len(doc_ids)*2 + 3 + len_positions))
-                # term_id
-                f.write(to_byte_rep(term_id))
-                # length of postings
-                f.write(to_byte_rep(len(doc_ids)))
-                # postings
-                for doc_id in doc_ids:
-                    f.write(to_byte_rep(doc_id))
-                # tfs
-                for tf in tfs:
-                    f.write(to_byte_rep(tf))
-                # positions
-                for doc_id in doc_ids:
-                    pos_list = self.positions[doc_id][token]
-                    f.write(to_byte_rep(len(pos_list)))
-                    for pos in pos_list:
-                        f.write(to_byte_rep(pos))
-                file_ptr += (len(doc_ids) * 2 + 3 + len_positions) * encoding_length
+                doc_ids, tfs = self.postings.get_postings(token)
+                positions = self.postings.get_positions(token)
+                impacts = self.__impacts(tfs, doc_ids, self.doc_len)
+                ptrs[term_id], pos_ptrs[term_id] = writer.add(term_id, doc_ids, tfs, positions, impacts)
         self.repr_ptrs = ptrs
+        self.repr_pos_ptrs = pos_ptrs
 
-    def index(self, input_file):
+    def index(self, input_file, doc_store_path=None, compress_documents=False):
         """
         Construct the reverse index of all files in input_file_dir, applicable to Reuters Corpus, where file names are
         the corresponding docIDs
         :param input_file: the path to the directory containing the files to index
+        :param doc_store_path: if given, the texts of the documents are also written to this document store
+            (see doc_store)
+        :param compress_documents: whether the document store is compressed
         :return: nothing
         """
-        # get training file names
-        doc_ids = []
-        # construct index
-        document_tokens = []
         csv_data = pd.read_csv(input_file)
-        # for i in range(csv_data.shape[0]):
-        for i in range(10):
-            document = csv_data.iloc[i]
-            doc_id = int(document.document_id)
-            doc_ids.append(doc_id)
-            # read file contents
-            tokens = []
-            tokens += self.__preprocess(self.__tokenize(document.content))
-            document_tokens.append((doc_id, tokens))
-            print("Processing {} out of {} lines...".format(i + 1, csv_data.shape[0]))
-
-        # build postings from (docID, token) pairs
-        postings_dict, df_dict, doc_len_dict, pos_dict, cf_dict = self.__build_postings(document_tokens)
-        self.vocabulary = sorted(postings_dict.keys())
-        self.postings = postings_dict
-        self.positions = pos_dict
+        doc_store = DocumentStoreWriter(doc_store_path, compress_documents) if doc_store_path else None
+        try:
+            # build postings from (docID, tokens) pairs, the tokens of each document are accumulated as they are read
+            postings, df_dict, doc_len_dict, cf_dict = self.__build_postings(self.__read_documents(csv_data, doc_store))
+        finally:
+            if doc_store is not None:
+                doc_store.close()
+        doc_ids = postings.doc_ids
+        self.vocabulary = sorted(postings.term_ids.keys())
+        self.postings = postings
         self.dfs = df_dict
+        self.doc_len = doc_len_dict
+
+        max_weights = {}
+        for term in self.vocabulary:
+            term_doc_ids, tfs = postings.get_postings(term)
+            max_weights[term] = self.__max_weight(tfs, term_doc_ids, doc_len_dict)
 
         self.dictionary = Dictionary(self.vocabulary, doc_ids)
         self.dictionary.add_dfs(self.dfs)
         self.dictionary.add_doc_len(doc_len_dict)
         self.dictionary.add_cfs(cf_dict)
+        self.dictionary.add_max_weights(max_weights)
+        if self.synonyms:
+            self.dictionary.add_synonyms(self.__build_synonyms(self.vocabulary))
+
+    def __read_documents(self, csv_data, doc_store=None):
+        """
+        Tokenizes and preprocesses the documents of a csv file
+        :param csv_data: the DataFrame of the csv file
+        :param doc_store: if given, a DocumentStoreWriter the texts of the documents are added to
+        :return: generator of (docID, list of terms) pairs
+        """
+        for i in range(csv_data.shape[0]):
+            document = csv_data.iloc[i]
+            doc_id = int(document.document_id)
+            if doc_store is not None:
+                doc_store.add(doc_id, document.content)
+            yield doc_id, self.__preprocess(self.__tokenize(document.content))
+            if (i + 1) % PROGRESS_INTERVAL == 0 or i + 1 == csv_data.shape[0]:
+                print("Processed {} out of {} lines...".format(i + 1, csv_data.shape[0]))
+
+    def __read_chunks(self, input_file, chunk_size):
+        """
+        Reads the input csv file in chunks
+        :param input_file: the path to the csv file
+        :param chunk_size: number of documents per chunk
+        :return: generator of lists of (docID, content) pairs
+        """
+        for chunk in pd.read_csv(input_file, usecols=["document_id", "content"], chunksize=chunk_size):
+            contents = chunk.content.fillna("")
+            yield [(int(doc_id), content) for doc_id, content in zip(chunk.document_id, contents)]
+
+    def __store_chunks(self, chunks, doc_store):
+        """
+        Writes the documents of chunks to a document store as they are read
+        :param chunks: iterable of lists of (docID, content) pairs
+        :param doc_store: a DocumentStoreWriter
+        :return: generator of the chunks
+        """
+        for chunk in chunks:
+            for doc_id, content in chunk:
+                doc_store.add(doc_id, content)
+            yield chunk
+
+    def __process_chunks(self, chunks, workers):
+        """
+        Tokenizes and preprocesses chunks of documents across a process pool, keeping at most a few chunks in flight
+        so that memory use does not grow with the size of the input file.
+        :param chunks: iterable of lists of (docID, content) pairs
+        :param workers: number of worker processes, 1 processes the chunks in this process
+        :return: generator of processed chunks (see _process_chunk), in input order
+        """
+        if workers == 1:
+            _init_worker(self.__tokenize, self.__preprocess, self.stem_cache, bool(self.biword_min_df))
+            for chunk in chunks:
+                yield _process_chunk(chunk)
+            return
+        pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                    initargs=(self.__tokenize, self.__preprocess, self.stem_cache,
+                                              bool(self.biword_min_df)))
+        try:
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_process_chunk, (chunk,)))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+            pool.close()
+        except BaseException:
+            # including GeneratorExit, if the caller stops early: chunks still in flight are dropped
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def __flush_block(self, block, tmp_dir):
+        """
+        Writes a partial inverted index to a run file, sorted by term
+        :param block: maps term -> list of (docID, positions)
+        :param tmp_dir: directory for the run file
+        :return: the path of the run file
+        """
+        fd, path = tempfile.mkstemp(suffix=".run", dir=tmp_dir)
+        with os.fdopen(fd, "wb") as f:
+            for term in sorted(block.keys()):
+                pickle.dump((term, block[term]), f, pickle.HIGHEST_PROTOCOL)
+        return path
+
+    def index_streaming(self, input_file, postings_path, dictionary_path, chunk_size=1000, workers=None,
+                        memory_limit=256 * 2**20, tmp_dir=None, doc_store_path=None, compress_documents=False):
+        """
+        Builds the index with bounded memory (SPIMI): documents are read in chunks and tokenized across a process pool,
+        partial inverted indexes are flushed to run files whenever the memory budget is hit, and the runs are k-way
+        merged into the final postings and dictionary files. Produces the same files as index() followed by save().
+        :param input_file: the path to the csv file to index
+        :param postings_path: the path of postings file
+        :param dictionary_path: the path of dictionary file
+        :param chunk_size: number of documents read and tokenized at a time
+        :param workers: number of worker processes (defaults to the number of CPUs)
+        :param memory_limit: approximate number of bytes of postings to buffer before flushing a run
+        :param tmp_dir: directory for the run files (defaults to the system temporary directory)
+        :param doc_store_path: if given, the texts of the documents are also written to this document store
+        :param compress_documents: whether the document store is compressed
+        :return: nothing
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        doc_ids = []
+        doc_len_dict = {}
+        runs = []
+        block = {}
+        block_items = 0
+        doc_store = DocumentStoreWriter(doc_store_path, compress_documents) if doc_store_path else None
+        try:
+            chunks = self.__read_chunks(input_file, chunk_size)
+            if doc_store is not None:
+                chunks = self.__store_chunks(chunks, doc_store)
+            for chunk, stems in self.__process_chunks(chunks, workers):
+                if stems:
+                    self.stem_cache.update(stems)
+                for doc_id, term_positions, norm in chunk:
+                    doc_ids.append(doc_id)
+                    doc_len_dict[doc_id] = norm
+                    for term, positions in term_positions.items():
+                        if term in block:
+                            block[term].append((doc_id, positions))
+                        else:
+                            block[term] = [(doc_id, positions)]
+                        block_items += len(positions) + 2
+                if block_items * BYTES_PER_ITEM >= memory_limit:
+                    runs.append(self.__flush_block(block, tmp_dir))
+                    block = {}
+                    block_items = 0
+                print("Processed {} documents, {} runs written...".format(len(doc_ids), len(runs)))
+            if doc_store is not None:
+                doc_store.close()
+
+            # k-way merge of the runs (and the block still in memory), runs are in document order so merging is stable
+            sources = [_read_run(path) for path in runs]
+            sources.append(iter(sorted(block.items())))
+            block = None
+            merged = heapq.merge(*sources, key=lambda record: record[0])
+
+            vocabulary = []
+            df_dict = {}
+            cf_dict = {}
+            max_weights = {}
+            ptrs = {}
+            pos_ptrs = {}
+            with postings_format.PostingsWriter(postings_path, self.format_version, impacts=self.impacts) as writer:
+                for term, records in itertools.groupby(merged, key=lambda record: record[0]):
+                    postings = [posting for _, term_postings in records for posting in term_postings]
+                    if is_biword(term) and len(postings) < self.biword_min_df:
+                        # a pair of words found in too few documents
+                        continue
+                    term_id = len(vocabulary)
+                    vocabulary.append(term)
+                    term_doc_ids = [doc_id for doc_id, _ in postings]
+                    positions = [pos_list for _, pos_list in postings]
+                    tfs = [len(pos_list) for pos_list in positions]
+                    df_dict[term] = len(term_doc_ids)
+                    cf_dict[term] = sum(tfs)
+                    max_weights[term] = self.__max_weight(tfs, term_doc_ids, doc_len_dict)
+                    impacts = self.__impacts(tfs, term_doc_ids, doc_len_dict)
+                    ptrs[term_id], pos_ptrs[term_id] = writer.add(term_id, term_doc_ids, tfs, positions, impacts)
+        finally:
+            if doc_store is not None:
+                doc_store.close()
+            for path in runs:
+                os.remove(path)
+
+        self.vocabulary = vocabulary
+        self.dfs = df_dict
+        self.repr_ptrs = ptrs
+        self.repr_pos_ptrs = pos_ptrs
+        self.dictionary = Dictionary(vocabulary, doc_ids)
+        self.dictionary.add_dfs(df_dict)
+        self.dictionary.add_doc_len(doc_len_dict)
+        self.dictionary.add_cfs(cf_dict)
+        self.dictionary.add_max_weights(max_weights)
+        self.dictionary.add_pointers(ptrs)
+        self.dictionary.add_position_pointers(pos_ptrs)
+        if self.synonyms:
+            self.dictionary.add_synonyms(self.__build_synonyms(vocabulary))
+        self.dictionary.save(dictionary_path)
 
     def save(self, postings_path, dictionary_path):
         """
@@ -184,14 +597,28 @@ class Indexer(object):
         # construct byte representation for postings
         self.__save_byte_repr(postings_path)
         self.dictionary.add_pointers(self.repr_ptrs)
+        self.dictionary.add_position_pointers(self.repr_pos_ptrs)
         self.dictionary.save(dictionary_path)
 
 
 if __name__ == "__main__":
     input_directory = output_file_dictionary = output_file_postings = None
+    streaming = False
+    workers = None
+    memory_budget = 256
+    chunk_size = 1000
+    format_version = postings_format.LATEST_VERSION
+    synonyms = False
+    synonym_top_k = None
+    save_stems = False
+    impacts = False
+    doc_store_file = None
+    compress_documents = False
+    fast_tokenizer = False
+    biword_min_df = None
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:')
+        opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:sw:m:c:f:ek:tqo:zab:')
     except getopt.GetoptError as err:
         usage()
         sys.exit(2)
@@ -203,6 +630,32 @@ if __name__ == "__main__":
             output_file_dictionary = a
         elif o == '-p':  # postings file
             output_file_postings = a
+        elif o == '-s':  # streaming (SPIMI) build
+            streaming = True
+        elif o == '-w':  # number of worker processes
+            workers = int(a)
+        elif o == '-m':  # memory budget in MB
+            memory_budget = int(a)
+        elif o == '-c':  # documents per chunk
+            chunk_size = int(a)
+        elif o == '-f':  # postings format version
+            format_version = int(a)
+        elif o == '-e':  # precompute synonyms for query expansion
+            synonyms = True
+        elif o == '-k':  # synonyms kept per term
+            synonym_top_k = int(a)
+        elif o == '-t':  # save the surface form -> stem map next to the dictionary
+            save_stems = True
+        elif o == '-q':  # store quantized impacts in the postings
+            impacts = True
+        elif o == '-o':  # document store file
+            doc_store_file = a
+        elif o == '-z':  # compress the document store
+            compress_documents = True
+        elif o == '-a':  # fast (regular expression) tokenizer, see fast_tokenizer
+            fast_tokenizer = True
+        elif o == '-b':  # index the pairs of adjacent words found in at least this many documents
+            biword_min_df = int(a)
         else:
             assert False, "unhandled option"
 
@@ -211,9 +664,20 @@ if __name__ == "__main__":
         sys.exit(2)
 
     # construct index
-    parser = Parser()
-    indexer = Indexer(preprocess=parser.preprocess, tokenize=parser.tokenize)
-    indexer.index(input_directory)
+    parser = Parser(fast_tokenizer=fast_tokenizer)
+    indexer = Indexer(preprocess=parser.iter_preprocess, tokenize=parser.iter_tokens, format_version=format_version,
+                      synonyms=synonyms, synonym_top_k=synonym_top_k, stem_cache=parser.stem_cache, impacts=impacts,
+                      biword_min_df=biword_min_df)
+    if streaming:
+        indexer.index_streaming(input_directory, output_file_postings, output_file_dictionary, chunk_size=chunk_size,
+                                workers=workers, memory_limit=memory_budget * 2**20, doc_store_path=doc_store_file,
+                                compress_documents=compress_documents)
+    else:
+        indexer.index(input_directory, doc_store_path=doc_store_file, compress_documents=compress_documents)
 
-    # save postings to file
-    indexer.save(output_file_postings, output_file_dictionary)
+        # save postings to file
+        indexer.save(output_file_postings, output_file_dictionary)
+        print("Stem cache: {} surface forms, hit rate {:.3f}".format(len(parser.stem_cache),
+                                                                    parser.stem_cache.hit_rate()))
+    if save_stems:
+        parser.stem_cache.save(output_file_dictionary + STEMS_SUFFIX)
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+
+# size of one decoded integer (NumPy int64)
+BYTES_PER_INT = 8
+
+
+def entry_size(entry):
+    """
+    Estimates the memory used by a decoded postings list, counting its positions as if they were all decoded
+    :param entry: a tuple of (ordinals, tfs, positions, order, doc_weights), see SearchEngine.__get_ordinals
+    :return: size in bytes
+    """
+    ordinals, tfs, positions, order, doc_weights = entry
+    if tfs is None:
+        # tfs stored with the positions (postings with impacts), decoded with them: at most one integer per byte of
+        # the positions entry, plus the offsets array
+        n_positions = positions.encoded_size() + len(positions) + 1
+        return ordinals.nbytes + order.nbytes + doc_weights.nbytes + n_positions * BYTES_PER_INT
+    # positions and their offsets array
+    n_positions = int(tfs.sum()) + len(tfs) + 1
+    return ordinals.nbytes + tfs.nbytes + order.nbytes + doc_weights.nbytes + n_positions * BYTES_PER_INT
+
+
+class PostingsCache(object):
+    """
+    Byte-budgeted cache of decoded postings lists, keyed by token. Two eviction policies are supported:
+        "lru": least recently used entries are evicted first
+        "slru": segmented LRU, frequency-aware. New entries go to a probation segment and are promoted to a protected
+            segment when they are hit again, so terms used once (e.g. rare synonyms) never push out recurring ones.
+            The protected segment holds at most protected_ratio of the budget, entries leaving it go back to probation.
+    Pinned entries are never evicted, and count towards the budget.
+    """
+    def __init__(self, max_bytes=64 * 2**20, policy="lru", protected_ratio=0.8):
+        """
+        :param max_bytes: memory budget of the cache
+        :param policy: eviction policy, "lru" or "slru"
+        :param protected_ratio: share of the budget of the protected segment ("slru" only)
+        """
+        if policy not in ("lru", "slru"):
+            raise ValueError("unknown eviction policy: {}".format(policy))
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.max_protected_bytes = max_bytes * protected_ratio
+        self.pinned = {}
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.pinned_bytes = 0
+        self.protected_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.pinned) + len(self.probation) + len(self.protected)
+
+    def __contains__(self, token):
+        return token in self.pinned or token in self.probation or token in self.protected
+
+    def get(self, token):
+        """
+        Looks up a postings list, counting a hit or a miss
+        :param token: the token to look up
+        :return: the cached entry, or None
+        """
+        entry = self.pinned.get(token)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        entry = self.protected.get(token)
+        if entry is not None:
+            self.hits += 1
+            self.protected.move_to_end(token)
+            return entry
+        entry = self.probation.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.policy == "lru":
+            self.probation.move_to_end(token)
+        else:
+            del self.probation[token]
+            self.protected[token] = entry
+            self.protected_bytes += self.sizes[token]
+            # demote the least recently used protected entries back to probation
+            while self.protected_bytes > self.max_protected_bytes and len(self.protected) > 1:
+                demoted, demoted_entry = self.protected.popitem(last=False)
+                self.protected_bytes -= self.sizes[demoted]
+                self.probation[demoted] = demoted_entry
+        return entry
+
+    def put(self, token, entry):
+        """
+        Adds a postings list, evicting entries to stay within the budget. Lists larger than the budget are not cached.
+        :param token: the token
+        :param entry: the decoded postings list, see entry_size
+        :return: nothing
+        """
+        if token in self:
+            return
+        size = entry_size(entry)
+        if size > self.max_bytes - self.pinned_bytes:
+            return
+        self.probation[token] = entry
+        self.sizes[token] = size
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            segment = self.probation if self.probation else self.protected
+            evicted, _ = segment.popitem(last=False)
+            if segment is self.protected:
+                self.protected_bytes -= self.sizes[evicted]
+            self.bytes -= self.sizes.pop(evicted)
+            self.evictions += 1
+
+    def pin(self, token, entry):
+        """
+        Adds a postings list that is never evicted (still counted towards the budget)
+        :param token: the token
+        :param entry: the decoded postings list, see entry_size
+        :return: True if the list was pinned, False if it does not fit in the budget
+        """
+        size = entry_size(entry)
+        if token in self or self.bytes + size > self.max_bytes:
+            return False
+        self.pinned[token] = entry
+        self.sizes[token] = size
+        self.bytes += size
+        self.pinned_bytes += size
+        return True
+
+    def clear(self):
+        """
+        Drops every entry (pinned ones included), statistics are kept
+        :return: nothing
+        """
+        self.pinned.clear()
+        self.probation.clear()
+        self.protected.clear()
+        self.sizes.clear()
+        self.bytes = 0
+        self.pinned_bytes = 0
+        self.protected_bytes = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def stats(self):
+        """
+        :return: dict of cache statistics
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate(),
+            "evictions": self.evictions,
+            "entries": len(self),
+            "pinned": len(self.pinned),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
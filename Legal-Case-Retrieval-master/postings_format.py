@@ -0,0 +1,425 @@
+import os
+import math
+import shutil
+import struct
+import tempfile
+
+# Postings files written since format version 2 start with a header:
+#   [magic (4 bytes), format version (1 byte), codec (1 byte), flags (2 bytes)]
+# followed, since version 3, by the file offset of the positions region (8 bytes).
+# Version 1 files (fixed 3-byte integers) have no header, their first bytes are the length of the first entry, whose
+# 4th byte (first byte of term_id 0) is always 0, so they can never be mistaken for the magic number.
+MAGIC = b"LCRP"
+HEADER = struct.Struct("<4sBBH")
+POSITIONS_OFFSET = struct.Struct("<Q")
+
+VERSION_FIXED = 1
+VERSION_VBYTE = 2
+# docIDs/tfs and positions are stored in separate regions of the file
+VERSION_SPLIT = 3
+LATEST_VERSION = VERSION_SPLIT
+
+CODEC_FIXED = 0
+CODEC_VBYTE = 1
+
+# header flags
+# entries ended with one impact byte per posting, on a fixed linear scale (no longer read)
+FLAG_LINEAR_IMPACTS = 0x1
+# entries end with the impact range of the term and one impact byte per posting (format version 2 and above)
+FLAG_IMPACTS = 0x2
+# the tfs are stored at the start of the positions entries instead of after the docIDs (format version 3 with
+# FLAG_IMPACTS: scoring only needs the docIDs and impacts, the tfs are read with the positions when those are needed)
+FLAG_TFS_WITH_POSITIONS = 0x4
+
+# Impacts are the document weights (1 + log10(tf)) / doc_len quantized to 8 bits, on a logarithmic scale between the
+# smallest and the largest weight of the term (its impact range, stored as two float32 in its entry): the relative
+# error is the same for every weight, and the largest one (the MaxScore bound) is exact. Weights are positive because
+# doc_len includes the term's own (1 + log10(tf)).
+IMPACT_LEVELS = 255
+IMPACT_RANGE = struct.Struct("<ff")
+
+# every version 2 and 3 entry (docIDs/tfs or positions) is prefixed by the byte length of its payload
+ENTRY_LENGTH = struct.Struct("<I")
+
+
+def write_header(f, version=LATEST_VERSION, codec=CODEC_VBYTE, flags=0, positions_offset=0):
+    """
+    Writes the postings file header
+    :param f: the postings file, positioned at its start
+    :param positions_offset: file offset of the positions region (format version 3 and above)
+    :return: the number of bytes written
+    """
+    f.write(HEADER.pack(MAGIC, version, codec, flags))
+    if version < VERSION_SPLIT:
+        return HEADER.size
+    f.write(POSITIONS_OFFSET.pack(positions_offset))
+    return HEADER.size + POSITIONS_OFFSET.size
+
+
+def read_header(f):
+    """
+    Reads the postings file header, leaves the file positioned at its start
+    :param f: the postings file
+    :return: a tuple of (format version, codec, flags, file offset of the positions region or 0)
+    """
+    f.seek(0)
+    head = f.read(HEADER.size + POSITIONS_OFFSET.size)
+    f.seek(0)
+    if len(head) >= HEADER.size and head[:len(MAGIC)] == MAGIC:
+        _, version, codec, flags = HEADER.unpack(head[:HEADER.size])
+        if version > LATEST_VERSION:
+            raise ValueError("unsupported postings format version {}".format(version))
+        if flags & FLAG_LINEAR_IMPACTS:
+            raise ValueError("postings file with linear impacts, rebuild it")
+        if version >= VERSION_SPLIT and flags & FLAG_IMPACTS and not flags & FLAG_TFS_WITH_POSITIONS:
+            raise ValueError("postings file with impacts stored next to the tfs, rebuild it")
+        positions_offset = 0
+        if version >= VERSION_SPLIT:
+            positions_offset, = POSITIONS_OFFSET.unpack(head[HEADER.size:])
+        return version, codec, flags, positions_offset
+    return VERSION_FIXED, CODEC_FIXED, 0, 0
+
+
+def vbyte_encode(numbers):
+    """
+    Variable-byte encodes a sequence of non-negative integers, 7 bits per byte with the least significant group first.
+    The high bit is set on every byte except the last one of each integer.
+    :param numbers: iterable of integers
+    :return: the encoded bytes
+    """
+    out = bytearray()
+    for x in numbers:
+        while x >= 0x80:
+            out.append((x & 0x7f) | 0x80)
+            x >>= 7
+        out.append(x)
+    return bytes(out)
+
+
+def vbyte_decode(byte_repr):
+    """
+    Decodes a sequence of variable-byte encoded integers
+    :param byte_repr: the encoded bytes
+    :return: list of integers
+    """
+    numbers = []
+    x = 0
+    shift = 0
+    for b in byte_repr:
+        x |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            numbers.append(x)
+            x = 0
+            shift = 0
+    return numbers
+
+
+def to_gaps(numbers):
+    """
+    Delta encodes a sorted list of integers
+    :param numbers: sorted list of integers
+    :return: list of gaps, the first element is kept as is
+    """
+    return [x - prev for x, prev in zip(numbers, [0] + numbers[:-1])]
+
+
+def from_gaps(gaps):
+    """
+    Reverses to_gaps
+    :param gaps: list of gaps
+    :return: list of integers
+    """
+    numbers = []
+    total = 0
+    for gap in gaps:
+        total += gap
+        numbers.append(total)
+    return numbers
+
+
+def impact_range(weights):
+    """
+    :param weights: list of the document weights of a term, all positive
+    :return: a tuple of (smallest weight, largest weight), as stored in the postings file (float32)
+    """
+    return IMPACT_RANGE.unpack(IMPACT_RANGE.pack(min(weights), max(weights)))
+
+
+def impact_step(low, high):
+    """
+    :return: the log of the ratio between the weights of consecutive impacts of a term whose impact range is low, high
+    """
+    return (math.log(high) - math.log(low)) / (IMPACT_LEVELS - 1)
+
+
+def quantize_impacts(weights):
+    """
+    Quantizes the document weights of a term to impacts
+    :param weights: list of document weights, all positive
+    :return: a tuple of (impact range, list of integer impacts in [1, IMPACT_LEVELS])
+    """
+    low, high = impact_range(weights)
+    step = impact_step(low, high)
+    if not step:
+        return (low, high), [IMPACT_LEVELS] * len(weights)
+    log_low = math.log(low)
+    return (low, high), [max(1, min(IMPACT_LEVELS, 1 + int(round((math.log(weight) - log_low) / step))))
+                         for weight in weights]
+
+
+def dequantize_impact(impact, low, high):
+    """
+    :param impact: an impact of a term, see quantize_impacts
+    :param low: smallest weight of the term's impact range
+    :param high: largest weight of the term's impact range
+    :return: the document weight the impact stands for
+    """
+    if impact == IMPACT_LEVELS:
+        return high
+    return math.exp(math.log(low) + (impact - 1) * impact_step(low, high))
+
+
+def encode_impacts(impacts, order):
+    """
+    :param impacts: a tuple of (impact range, list of impacts), see quantize_impacts
+    :param order: order of the postings in the entry
+    :return: the impact range and impact bytes that end an entry
+    """
+    (low, high), levels = impacts
+    return IMPACT_RANGE.pack(low, high) + bytes(levels[i] for i in order)
+
+
+def split_impacts(payload):
+    """
+    Splits the payload of an entry with impacts
+    :param payload: the encoded bytes (without the length prefix), starting with vbyte(length of postings)
+    :return: a tuple of (vbyte encoded part, impact range and impact bytes)
+    """
+    length = 0
+    shift = 0
+    for b in payload:
+        length |= (b & 0x7f) << shift
+        if not b & 0x80:
+            break
+        shift += 7
+    end = len(payload) - length - IMPACT_RANGE.size
+    return payload[:end], payload[end:]
+
+
+def encode_fixed_entry(term_id, doc_ids, tfs, positions, encoding_length=3):
+    """
+    Encodes a postings entry in format version 1, formatted as follows:
+        [length of entry (number of items), term_id, length of postings (integer count),
+        postings: docID1, docID2, ..., tf1, tf2 ...,
+        positions: length1, pos1_1, pos1_2, ..., length2, pos2_1, ...]
+    :param positions: list of position lists, in the same order as doc_ids
+    :param encoding_length: integer encoding length
+    :return: the encoded bytes
+    """
+    def to_byte_rep(x): return x.to_bytes(encoding_length, byteorder="little")
+
+    numbers = [term_id, len(doc_ids)] + list(doc_ids) + list(tfs)
+    for pos_list in positions:
+        numbers.append(len(pos_list))
+        numbers += pos_list
+    return b"".join(to_byte_rep(x) for x in [len(numbers) + 1] + numbers)
+
+
+def encode_entry(doc_ids, tfs, positions, impacts=None):
+    """
+    Encodes a postings entry in format version 2. Postings are sorted by docID, and the entry is formatted as:
+        [byte length of payload (4 bytes), payload: vbyte(length of postings,
+        docID gaps: docID1, docID2 - docID1, ..., tf1, tf2, ...,
+        position gaps: pos1_1, pos1_2 - pos1_1, ..., pos2_1, pos2_2 - pos2_1, ...),
+        impacts: low, high (float32 each, the impact range), impact1, impact2, ... (1 byte each), only in files with
+        FLAG_IMPACTS]
+    The number of positions of each document is its tf, so position list lengths are not stored.
+    :param doc_ids: list of docIDs
+    :param tfs: list of term frequencies, in the same order as doc_ids
+    :param positions: list of position lists, in the same order as doc_ids
+    :param impacts: a tuple of (impact range, list of impacts in the same order as doc_ids), see quantize_impacts
+    :return: the encoded bytes
+    """
+    order = sorted(range(len(doc_ids)), key=lambda i: doc_ids[i])
+    numbers = [len(doc_ids)]
+    numbers += to_gaps([doc_ids[i] for i in order])
+    numbers += [tfs[i] for i in order]
+    for i in order:
+        numbers += to_gaps(positions[i])
+    payload = vbyte_encode(numbers)
+    if impacts is not None:
+        payload += encode_impacts(impacts, order)
+    return ENTRY_LENGTH.pack(len(payload)) + payload
+
+
+def decode_entry(payload, has_impacts=False):
+    """
+    Decodes the payload of a version 2 entry (without its length prefix)
+    :param payload: the encoded bytes
+    :param has_impacts: whether the file has FLAG_IMPACTS (impacts are skipped)
+    :return: a tuple of (docIDs, tfs, positions)
+    """
+    if has_impacts:
+        payload = split_impacts(payload)[0]
+    numbers = vbyte_decode(payload)
+    length = numbers[0]
+    doc_ids = from_gaps(numbers[1:1 + length])
+    tfs = numbers[1 + length:1 + 2 * length]
+    positions = []
+    idx = 1 + 2 * length
+    for tf in tfs:
+        positions.append(from_gaps(numbers[idx:idx + tf]))
+        idx += tf
+    return doc_ids, tfs, positions
+
+
+def encode_split_entry(doc_ids, tfs, positions, impacts=None):
+    """
+    Encodes a postings entry in format version 3, as two parts stored in separate regions of the file:
+        docIDs/tfs: [byte length of payload (4 bytes), payload: vbyte(length of postings, docID gaps, tfs)]
+        positions: [byte length of payload (4 bytes), payload: vbyte(position gaps, in docID order)]
+    In files with FLAG_IMPACTS, the impact range and impacts take the place of the tfs, which start the positions
+    payload instead (FLAG_TFS_WITH_POSITIONS):
+        docIDs/impacts: [byte length of payload (4 bytes), payload: vbyte(length of postings, docID gaps),
+            impact range and impacts]
+        positions: [byte length of payload (4 bytes), payload: vbyte(tfs, position gaps)]
+    :param doc_ids: list of docIDs
+    :param tfs: list of term frequencies, in the same order as doc_ids
+    :param positions: list of position lists, in the same order as doc_ids
+    :param impacts: a tuple of (impact range, list of impacts in the same order as doc_ids), see quantize_impacts
+    :return: a tuple of (docIDs/tfs bytes, positions bytes)
+    """
+    order = sorted(range(len(doc_ids)), key=lambda i: doc_ids[i])
+    numbers = [len(doc_ids)]
+    numbers += to_gaps([doc_ids[i] for i in order])
+    pos_numbers = []
+    if impacts is None:
+        numbers += [tfs[i] for i in order]
+    else:
+        pos_numbers += [tfs[i] for i in order]
+    for i in order:
+        pos_numbers += to_gaps(positions[i])
+    payload = vbyte_encode(numbers)
+    if impacts is not None:
+        payload += encode_impacts(impacts, order)
+    pos_payload = vbyte_encode(pos_numbers)
+    return ENTRY_LENGTH.pack(len(payload)) + payload, ENTRY_LENGTH.pack(len(pos_payload)) + pos_payload
+
+
+def decode_split_entry(payload, has_impacts=False):
+    """
+    Decodes the docIDs/tfs payload of a version 3 entry (without its length prefix)
+    :param payload: the encoded bytes
+    :param has_impacts: whether the file has FLAG_IMPACTS (impacts are skipped)
+    :return: a tuple of (docIDs, tfs), tfs is None if the file has FLAG_IMPACTS (see decode_split_positions)
+    """
+    if has_impacts:
+        numbers = vbyte_decode(split_impacts(payload)[0])
+        return from_gaps(numbers[1:]), None
+    numbers = vbyte_decode(payload)
+    length = numbers[0]
+    return from_gaps(numbers[1:1 + length]), numbers[1 + length:1 + 2 * length]
+
+
+def decode_split_positions(payload, tfs=None, length=None):
+    """
+    Decodes the positions payload of a version 3 entry (without its length prefix)
+    :param payload: the encoded bytes
+    :param tfs: the term frequencies of the entry, i.e. the number of positions of each document, None if the file has
+        FLAG_TFS_WITH_POSITIONS (the tfs are then the lengths of the position lists)
+    :param length: the length of the postings list, if tfs is None
+    :return: list of position lists
+    """
+    numbers = vbyte_decode(payload)
+    idx = 0
+    if tfs is None:
+        tfs = numbers[:length]
+        idx = length
+    positions = []
+    for tf in tfs:
+        positions.append(from_gaps(numbers[idx:idx + tf]))
+        idx += tf
+    return positions
+
+
+class PostingsWriter(object):
+    """
+    Writes a postings file in any format version. Entries are added one term at a time, for format version 3 the
+    positions region is spooled to a temporary file and appended when the writer is closed.
+    """
+    def __init__(self, path, version=LATEST_VERSION, encoding_length=3, impacts=False):
+        """
+        :param path: the path of the postings file
+        :param version: the format version to write
+        :param encoding_length: integer encoding length (format version 1 only)
+        :param impacts: whether entries store impacts (format version 2 and above)
+        """
+        if impacts and version == VERSION_FIXED:
+            raise ValueError("impacts require postings format version {} or above".format(VERSION_VBYTE))
+        self.version = version
+        self.flags = 0
+        if impacts:
+            self.flags = FLAG_IMPACTS | (FLAG_TFS_WITH_POSITIONS if version >= VERSION_SPLIT else 0)
+        self.encoding_length = encoding_length
+        self.f = open(path, "wb")
+        self.file_ptr = 0
+        self.positions_file = None
+        self.positions_ptr = 0
+        if version != VERSION_FIXED:
+            self.file_ptr = write_header(self.f, version, flags=self.flags)
+        if version >= VERSION_SPLIT:
+            self.positions_file = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, term_id, doc_ids, tfs, positions, impacts=None):
+        """
+        Writes the entry of one term
+        :param term_id: the termID
+        :param doc_ids: list of docIDs
+        :param tfs: list of term frequencies, in the same order as doc_ids
+        :param positions: list of position lists, in the same order as doc_ids
+        :param impacts: a tuple of (impact range, list of impacts in the same order as doc_ids), see quantize_impacts
+            (required if the writer stores impacts)
+        :return: a tuple of (file pointer of the entry, pointer of its positions relative to the positions region),
+            the second element is None unless the format stores positions separately
+        """
+        if self.flags & FLAG_IMPACTS and impacts is None:
+            raise ValueError("impacts are required by this postings file")
+        ptr = self.file_ptr
+        pos_ptr = None
+        if self.version == VERSION_FIXED:
+            entry = encode_fixed_entry(term_id, doc_ids, tfs, positions, self.encoding_length)
+        elif self.version == VERSION_VBYTE:
+            entry = encode_entry(doc_ids, tfs, positions, impacts if self.flags & FLAG_IMPACTS else None)
+        else:
+            entry, pos_entry = encode_split_entry(doc_ids, tfs, positions,
+                                                  impacts if self.flags & FLAG_IMPACTS else None)
+            pos_ptr = self.positions_ptr
+            self.positions_file.write(pos_entry)
+            self.positions_ptr += len(pos_entry)
+        self.f.write(entry)
+        self.file_ptr += len(entry)
+        return ptr, pos_ptr
+
+    def close(self):
+        """
+        Appends the positions region (if any) and closes the file
+        :return: nothing
+        """
+        if self.f.closed:
+            return
+        if self.positions_file is not None:
+            positions_offset = self.file_ptr
+            self.positions_file.seek(0)
+            shutil.copyfileobj(self.positions_file, self.f)
+            self.positions_file.close()
+            self.f.seek(0)
+            write_header(self.f, self.version, flags=self.flags, positions_offset=positions_offset)
+        self.f.close()
@@ -0,0 +1,276 @@
+import os
+import math
+import mmap
+import numpy as np
+import postings_format
+
+
+def vbyte_decode_array(byte_repr):
+    """
+    Vectorized version of postings_format.vbyte_decode
+    :param byte_repr: uint8 array of variable-byte encoded integers
+    :return: int64 array of the decoded integers
+    """
+    byte_repr = np.asarray(byte_repr, dtype=np.uint8)
+    # the last byte of each integer is the one with the high bit cleared
+    ends = np.flatnonzero(byte_repr < 0x80)
+    if len(ends) == len(byte_repr):
+        # every integer fits in one byte
+        return byte_repr.astype(np.int64)
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    shifts = (np.arange(len(byte_repr)) - np.repeat(starts, ends - starts + 1)) * 7
+    values = (byte_repr & 0x7f).astype(np.int64) << shifts
+    return np.add.reduceat(values, starts)
+
+
+def fixed_decode_array(byte_repr, encoding_length=3):
+    """
+    Decodes a sequence of fixed-width little endian integers
+    :param byte_repr: uint8 array, its length is a multiple of encoding_length
+    :param encoding_length: integer encoding length
+    :return: int64 array of the decoded integers
+    """
+    items = np.asarray(byte_repr, dtype=np.uint8).reshape(-1, encoding_length).astype(np.int64)
+    return items.dot(np.int64(256) ** np.arange(encoding_length, dtype=np.int64))
+
+
+def segmented_cumsum(gaps, lengths):
+    """
+    Reverses delta encoding of consecutive lists stored back to back, the running sum restarts at every list
+    :param gaps: int64 array of gaps of all lists
+    :param lengths: int64 array of the length of each list
+    :return: int64 array of the decoded values
+    """
+    totals = np.cumsum(gaps)
+    ends = np.cumsum(lengths)
+    bases = np.zeros(len(lengths), dtype=np.int64)
+    bases[1:] = totals[ends[:-1] - 1] if len(totals) else 0
+    return totals - np.repeat(bases, lengths)
+
+
+class PositionLists(object):
+    """
+    Positions of all documents of a postings list, stored as one flat array. Indexing returns a view of the positions
+    of one document, so nothing is materialized per document until it is used.
+    """
+    def __init__(self, positions, offsets):
+        """
+        :param positions: int64 array of all positions
+        :param offsets: int64 array of length (number of documents + 1), positions of document i are
+                        positions[offsets[i]:offsets[i+1]]
+        """
+        self.positions = positions
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.positions[self.offsets[idx]:self.offsets[idx + 1]]
+
+
+class LazyPositionLists(object):
+    """
+    Positions of a postings list stored in the positions region of the file (format version 3). The positions entry is
+    only read and decoded the first time the positions of a document (or the tfs, if they are stored with the
+    positions) are accessed.
+    """
+    def __init__(self, reader, pos_fp, tfs, length=None):
+        """
+        :param reader: the PostingsReader of the file
+        :param pos_fp: pointer of the positions entry, relative to the positions region
+        :param tfs: int64 array of term frequencies (number of positions of each document), None if they start the
+            positions entry (see postings_format.FLAG_TFS_WITH_POSITIONS)
+        :param length: the length of the postings list, if tfs is None
+        """
+        self.reader = reader
+        self.pos_fp = pos_fp
+        self.length = len(tfs) if tfs is not None else length
+        self.position_lists = None
+        self.__tfs = tfs
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        return self.__load()[idx]
+
+    @property
+    def tfs(self):
+        """
+        int64 array of term frequencies, read from the positions entry if they are stored there
+        """
+        if self.__tfs is None:
+            self.__tfs = np.diff(self.__load().offsets)
+        return self.__tfs
+
+    def encoded_size(self):
+        """
+        :return: the byte length of the positions entry, an upper bound on the number of integers it decodes to
+        """
+        return len(self.reader.entry(self.reader.positions_offset + self.pos_fp))
+
+    def __load(self):
+        if self.position_lists is None:
+            self.position_lists = self.reader.read_positions(self.pos_fp, self.__tfs, self.length)
+        return self.position_lists
+
+
+class PostingsReader(object):
+    """
+    Memory-maps a postings file and decodes entries in bulk into NumPy arrays. Readers opened through open() are shared
+    by path, so several search engines in one process share the same mapping (and page cache pages).
+    """
+    __shared = {}
+
+    def __init__(self, path, encoding_length=3):
+        """
+        :param path: the path of the postings file
+        :param encoding_length: integer encoding length of format version 1 files
+        """
+        self.path = path
+        self.encoding_length = encoding_length
+        self.refs = 1
+        with open(path, "rb") as f:
+            self.format_version, self.codec, self.flags, self.positions_offset = postings_format.read_header(f)
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else None
+        self.buffer = np.frombuffer(self.mmap, dtype=np.uint8) if self.mmap else np.zeros(0, dtype=np.uint8)
+        # entries end with an impact range and an impact byte per posting (see postings_format.quantize_impacts)
+        self.has_impacts = bool(self.flags & postings_format.FLAG_IMPACTS)
+        # the tfs are stored at the start of the positions entries, instead of after the docIDs
+        self.tfs_with_positions = bool(self.flags & postings_format.FLAG_TFS_WITH_POSITIONS)
+
+    @classmethod
+    def open(cls, path, encoding_length=3):
+        """
+        Returns the shared reader of a postings file, opening it if needed
+        :param path: the path of the postings file
+        :return: a PostingsReader, to be released with close()
+        """
+        key = os.path.realpath(path)
+        reader = cls.__shared.get(key)
+        if reader is None:
+            reader = cls(path, encoding_length)
+            cls.__shared[key] = reader
+        else:
+            reader.refs += 1
+        return reader
+
+    def entry(self, fp):
+        """
+        Returns the bytes of an entry (or of a positions entry, with fp offset by the positions region), as a zero-copy
+        view of the mapping
+        :param fp: file pointer of the entry
+        :return: uint8 array (without the entry length prefix)
+        """
+        if self.format_version == postings_format.VERSION_FIXED:
+            entry_len = int(fixed_decode_array(self.buffer[fp:fp + self.encoding_length], self.encoding_length)[0])
+            return self.buffer[fp + self.encoding_length:fp + entry_len * self.encoding_length]
+        start = fp + postings_format.ENTRY_LENGTH.size
+        entry_len, = postings_format.ENTRY_LENGTH.unpack(self.buffer[fp:start].tobytes())
+        return self.buffer[start:start + entry_len]
+
+    def read(self, fp, pos_fp=None):
+        """
+        Decodes the entry at a file pointer
+        :param fp: file pointer of the entry
+        :param pos_fp: pointer of the positions entry, relative to the positions region (format version 3)
+        :return: a tuple of (docIDs, tfs, positions), docIDs and tfs are int64 arrays and positions is a PositionLists,
+            or a LazyPositionLists if the positions are stored in their own region. tfs is None if they are stored with
+            the positions (files with impacts, see LazyPositionLists.tfs).
+        """
+        entry = self.entry(fp)
+        if self.has_impacts:
+            entry = entry[:len(entry) - self.__length(entry) - postings_format.IMPACT_RANGE.size]
+        if self.format_version >= postings_format.VERSION_SPLIT:
+            # [length of postings, docID gaps, tfs], without the tfs if they are stored with the positions
+            numbers = vbyte_decode_array(entry)
+            length = int(numbers[0])
+            doc_ids = np.cumsum(numbers[1:1 + length])
+            if self.tfs_with_positions:
+                return doc_ids, None, LazyPositionLists(self, pos_fp, None, length)
+            tfs = numbers[1 + length:1 + 2 * length]
+            return doc_ids, tfs, LazyPositionLists(self, pos_fp, tfs)
+        if self.format_version == postings_format.VERSION_FIXED:
+            # [term_id, length of postings, docIDs, tfs, length1, pos1_1, ..., length2, pos2_1, ...]
+            numbers = fixed_decode_array(entry, self.encoding_length)
+            length = int(numbers[1])
+            doc_ids = numbers[2:2 + length]
+            tfs = numbers[2 + length:2 + 2 * length]
+            rest = numbers[2 + 2 * length:]
+            # each position list is preceded by its length (which equals the tf), drop those slots
+            is_position = np.ones(len(rest), dtype=bool)
+            is_position[np.arange(length) + np.cumsum(tfs) - tfs] = False
+            positions = rest[is_position]
+        else:
+            # [length of postings, docID gaps, tfs, position gaps]
+            numbers = vbyte_decode_array(entry)
+            length = int(numbers[0])
+            doc_ids = np.cumsum(numbers[1:1 + length])
+            tfs = numbers[1 + length:1 + 2 * length]
+            positions = segmented_cumsum(numbers[1 + 2 * length:], tfs)
+        offsets = np.zeros(length + 1, dtype=np.int64)
+        np.cumsum(tfs, out=offsets[1:])
+        return doc_ids, tfs, PositionLists(positions, offsets)
+
+    def __length(self, entry):
+        """
+        :return: the length of the postings list of an entry, its first vbyte integer
+        """
+        ends = np.flatnonzero(entry[:10] < 0x80)
+        return int(vbyte_decode_array(entry[:ends[0] + 1])[0])
+
+    def read_impacts(self, fp):
+        """
+        Returns the dequantized impacts of an entry, in docID order (files with postings_format.FLAG_IMPACTS only),
+        see postings_format.dequantize_impact
+        :param fp: file pointer of the entry
+        :return: float64 array of document weights
+        """
+        entry = self.entry(fp)
+        start = len(entry) - self.__length(entry)
+        range_start = start - postings_format.IMPACT_RANGE.size
+        low, high = postings_format.IMPACT_RANGE.unpack(entry[range_start:start].tobytes())
+        impacts = entry[start:]
+        weights = np.exp(math.log(low) + (impacts - 1.0) * postings_format.impact_step(low, high))
+        # the largest impact is the exact largest weight, the MaxScore bound of the term
+        weights[impacts == postings_format.IMPACT_LEVELS] = high
+        return weights
+
+    def read_positions(self, pos_fp, tfs, length=None):
+        """
+        Decodes a positions entry stored in the positions region (format version 3)
+        :param pos_fp: pointer of the positions entry, relative to the positions region
+        :param tfs: int64 array of term frequencies of the postings list, None if they start the positions entry
+        :param length: the length of the postings list, if tfs is None
+        :return: a PositionLists
+        """
+        numbers = vbyte_decode_array(self.entry(self.positions_offset + pos_fp))
+        if tfs is None:
+            # [tfs, position gaps]
+            tfs, numbers = numbers[:length], numbers[length:]
+        positions = segmented_cumsum(numbers, tfs)
+        offsets = np.zeros(len(tfs) + 1, dtype=np.int64)
+        np.cumsum(tfs, out=offsets[1:])
+        return PositionLists(positions, offsets)
+
+    def close(self):
+        """
+        Releases this reader, the mapping is closed once every user has released it
+        :return: nothing
+        """
+        self.refs -= 1
+        if self.refs > 0:
+            return
+        key = os.path.realpath(self.path)
+        if PostingsReader.__shared.get(key) is self:
+            del PostingsReader.__shared[key]
+        self.buffer = None
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                # views handed out are still alive, the mapping is released when they are garbage collected
+                pass
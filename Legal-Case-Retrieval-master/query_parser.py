@@ -1,3 +1,5 @@
+import pickle
+from collections import OrderedDict
 import nltk
 nltk.data.path.append('./nltk_data')
 from nltk.corpus import wordnet as wn
@@ -5,27 +7,156 @@ from nltk.corpus import wordnet as wn
 from nltk.stem.porter import *
 from nltk.corpus import stopwords
 from query import Query
+import fast_tokenizer
+
+# suffix of the surface form -> stem map saved next to the dictionary file
+STEMS_SUFFIX = ".stems"
+
+
+class StemCache(object):
+    """
+    Bounded LRU cache of lower-cased surface form -> stem. A cache can be shared by several Parser instances, and saved
+    with the index so that query-side normalization reuses the stems computed while indexing.
+    """
+    def __init__(self, stem, max_size=2**20):
+        """
+        :param stem: the stemming function
+        :param max_size: maximum number of cached surface forms
+        """
+        self.stem_func = stem
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # surface forms stemmed since the last call to take_new
+        self.new = []
+
+    def __len__(self):
+        return len(self.cache)
+
+    def stem(self, token):
+        """
+        Stems a lower-cased token, through the cache
+        :param token: the token
+        :return: its stem
+        """
+        stem = self.cache.get(token)
+        if stem is not None:
+            self.hits += 1
+            self.cache.move_to_end(token)
+            return stem
+        self.misses += 1
+        stem = self.stem_func(token)
+        self.cache[token] = stem
+        self.new.append(token)
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        return stem
+
+    def update(self, stems):
+        """
+        Adds entries to the cache without counting hits or misses
+        :param stems: dict of surface form -> stem
+        :return: nothing
+        """
+        for token, stem in stems.items():
+            self.cache[token] = stem
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def take_new(self):
+        """
+        Returns the entries added since the last call (used to collect the stems computed by worker processes)
+        :return: dict of surface form -> stem
+        """
+        new = {token: self.cache[token] for token in self.new if token in self.cache}
+        self.new = []
+        return new
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def save(self, path):
+        """
+        Saves the surface form -> stem map to disk
+        :param path: the path to the save file
+        :return: nothing
+        """
+        with open(path, "wb") as f:
+            pickle.dump(dict(self.cache), f)
+
+    def load(self, path):
+        """
+        Loads a surface form -> stem map saved by save()
+        :param path: the path to the save file
+        :return: nothing
+        """
+        with open(path, "rb") as f:
+            self.update(pickle.load(f))
+        self.new = []
 
 
 class Parser(object):
-    def __init__(self):
+    def __init__(self, stem_cache=None, fast_tokenizer=False):
+        """
+        :param stem_cache: a StemCache to share with other parsers, by default each parser has its own
+        :param fast_tokenizer: tokenize with the single regular expression of fast_tokenizer instead of
+                               nltk.word_tokenize
+        """
         self.operators = ["NOT", "AND", "OR"]
         self.stemmer = PorterStemmer()
         self.stopWords = set(stopwords.words('english'))
+        self.stem_cache = stem_cache if stem_cache is not None else StemCache(self.stemmer.stem)
+        self.fast_tokenizer = fast_tokenizer
 
     def tokenize(self, document):
+        if self.fast_tokenizer:
+            return fast_tokenizer.tokenize(document)
         return nltk.word_tokenize(document)
 
+    def iter_tokens(self, document):
+        """
+        Tokenizes a document lazily: with the fast tokenizer, tokens are produced as they are consumed and the document
+        is never held as a list of tokens
+        :param document: the document
+        :return: iterator of tokens
+        """
+        if self.fast_tokenizer:
+            return fast_tokenizer.iter_tokens(document)
+        return iter(nltk.word_tokenize(document))
+
     def preprocess(self, tokens):
-        result = []
+        return list(self.iter_preprocess(tokens))
+
+    def iter_preprocess(self, tokens):
+        """
+        Preprocesses tokens lazily, e.g. the tokens of iter_tokens: terms are produced as they are consumed
+        :param tokens: iterable of tokens
+        :return: generator of terms
+        """
         for token in tokens:
             if token != "AND":
                 # if not token.isnumeric() and token not in self.stopWords:
                 #     # if token not in self.stopWords:
-                result.append(self.stemmer.stem(token.lower()))
+                yield self.stem_cache.stem(token.lower())
             else:
-                result.append(token)
-        return result
+                yield token
+
+    def preprocess_many(self, token_lists):
+        """
+        Preprocesses several token lists (e.g. documents or queries) in one batch, each distinct token is normalized
+        only once
+        :param token_lists: iterable of token lists (or arrays)
+        :return: list of lists of preprocessed tokens
+        """
+        token_lists = list(token_lists)
+        normalized = {}
+        for tokens in token_lists:
+            for token in tokens:
+                if token not in normalized:
+                    normalized[token] = token if token == "AND" else self.stem_cache.stem(token.lower())
+        return [[normalized[token] for token in tokens] for tokens in token_lists]
 
     def parse_query(self, query):
         processed_tokens = self.preprocess(self.tokenize(query))
@@ -0,0 +1,191 @@
+import os
+import json
+import time
+from collections import OrderedDict
+
+# Stages of a query, as recorded by SearchEngine:
+#   parse: Parser.parse_query (tokenizing and stemming)
+#   expand: query expansion (synonym tables or WordNet)
+#   postings: postings list lookups (cache, memory-mapped reads and decoding, document weights)
+#   boolean_match: postings and positional intersection of conjunctive Boolean queries
+#   score: cosine score accumulation and MaxScore top k traversal
+#   proximity: proximity scores (positions are decoded lazily, so positions reads are counted here)
+#   sort: final ranking
+STAGES = ("parse", "expand", "postings", "boolean_match", "score", "proximity", "sort")
+
+
+class NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class NullTrace(object):
+    """
+    Trace used while tracing is off, every call is a no-op
+    """
+    enabled = False
+    __stage = NullStage()
+
+    def stage(self, name):
+        return self.__stage
+
+    def count(self, name, **counters):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class Stage(object):
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.trace.enter(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.trace.exit()
+        return False
+
+
+class QueryTrace(object):
+    """
+    Wall time, number of calls and counters of each stage of one query. Stage times are exclusive: the time spent in a
+    stage entered from another one (e.g. postings reads while scoring) is only counted in the inner stage.
+    """
+    enabled = True
+
+    def __init__(self, query, kind="query", **fields):
+        """
+        :param query: the query string (None for work shared by a batch of queries)
+        :param kind: "query", or "batch" for the postings reads shared by a query batch
+        :param fields: other fields of the record
+        """
+        self.query = query
+        self.kind = kind
+        self.fields = fields
+        self.stages = OrderedDict()
+        # stack of [stage name, time it was entered or resumed]
+        self.stack = []
+        # the trace only runs while its query is being worked on (queries of a batch are interleaved)
+        self.elapsed = 0.0
+        self.resumed = None
+
+    def resume(self):
+        self.resumed = time.perf_counter()
+        if self.stack:
+            self.stack[-1][1] = self.resumed
+
+    def pause(self):
+        if self.resumed is None:
+            return
+        now = time.perf_counter()
+        self.elapsed += now - self.resumed
+        self.resumed = None
+        if self.stack:
+            self.__get(self.stack[-1][0])["ms"] += (now - self.stack[-1][1]) * 1000
+
+    def stage(self, name):
+        """
+        :return: a context manager timing a stage
+        """
+        return Stage(self, name)
+
+    def __get(self, name):
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = OrderedDict([("ms", 0.0), ("calls", 0)])
+        return stats
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            # pause the enclosing stage
+            self.__get(self.stack[-1][0])["ms"] += (now - self.stack[-1][1]) * 1000
+        self.__get(name)["calls"] += 1
+        self.stack.append([name, now])
+
+    def exit(self):
+        now = time.perf_counter()
+        name, resumed = self.stack.pop()
+        self.__get(name)["ms"] += (now - resumed) * 1000
+        if self.stack:
+            self.stack[-1][1] = now
+
+    def count(self, name, **counters):
+        """
+        Adds to counters of a stage
+        :param name: the stage
+        :param counters: counter names and increments
+        :return: nothing
+        """
+        stats = self.__get(name)
+        for counter, value in counters.items():
+            stats[counter] = stats.get(counter, 0) + value
+
+    def finish(self, **fields):
+        """
+        Stops the clock
+        :param fields: other fields of the record (e.g. number of results)
+        :return: nothing
+        """
+        self.pause()
+        self.fields.update(fields)
+
+    def total_ms(self):
+        running = time.perf_counter() - self.resumed if self.resumed is not None else 0
+        return (self.elapsed + running) * 1000
+
+    def to_dict(self):
+        """
+        :return: the trace as a JSON-serializable dict
+        """
+        record = OrderedDict([("type", self.kind), ("query", self.query), ("total_ms", self.total_ms())])
+        record.update(self.fields)
+        record["stages"] = self.stages
+        return record
+
+
+class TraceWriter(object):
+    """
+    Trace hook appending traces to a JSON-lines file. Each record is written with a single append, so processes
+    sharing the file (e.g. the workers of search.run_batch, which get a pickled copy) do not interleave records.
+    """
+    def __init__(self, path, min_ms=0, truncate=True):
+        """
+        :param path: the trace file
+        :param min_ms: only queries taking at least this long are written (batch records are always written)
+        :param truncate: empty the file first
+        """
+        self.path = path
+        self.min_ms = min_ms
+        self.fd = None
+        if truncate:
+            open(path, "w").close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["fd"] = None
+        return state
+
+    def __call__(self, trace):
+        """
+        :param trace: a QueryTrace
+        :return: nothing
+        """
+        record = trace.to_dict()
+        if record["type"] == "query" and record["total_ms"] < self.min_ms:
+            return
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self.fd, (json.dumps(record) + "\n").encode("utf-8"))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
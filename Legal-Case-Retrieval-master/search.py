@@ -3,17 +3,34 @@ import math
 import heapq
 import sys
 import getopt
-import pickle
 import os
 import bisect
+import multiprocessing
+import numpy as np
 import nltk
 nltk.data.path.append('./nltk_data')
 from nltk.corpus import wordnet as wn
-from query_parser import Parser
+from dictionary import load_dictionary
+from postings_cache import PostingsCache
+from postings_reader import PostingsReader, PositionLists
+from query_parser import Parser, STEMS_SUFFIX
+from query_trace import NULL_TRACE, QueryTrace, TraceWriter
+from biwords import phrase_biwords
+
+
+# number of queries evaluated together by the CLI (see SearchEngine.query_batch)
+BATCH_SIZE = 32
+# relative slack on score upper bounds, so rounding differences never prune a document that could make the top k
+BOUND_SLACK = 1e-9
 
 
 def usage():
-    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results")
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results "
+                                    "[-k top-k] [-r rerank-depth] [-m pairwise|window] [-b] [-c cache-MB] "
+                                    "[-e lru|slru] [-n pinned-terms] [-w workers] [-t trace-file] [-s slow-query-ms] "
+                                    "[-a]")
+    print("       " + sys.argv[0] + " -x segmented-or-sharded-index-directory -q file-of-queries "
+                                    "-o output-file-of-results [options except -w]")
 
 
 class Postings(object):
@@ -22,19 +39,128 @@ class Postings(object):
         self.skip_intv = skip_intv
         self.skip_ptrs = skip_ptrs
 
+    @classmethod
+    def with_skips(cls, postings):
+        """
+        Builds a postings list with evenly spaced skip pointers (sqrt(n) apart)
+        :param postings: ascending list of document ordinals
+        :return: a Postings object
+        """
+        skip_intv = int(math.sqrt(len(postings)))
+        if skip_intv < 2:
+            return cls(postings, 0, [])
+        # the skip pointer at index i * skip_intv jumps to index skip_ptrs[i]
+        skip_ptrs = list(range(skip_intv, len(postings), skip_intv))
+        return cls(postings, skip_intv, skip_ptrs)
+
+    def skip(self, idx):
+        """
+        Returns the target of the skip pointer at an index
+        :param idx: index in the postings list
+        :return: the index the skip pointer jumps to, or None if there is no skip pointer at idx
+        """
+        if self.skip_intv and idx % self.skip_intv == 0 and idx // self.skip_intv < len(self.skip_ptrs):
+            return self.skip_ptrs[idx // self.skip_intv]
+        return None
+
+    def intersect(self, other):
+        """
+        Intersects two postings lists, following skip pointers whenever they do not overshoot
+        :param other: a Postings object
+        :return: the intersection, as a Postings object with its own skip pointers
+        """
+        answer = []
+        p1, p2 = self.postings, other.postings
+        i = j = 0
+        while i < len(p1) and j < len(p2):
+            if p1[i] == p2[j]:
+                answer.append(p1[i])
+                i += 1
+                j += 1
+            elif p1[i] < p2[j]:
+                target = self.skip(i)
+                if target is not None and p1[target] <= p2[j]:
+                    while target is not None and p1[target] <= p2[j]:
+                        i = target
+                        target = self.skip(i)
+                else:
+                    i += 1
+            else:
+                target = other.skip(j)
+                if target is not None and p2[target] <= p1[i]:
+                    while target is not None and p2[target] <= p1[i]:
+                        j = target
+                        target = other.skip(j)
+                else:
+                    j += 1
+        return Postings.with_skips(answer)
+
 
 class SearchEngine(object):
-    def __init__(self, dict_file, post_file, encoding_length=3):
+    def __init__(self, dict_file, post_file, encoding_length=3, rerank_depth=None, proximity="pairwise",
+                 cache_bytes=64 * 2**20, cache_policy="lru", pinned_terms=0, deleted_doc_ids=None,
+                 collection_stats=None, trace_hook=None, fast_tokenizer=False):
+        """
+        :param dict_file: the dictionary file
+        :param post_file: the postings file
+        :param rerank_depth: if given, proximity scores are only computed for this many top documents of the cosine
+            ranking (two-stage ranking), otherwise for every document matching several query terms
+        :param proximity: proximity scoring method, "pairwise" (minimum distance of every pair of matched terms) or
+            "window" (smallest window containing all matched terms, single pass)
+        :param cache_bytes: memory budget of the decoded postings cache, 0 disables the cache
+        :param cache_policy: eviction policy of the cache, "lru" or "slru" (frequency-aware, see PostingsCache)
+        :param pinned_terms: number of highest document frequency terms loaded in the cache at startup and never evicted
+        :param deleted_doc_ids: docIDs of deleted documents (tombstones), dropped from every postings list
+        :param collection_stats: if given, document frequencies, number of documents, vocabulary and synonyms are taken
+            from this object instead of this index (see segments.CollectionStats), so that the scores of several indexes
+            over parts of a collection are those of a single index over the whole collection
+        :param trace_hook: if given, called with a query_trace.QueryTrace (per-stage wall time, bytes read, postings
+            decoded and candidates scored) after each query, and for the postings reads shared by each query batch
+        :param fast_tokenizer: tokenize queries with fast_tokenizer instead of nltk.word_tokenize (see Parser)
+        """
+        if proximity not in ("pairwise", "window"):
+            raise ValueError("unknown proximity method: {}".format(proximity))
+        self.rerank_depth = rerank_depth
+        self.proximity = proximity
+        self.dict_file = dict_file
+        self.trace_hook = trace_hook
+        # trace of the query being evaluated, a no-op one when not tracing
+        self.__trace = NULL_TRACE
         self.dictionary = self.__load(dict_file)
-        self.postings_file = open(post_file, "rb")
-        self.parser = Parser()
+        # memory-mapped postings, shared with other engines using the same file
+        self.postings_reader = PostingsReader.open(post_file, encoding_length)
+        self.parser = Parser(fast_tokenizer=fast_tokenizer)
+        if os.path.exists(dict_file + STEMS_SUFFIX):
+            # reuse the stems computed at indexing time
+            self.parser.stem_cache.load(dict_file + STEMS_SUFFIX)
         self.encoding_length = encoding_length
+        # docIDs in ascending order and their vector norms, for vectorized weighting of postings
+        self.doc_id_array, self.doc_norms = self.dictionary.get_doc_arrays()
+        # per-document score accumulator and hit counter, reused (and reset) by every query
+        self.__score_buffer = np.zeros(len(self.doc_id_array))
+        self.__hit_buffer = np.zeros(len(self.doc_id_array), dtype=np.int64)
+        self.collection_stats = collection_stats
+        # per-ordinal liveness, None when no document is deleted
+        self.alive = None
+        self.n_deleted = 0
+        if deleted_doc_ids:
+            deleted = np.isin(self.doc_id_array, np.array(sorted(deleted_doc_ids), dtype=np.int64))
+            self.alive = ~deleted
+            self.n_deleted = int(deleted.sum())
+        # decoded postings lists of the query batch being evaluated, see query_batch
+        self.__batch_postings = {}
+        # decoded postings lists in ascending ordinal order, see __get_ordinals
+        self.postings_cache = PostingsCache(cache_bytes, cache_policy) if cache_bytes else None
+        if self.postings_cache is not None:
+            for token in self.dictionary.top_df_terms(pinned_terms):
+                if not self.postings_cache.pin(token, self.__read_ordinals(token)):
+                    break
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.postings_file.close()
+        self.close()
 
     def __load(self, dict_file):
         """
@@ -42,77 +168,53 @@ class SearchEngine(object):
         :param dict_file: the file containing the dictionary
         :return: the dictionary object
         """
-        with open(dict_file, "rb") as f:
-            dictionary = pickle.load(f)
-        return dictionary
+        return load_dictionary(dict_file)
 
     def __get_synonyms(self, token):
+        # use the synonym table precomputed by the indexer if there is one. It covers the vocabulary, other terms
+        # without an entry (e.g. inflected forms WordNet resolves with morphy, "criteria") are looked up in WordNet
+        synonyms = self.dictionary.get_synonyms(token)
+        if synonyms or (synonyms is not None and token in self.dictionary):
+            return set(synonyms)
         result = set()
         for synset in wn.synsets(token):
             name = self.parser.preprocess([synset.name().split(".")[0]])[0]
-            if name in self.dictionary.stoi:
+            if name in self.dictionary:
                 result.add(name)
         # if len(result) > 5:
         #     result_list = [word for word, sim in self.parser.top_k_similarity(token, list(result), 5)]
         #     result = set(result_list)
         return result
 
+    def get_synonyms(self, token):
+        """
+        Looks up the in-vocabulary synonyms of a term in this index
+        :param token: the term
+        :return: set of terms
+        """
+        return self.__get_synonyms(token)
+
     def __expand_query(self, query):
         synonyms = set()
-        for token in query:
-            synonyms = synonyms.union(set(self.__get_synonyms(token)))
+        with self.__trace.stage("expand"):
+            for token in query:
+                if self.collection_stats is not None:
+                    synonyms = synonyms.union(self.collection_stats.get_synonyms(token))
+                else:
+                    synonyms = synonyms.union(set(self.__get_synonyms(token)))
         return query + list(synonyms)
 
-    def __parse_byte_repr(self, byte_repr, to_int):
-        """
-        Parses byte representation of a postings list, ordered as:
-            [termID, length of postings (integer count)
-            postings: docID1, docID2, ..., tf1, tf2 ...,
-            positions: length1, pos1_1, pos1_2, ..., length2, pos2_1, ...]
-        :param byte_repr: byte representation to parse
-        :param to_int: the function used to convert byte to integer
-        :return: a Postings object
-        """
-        # read length of postings
-        postings_length = to_int(byte_repr[self.encoding_length:self.encoding_length*2])
-        # read postings
-        postings = []
-        idx = self.encoding_length*2
-        for i in range(postings_length):
-            postings.append(to_int(byte_repr[idx:idx+self.encoding_length]))
-            idx += self.encoding_length
-        # read tf values
-        tfs = []
-        for i in range(postings_length):
-            tfs.append(to_int(byte_repr[idx:idx+self.encoding_length]))
-            idx += self.encoding_length
-        # read positions
-        positions = [[] for _ in range(postings_length)]
-        for i in range(postings_length):
-            pos_length = to_int(byte_repr[idx:idx + self.encoding_length])
-            idx += self.encoding_length
-            for _ in range(pos_length):
-                positions[i].append(to_int(byte_repr[idx:idx + self.encoding_length]))
-                idx += self.encoding_length
-        return postings, tfs, positions
-
     def __get_postings(self, token):
         """
-        Looks up a postings list in file.
+        Looks up a postings list in the memory-mapped postings file.
         :param token: the token to loop up
-        :return: a tuple of (termID, term frequency, postings)
+        :return: a tuple of (postings, term frequencies, positions), postings and term frequencies are NumPy arrays and
+            positions[i] is the array of positions in the i-th document (positions stored in their own region are only
+            read when first accessed)
         """
-        def to_int(x): return int.from_bytes(x, byteorder="little")
         fp = self.dictionary[token]
         if fp is not None:
-            # if token exists in dictionary
-            self.postings_file.seek(fp)
-            # read length of entry
-            entry_len = to_int(self.postings_file.read(self.encoding_length))
-            remain_entry = self.postings_file.read((entry_len - 1)*self.encoding_length)
-            # read postings
-            postings, tfs, positions = self.__parse_byte_repr(remain_entry, to_int)
-            return postings, tfs, positions
+            return self.postings_reader.read(fp, self.dictionary.get_position_pointer(token))
         else:
             return None
 
@@ -125,8 +227,9 @@ class SearchEngine(object):
         """
         token_dict = {}
         tfs = []
+        vocabulary = self.collection_stats if self.collection_stats is not None else self
         for token in tokens:
-            if token not in self.dictionary.stoi:
+            if token not in vocabulary:
                 continue
             if token not in token_dict:
                 token_dict[token] = 1
@@ -143,146 +246,818 @@ class SearchEngine(object):
         :param token: the term to look up
         :return: the inverse document frequency
         """
-        df = self.dictionary.dfs.get(token, 0)
+        stats = self.collection_stats if self.collection_stats is not None else self
+        df = stats.get_df(token)
         if df == 0:
             return 0
         else:
-            return math.log(len(self.dictionary.doc_ids)/df, 10)
+            return math.log(stats.num_docs()/df, 10)
+
+    def __contains__(self, token):
+        """
+        :return: whether a term occurs in a document of this index that is not deleted
+        """
+        return token in self.dictionary and (self.alive is None or self.get_df(token) > 0)
+
+    def get_df(self, token):
+        """
+        Document frequency of a term in this index, deleted documents excluded
+        :param token: the term to look up
+        :return: document frequency
+        """
+        if self.alive is None or token not in self.dictionary:
+            return self.dictionary.get_df(token)
+        return len(self.__get_ordinals(token)[0])
+
+    def num_docs(self):
+        """
+        :return: number of documents in this index, deleted documents excluded
+        """
+        return self.dictionary.num_docs() - self.n_deleted
 
-    # algorithm from https://stackoverflow.com/questions/24989772/finding-closest-numbers-within-two-arrays
     def __min_dist(self, l1, l2):
-        i = 0
-        j = 0
-        min_val = abs(l1[0] - l2[0])
-        while i < len(l1) and j < len(l2):
-            min_val = min(min_val, abs(l1[i] - l2[j]))
-            if i+1 == len(l1) or j+1 == len(l2):
-                break
-            if abs(l1[i+1] - l2[j]) < abs(l1[i] - l2[j+1]):
-                i += 1
+        """
+        Minimum distance between any element of l1 and any element of l2
+        :param l1: sorted array of positions
+        :param l2: sorted array of positions
+        :return: the minimum distance
+        """
+        # the closest element of l2 to each element of l1 is one of its two neighbours in l2
+        idx = np.searchsorted(l2, l1)
+        left = np.abs(l1 - l2[np.maximum(idx - 1, 0)])
+        right = np.abs(l1 - l2[np.minimum(idx, len(l2) - 1)])
+        return int(min(left.min(), right.min()))
+
+    def __min_window(self, pos):
+        """
+        Length of the smallest window containing an occurrence of every term, in a single pass over the merged
+        position lists
+        :param pos: list of sorted position arrays, one per term
+        :return: distance between the first and the last position of the window
+        """
+        lists = [p.tolist() for p in pos]
+        heap = [(positions[0], term, 0) for term, positions in enumerate(lists)]
+        heapq.heapify(heap)
+        high = max(positions[0] for positions in lists)
+        best = high - heap[0][0]
+        while True:
+            low, term, idx = heap[0]
+            best = min(best, high - low)
+            if idx + 1 == len(lists[term]):
+                return best
+            nxt = lists[term][idx + 1]
+            high = max(high, nxt)
+            heapq.heapreplace(heap, (nxt, term, idx + 1))
+
+    def __proximity(self, pos, n_terms):
+        """
+        Proximity score of a document. The pairwise method sums 1 / (minimum distance) over every pair of matched terms,
+        the window method scores the number of matched pairs by the density of the smallest window containing all
+        matched terms (1 when they are adjacent). Both are normalized by the number of term pairs in the query.
+        :param pos: position arrays of the matched query terms (at least two), in query term order
+        :param n_terms: number of terms in the query
+        :return: the proximity score
+        """
+        n_hit = len(pos)
+        with self.__trace.stage("proximity"):
+            if self.proximity == "window":
+                return (n_hit * (n_hit - 1) / 2) / (n_terms * (n_terms - 1) / 2) * (n_hit - 1) / self.__min_window(pos)
+            min_dist = [1 / self.__min_dist(pos[i], pos[j]) for i in range(n_hit-1) for j in range(i+1, n_hit)]
+            return sum(min_dist) / (n_terms * (n_terms - 1) / 2)
+
+    def __load_terms(self, query_tokens, query_tfidfs, candidates=None):
+        """
+        Fetches and weights the postings lists of the query terms
+        :param query_tokens: the terms in the query
+        :param query_tfidfs: corresponding term tfidfs (in the same order with query_tokens)
+        :param candidates: if given, ascending array of the only document ordinals to keep
+        :return: a list of (ordinals, weights, positions, order) per term: ordinals are the ascending document ordinals
+            (positions in doc_id_array) of the postings, weights the matching document weights times the query weight,
+            and positions[order[i]] are the positions of the term in document ordinals[i]
+        """
+        terms = []
+        for query_idx, token in enumerate(query_tokens):
+            ordinals, _, positions, order, doc_weights = self.__get_ordinals(token)
+            if candidates is not None:
+                keep = np.isin(ordinals, candidates)
+                ordinals, order, doc_weights = ordinals[keep], order[keep], doc_weights[keep]
+            weights = doc_weights * query_tfidfs[query_idx]
+            terms.append((ordinals, weights, positions, order))
+        return terms
+
+    def __get_ordinals(self, token):
+        """
+        Looks up a postings list, in ascending document ordinal order, through the postings cache
+        :param token: the token to look up
+        :return: a tuple of (ordinals, tfs, positions, order, doc_weights), positions[order[i]] are the positions of
+            the term in document ordinals[i] and doc_weights[i] is its document weight (1 + log10(tf)) / doc_len, or
+            its dequantized impact if the postings store impacts. tfs is None if the postings store them with the
+            positions (see PostingsReader.read). The arrays may be shared with the cache and must not be modified.
+        """
+        with self.__trace.stage("postings"):
+            entry = self.__batch_postings.get(token)
+            if entry is not None:
+                self.__trace.count("postings", batch_hits=1)
+                return entry
+            if self.postings_cache is None:
+                return self.__read_ordinals(token)
+            entry = self.postings_cache.get(token)
+            if entry is None:
+                self.__trace.count("postings", cache_misses=1)
+                entry = self.__read_ordinals(token)
+                self.postings_cache.put(token, entry)
             else:
-                j += 1
-        if i == len(l1) -1:
-            while j < len(l2):
-                min_val = min(min_val, abs(l1[i] - l2[j]))
-                j += 1
+                self.__trace.count("postings", cache_hits=1)
+            return entry
+
+    def __read_ordinals(self, token):
+        """
+        Reads and decodes a postings list, see __get_ordinals
+        """
+        postings = self.__get_postings(token)
+        if postings is None:
+            # a term of the collection that does not occur in this index (see collection_stats)
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, PositionLists(empty, np.zeros(1, dtype=np.int64)), empty, np.zeros(0)
+        postings, tfs, positions = postings
+        if self.__trace.enabled:
+            self.__trace.count("postings", bytes_read=len(self.postings_reader.entry(self.dictionary[token])),
+                               postings_decoded=len(postings))
+        ordinals = np.searchsorted(self.doc_id_array, postings)
+        order = np.argsort(ordinals, kind="stable")
+        if self.alive is not None:
+            order = order[self.alive[ordinals[order]]]
+        ordinals = ordinals[order]
+        if tfs is not None:
+            tfs = tfs[order]
+        if self.postings_reader.has_impacts:
+            # impacts are in docID order, like the postings
+            doc_weights = self.postings_reader.read_impacts(self.dictionary[token])[order]
         else:
-            while i < len(l1):
-                min_val = min(min_val, abs(l1[i] - l2[j]))
-                i += 1
-        return min_val
+            doc_weights = (1 + np.log10(tfs)) / self.doc_norms[ordinals]
+        entry = (ordinals, tfs, positions, order, doc_weights)
+        for array in (ordinals, tfs, order, doc_weights):
+            if array is not None:
+                array.flags.writeable = False
+        return entry
+
+    def cache_stats(self):
+        """
+        :return: dict of postings cache statistics (hits, misses, hit_rate, evictions, entries, pinned, bytes,
+            max_bytes), or None if the cache is disabled
+        """
+        return self.postings_cache.stats() if self.postings_cache is not None else None
 
-    def __search_similarity(self, query_tokens, query_tfidfs, alpha=0.8):
+    def __match_phrase(self, tokens):
+        """
+        Finds the documents containing a phrase: skip pointer intersection of the postings lists (rarest term first),
+        then positional intersection. If the index has the biwords of every adjacent pair of the phrase (see biwords),
+        they are matched instead of its terms: a two-term phrase is then a single postings list.
+        :param tokens: the terms of the phrase (or a single term)
+        :return: a Postings object of the matching document ordinals
+        """
+        if len(tokens) > 1:
+            pairs = phrase_biwords(tokens)
+            if all(pair in self.dictionary for pair in pairs):
+                self.__trace.count("boolean_match", biword_phrases=1)
+                tokens = pairs
+        if any(token not in self.dictionary for token in tokens):
+            return Postings.with_skips([])
+        lists = {token: self.__get_ordinals(token) for token in set(tokens)}
+        rarest_first = sorted(lists.keys(), key=lambda token: len(lists[token][0]))
+        result = Postings.with_skips(lists[rarest_first[0]][0].tolist())
+        for token in rarest_first[1:]:
+            if not result.postings:
+                break
+            result = result.intersect(Postings.with_skips(lists[token][0].tolist()))
+        if len(tokens) < 2 or not result.postings:
+            return result
+        # positional intersection: keep documents where tokens[i] occurs at offset i from an occurrence of tokens[0]
+        # (biwords are at the position of their first term)
+        matches = []
+        for ordinal in result.postings:
+            starts = None
+            for offset, token in enumerate(tokens):
+                ordinals, _, positions, order, _ = lists[token]
+                pos = positions[int(order[np.searchsorted(ordinals, ordinal)])]
+                starts = pos if starts is None else starts[np.isin(starts + offset, pos)]
+                if not len(starts):
+                    break
+            if len(starts):
+                matches.append(ordinal)
+        return Postings.with_skips(matches)
+
+    def __match_boolean(self, clauses):
+        """
+        Conjunctive evaluation of a Boolean query, clauses are intersected rarest first
+        :param clauses: list of clauses, each a list of terms (a phrase or a single term)
+        :return: ascending array of the ordinals of the documents matching every clause
+        """
+        with self.__trace.stage("boolean_match"):
+            matches = sorted((self.__match_phrase(clause) for clause in clauses), key=lambda p: len(p.postings))
+            result = matches[0]
+            for postings in matches[1:]:
+                if not result.postings:
+                    break
+                result = result.intersect(postings)
+            return np.array(result.postings, dtype=np.int64)
+
+    def __rerank_components(self, terms, ordinals, n_terms):
+        """
+        Cosine similarities and proximity scores of candidate documents
+        :param terms: the query terms, see __load_terms
+        :param ordinals: int array of candidate document ordinals
+        :param n_terms: number of terms in the query
+        :return: a tuple of (similarities, proximity scores, whether each document matches several terms), proximity
+            scores are 0 for documents matching a single term
+        """
+        with self.__trace.stage("proximity"):
+            similarity = np.zeros(len(ordinals))
+            proximity = np.zeros(len(ordinals))
+            n_hits = np.zeros(len(ordinals), dtype=np.int64)
+            refs = [[] for _ in range(len(ordinals))]
+            # accumulate in query term order, so scores are identical whichever way candidates were generated
+            for term_ordinals, weights, positions, order in terms:
+                if not len(term_ordinals):
+                    continue
+                idx = np.minimum(np.searchsorted(term_ordinals, ordinals), len(term_ordinals) - 1)
+                found = term_ordinals[idx] == ordinals
+                similarity[found] += weights[idx[found]]
+                n_hits += found
+                for candidate in np.flatnonzero(found).tolist():
+                    refs[candidate].append((positions, int(order[idx[candidate]])))
+            is_multi_hit = n_hits > 1
+            for candidate in np.flatnonzero(is_multi_hit).tolist():
+                # positions are only fetched here
+                pos = [positions[doc_idx] for positions, doc_idx in refs[candidate]]
+                proximity[candidate] = self.__proximity(pos, n_terms)
+            return similarity, proximity, is_multi_hit
+
+    def __rerank(self, terms, ordinals, n_terms, alpha):
+        """
+        Second stage: final scores of candidate documents, with proximity scores for those matching several terms
+        :param terms: the query terms, see __load_terms
+        :param ordinals: int array of candidate document ordinals
+        :param n_terms: number of terms in the query
+        :return: array of final scores
+        """
+        similarity, proximity, is_multi_hit = self.__rerank_components(terms, ordinals, n_terms)
+        final = similarity.copy()
+        final[is_multi_hit] = -(alpha * -similarity[is_multi_hit] - (1 - alpha) * proximity[is_multi_hit])
+        return final
+
+    def __search_similarity(self, query_tokens, query_tfidfs, alpha=0.8, candidates=None):
         """
         Search similar documents for query.
+        Scores are accumulated in reusable buffers indexed by document ordinal, only the entries of documents that
+        appear in the postings are touched (and reset afterwards), so the cost depends on the postings, not on the size
+        of the collection.
+        Documents matching several terms are then reranked with their proximity score: all of them, or if rerank_depth
+        is set only the top rerank_depth documents of the cosine ranking, which are ranked ahead of the others.
         :param query_tokens: the terms in the query
         :param query_tfidfs: corresponding term tfidfs (in the same order with query_tokens)
+        :param candidates: if given, ascending array of the only document ordinals to score
         :return: a list of document ids, ranked by similarity
         """
-        heap = [(0, doc_id) for doc_id in self.dictionary.doc_ids]
-        position = [[] for _ in self.dictionary.doc_ids]
-        for query_idx, token in enumerate(query_tokens):
-            # get postings
-            postings, tfs, positions = self.__get_postings(token)
-            for doc_idx, doc_id in enumerate(postings):
-                position[self.dictionary.doc_order[doc_id]].append(positions[doc_idx])
-                similarity, doc_id = heap[self.dictionary.doc_order[doc_id]]
-                similarity -= (1 + math.log(tfs[doc_idx], 10))/self.dictionary.doc_len[doc_id] * query_tfidfs[query_idx]
-                heap[self.dictionary.doc_order[doc_id]] = (similarity, doc_id)
-        # calculate proximity score for each document
-        for doc_order, pos in enumerate(position):
-            n_hit = len(pos)
-            if n_hit > 1:
-                min_dist = [1 / self.__min_dist(pos[i], pos[j]) for i in range(n_hit-1) for j in range(i+1, n_hit)]
-                score = sum(min_dist) / (len(query_tokens) * (len(query_tokens)-1) / 2)
-                similarity, doc_id = heap[doc_order]
-                heap[doc_order] = (alpha * similarity - (1 - alpha) * score, doc_id)
-                # print("similarity: {} , proximity: {}".format(-alpha * similarity, (1 - alpha) * score))
-        # sort the scores using a heap
-        heapq.heapify(heap)
-        answer = []
-        score_output = []
-        while heap:
-            score, doc_id = heapq.heappop(heap)
-            if score < 0:
-                answer.append(doc_id)
-                score_output.append(-score)
+        with self.__trace.stage("score"):
+            scores = self.__score_buffer
+            hit_counts = self.__hit_buffer
+            terms = self.__load_terms(query_tokens, query_tfidfs, candidates)
+            for ordinals, weights, _, _ in terms:
+                scores[ordinals] += weights
+                hit_counts[ordinals] += 1
+            if not terms:
+                return [], []
+            touched = np.unique(np.concatenate([term[0] for term in terms]))
+            self.__trace.count("score", candidates_scored=len(touched))
+            similarity = scores[touched]
+            is_multi_hit = hit_counts[touched] > 1
+            scores[touched] = 0
+            hit_counts[touched] = 0
+
+            # first stage: cosine similarity (weighted by alpha for documents that will get a proximity score)
+            final = similarity.copy()
+            final[is_multi_hit] = -(alpha * -similarity[is_multi_hit])
+            doc_ids = self.doc_id_array[touched]
+            if self.rerank_depth is None:
+                rerank = np.flatnonzero(is_multi_hit)
+            else:
+                # every candidate goes through the first stage: a document matching several terms can still get a
+                # positive final score from its proximity score
+                first_stage = np.lexsort((doc_ids, -final))
+                head = first_stage[:self.rerank_depth]
+                rerank = head[is_multi_hit[head]]
+        # second stage: proximity
+        if len(rerank):
+            final[rerank] = self.__rerank(terms, touched[rerank], len(query_tokens), alpha)
+
+        # rank by score, ties broken by docID
+        with self.__trace.stage("sort"):
+            if self.rerank_depth is None:
+                order = np.lexsort((doc_ids, -final))
+                order = order[final[order] > 0]
             else:
+                head = head[np.lexsort((doc_ids[head], -final[head]))]
+                tail = first_stage[len(head):]
+                # documents beyond the rerank depth matching several terms are kept, they were not given a proximity
+                # score
+                order = np.concatenate([head[final[head] > 0], tail[(final[tail] > 0) | is_multi_hit[tail]]])
+            return doc_ids[order].tolist(), final[order].tolist()
+
+    def __proximity_bound(self, n_hit, n_terms):
+        """
+        Upper bound of the proximity score of a document containing n_hit of the n_terms query terms (every pair of
+        matched terms contributes at most 1)
+        """
+        if n_hit < 2:
+            return 0
+        return (n_hit * (n_hit - 1) / 2) / (n_terms * (n_terms - 1) / 2)
+
+    def __score_bound(self, cos_bound, n_hit_min, n_hit_max, n_terms, alpha, with_proximity=True):
+        """
+        Upper bound of the final score of a document, see __search_similarity for how scores are combined
+        :param cos_bound: upper bound of the cosine similarity
+        :param n_hit_min: number of query terms known to be in the document
+        :param n_hit_max: maximum number of query terms the document can contain
+        :param with_proximity: whether the score includes the proximity score
+        :return: the upper bound
+        """
+        bound = 0
+        if n_hit_min <= 1:
+            # single matched term: the cosine similarity is used as is
+            bound = cos_bound
+        if n_hit_max >= 2:
+            proximity_bound = self.__proximity_bound(n_hit_max, n_terms) if with_proximity else 0
+            bound = max(bound, alpha * cos_bound + (1 - alpha) * proximity_bound)
+        return bound * (1 + BOUND_SLACK)
+
+    def __max_score(self, terms, n_terms, top_k, alpha, with_proximity=True):
+        """
+        Top k retrieval with MaxScore pruning, vectorized.
+        Any document of the postings list with the highest score upper bound (max document weight in the dictionary
+        times the query weight) scores at least min(alpha, 1) times its weight in that list, so the k-th largest of
+        those is a lower bound of the k-th score. Query terms whose combined bound is below it are non-essential:
+        candidates are the documents of the essential terms, and non-essential terms are only probed (by binary search)
+        for those. Proximity scores are then computed by chunks of candidates, by decreasing score upper bound, until no
+        remaining candidate can reach the current k-th score.
+        :param terms: the query terms, see __load_terms, with their score upper bound appended
+        :param n_terms: number of terms in the query
+        :param top_k: number of documents to return
+        :param with_proximity: whether to score proximity (otherwise documents matching several terms get the first
+            stage score of __search_similarity, and are kept even if it is not positive)
+        :return: a tuple of (array of document ordinals, array of scores), ranked by score then docID
+        """
+        if not terms:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        # terms by increasing bound
+        by_bound = sorted(range(len(terms)), key=lambda query_idx: terms[query_idx][4])
+        top_weights = terms[by_bound[-1]][1]
+        threshold = 0
+        if len(top_weights) >= top_k:
+            threshold = min(alpha, 1) * np.partition(top_weights, len(top_weights) - top_k)[len(top_weights) - top_k]
+        # documents only in the non-essential terms by_bound[:n_non_essential] cannot make the top k
+        n_non_essential = 0
+        remaining = 0
+        while n_non_essential < len(by_bound):
+            remaining += terms[by_bound[n_non_essential]][4]
+            if self.__score_bound(remaining, 0, n_non_essential + 1, n_terms, alpha, with_proximity) >= threshold:
+                break
+            n_non_essential += 1
+        non_essential = set(by_bound[:n_non_essential])
+
+        # accumulate in query term order, so scores are identical to __search_similarity
+        scores = self.__score_buffer
+        hit_counts = self.__hit_buffer
+        essential_ordinals = [term[0] for query_idx, term in enumerate(terms) if query_idx not in non_essential]
+        candidates = np.unique(np.concatenate(essential_ordinals)) if essential_ordinals else np.zeros(0, np.int64)
+        for query_idx, (ordinals, weights, _, _, _) in enumerate(terms):
+            if query_idx not in non_essential:
+                scores[ordinals] += weights
+                hit_counts[ordinals] += 1
+            elif len(ordinals):
+                idx = np.minimum(np.searchsorted(ordinals, candidates), len(ordinals) - 1)
+                found = ordinals[idx] == candidates
+                scores[candidates[found]] += weights[idx[found]]
+                hit_counts[candidates[found]] += 1
+        self.__trace.count("score", candidates_scored=len(candidates))
+        similarity = scores[candidates]
+        n_hits = hit_counts[candidates]
+        scores[candidates] = 0
+        hit_counts[candidates] = 0
+        doc_ids = self.doc_id_array[candidates]
+        is_multi_hit = n_hits > 1
+
+        final = similarity.copy()
+        if not with_proximity:
+            # first stage of __search_similarity
+            final[is_multi_hit] = -(alpha * -similarity[is_multi_hit])
+            order = np.lexsort((doc_ids, -final))
+            order = order[((final > 0) | is_multi_hit)[order]][:top_k]
+            return candidates[order], final[order]
+
+        # the score of documents matching a single term is their similarity, the others are scored by decreasing upper
+        # bound (see __score_bound, each pair of matched terms contributes at most 1 to the proximity score)
+        multi_hit = np.flatnonzero(is_multi_hit)
+        pairs = n_hits[multi_hit] * (n_hits[multi_hit] - 1) / 2
+        bounds = (alpha * similarity[multi_hit] + (1 - alpha) * pairs / max(n_terms * (n_terms - 1) / 2, 1))
+        bounds *= 1 + BOUND_SLACK
+        by_score_bound = np.argsort(-bounds, kind="stable")
+        multi_hit, bounds = multi_hit[by_score_bound], bounds[by_score_bound]
+        is_scored = ~is_multi_hit
+        query_terms = [term[:4] for term in terms]
+        start = 0
+        while start < len(multi_hit):
+            positive = final[is_scored & (final > 0)]
+            # documents with a non-positive score are never returned, ties on the k-th score are broken by docID
+            kth_score = 0 if len(positive) < top_k else np.partition(positive, len(positive) - top_k)[-top_k]
+            if bounds[start] < kth_score or bounds[start] <= 0:
                 break
-        return answer, score_output
+            # chunks grow with the number of documents scored, so there are few of them even for a small k
+            chunk = multi_hit[start:start + max(top_k, start // 4)]
+            final[chunk] = self.__rerank(query_terms, candidates[chunk], n_terms, alpha)
+            is_scored[chunk] = True
+            start += len(chunk)
+        order = np.lexsort((doc_ids, -final))
+        order = order[(is_scored & (final > 0))[order]][:top_k]
+        return candidates[order], final[order]
 
-    def __free_text_query(self, tokens, alpha=0.8):
+    def __search_top_k(self, query_tokens, query_tfidfs, top_k, alpha=0.8):
         """
-        Returns the query result for a free text query
+        Search the top k similar documents for query with dynamic pruning (see __max_score). Ranks and scores are the
+        same as the head of __search_similarity's result; with rerank_depth set, the first stage is pruned on cosine
+        scores and the top rerank_depth documents are then reranked with their proximity scores.
+        :param query_tokens: the terms in the query
+        :param query_tfidfs: corresponding term tfidfs (in the same order with query_tokens)
+        :param top_k: number of documents to return
+        :return: a tuple of (list of document ids, list of scores), ranked by similarity
+        """
+        with self.__trace.stage("score"):
+            terms = self.__load_terms(query_tokens, query_tfidfs)
+            for query_idx, token in enumerate(query_tokens):
+                max_weight = self.dictionary.get_max_weight(token)
+                if max_weight is not None:
+                    bound = max_weight * query_tfidfs[query_idx]
+                else:
+                    bound = float(terms[query_idx][1].max()) if len(terms[query_idx][1]) else 0.0
+                terms[query_idx] += (bound,)
+            if self.rerank_depth is None:
+                ordinals, scores = self.__max_score(terms, len(query_tokens), top_k, alpha)
+                return self.doc_id_array[ordinals].tolist(), scores.tolist()
+            ordinals, scores = self.__max_score(terms, len(query_tokens), max(top_k, self.rerank_depth), alpha,
+                                                with_proximity=False)
+        head = min(self.rerank_depth, len(ordinals))
+        scores[:head] = self.__rerank([term[:4] for term in terms], ordinals[:head], len(query_tokens), alpha)
+        doc_ids = self.doc_id_array[ordinals]
+        order = np.lexsort((doc_ids[:head], -scores[:head]))
+        # only the reranked scores can be non-positive, see __max_score
+        order = np.concatenate([order[scores[order] > 0], np.arange(head, len(ordinals))])[:top_k]
+        return doc_ids[order].tolist(), scores[order].tolist()
+
+    def __get_query_tfidfs(self, tokens):
+        """
+        Weights the terms of a query
         :param tokens: the tokens in the query
-        :return: a list of doc_ids retrieved by the search engine
+        :return: a tuple of (sorted_tokens, tfidfs), see __get_query_tfs
         """
         # calculate tfidfs for query tokens
         sorted_tokens, tfs = self.__get_query_tfs(tokens)
         idfs = [self.__get_idf(token) for token in sorted_tokens]
         tfidfs = [(1 + math.log(tfs[i], 10)) * idfs[i] for i in range(len(tfs))]
-        return self.__search_similarity(sorted_tokens, tfidfs, alpha=alpha)
+        return sorted_tokens, tfidfs
 
-    def query(self, query_string, expand=False):
+    def __free_text_query(self, tokens, alpha=0.8, top_k=None, candidates=None):
+        """
+        Returns the query result for a free text query
+        :param tokens: the tokens in the query
+        :param top_k: if given, only the top k documents are retrieved (with dynamic pruning)
+        :param candidates: if given, ascending array of the only document ordinals to score (top_k is then ignored)
+        :return: a list of doc_ids retrieved by the search engine
+        """
+        sorted_tokens, tfidfs = self.__get_query_tfidfs(tokens)
+        if top_k is not None and candidates is None:
+            return self.__search_top_k(sorted_tokens, tfidfs, top_k, alpha=alpha)
+        return self.__search_similarity(sorted_tokens, tfidfs, alpha=alpha, candidates=candidates)
+
+    def query(self, query_string, expand=False, top_k=None, conjunctive=False, with_scores=False):
         """
         Returns the query result for a query string
         :param query_string: contains the query
         :param expand: whether use query expansion
-        :return: a list of doc_ids retrieved by the search engine
+        :param top_k: if given, only the top k documents are returned. Free text queries are then evaluated
+            document-at-a-time with MaxScore pruning, Boolean queries are truncated after combining their clauses.
+        :param conjunctive: if True, Boolean queries only return documents matching every clause (phrases matched
+            exactly), which are the only ones ranked. Otherwise every clause is scored over all documents.
+        :param with_scores: also return the scores
+        :return: a list of doc_ids retrieved by the search engine, or a tuple of (doc_ids, scores) if with_scores is set
+        """
+        result = score = None
+        trace = self.__start_trace(query_string)
+        try:
+            # tokenize and preprocess the query string
+            with self.__trace.stage("parse"):
+                query_container = self.parser.parse_query(query_string)
+            result, score = self.__evaluate(query_container, expand, top_k, conjunctive)
+        finally:
+            self.__pause_trace()
+        self.__end_trace(trace, result)
+        return (result, score) if with_scores else result
+
+    def query_batch(self, query_strings, expand=False, top_k=None, conjunctive=False, with_scores=False):
+        """
+        Returns the query results of a batch of query strings. The postings lists of the union of the query terms are
+        read once, in file offset order (a single sequential pass over the postings file), and shared by every query of
+        the batch. Results are the same as calling query on each query string.
+        :param query_strings: list of query strings
+        :param expand: whether use query expansion
+        :param top_k: see query
+        :param conjunctive: see query
+        :param with_scores: see query
+        :return: a list of query results, in the same order as query_strings
+        """
+        query_containers = []
+        traces = []
+        for query_string in query_strings:
+            traces.append(self.__start_trace(query_string))
+            try:
+                with self.__trace.stage("parse"):
+                    query_containers.append(self.parser.parse_query(query_string))
+            finally:
+                self.__pause_trace()
+        batch_trace = self.__start_trace(None, "batch", batch_size=len(query_strings))
+        try:
+            terms = set()
+            for query_container in query_containers:
+                terms.update(self.__query_terms(query_container, expand, conjunctive))
+            terms = sorted((token for token in terms if token in self.dictionary),
+                           key=lambda token: self.dictionary[token])
+            self.__batch_postings = {token: self.__get_ordinals(token) for token in terms}
+        finally:
+            self.__pause_trace()
+        self.__end_trace(batch_trace)
+        try:
+            results = []
+            for query_container, trace in zip(query_containers, traces):
+                self.__resume_trace(trace)
+                try:
+                    results.append(self.__evaluate(query_container, expand, top_k, conjunctive))
+                finally:
+                    self.__pause_trace()
+                self.__end_trace(trace, results[-1][0])
+            return results if with_scores else [result for result, _ in results]
+        finally:
+            self.__batch_postings = {}
+
+    def __start_trace(self, query, kind="query", **fields):
+        """
+        Starts tracing a query, if there is a trace hook
+        :param query: the query string
+        :return: the QueryTrace, or None if not tracing
+        """
+        if self.trace_hook is None:
+            return None
+        self.__trace = QueryTrace(query.strip() if query is not None else None, kind, index=self.dict_file, **fields)
+        self.__trace.resume()
+        return self.__trace
+
+    def __resume_trace(self, trace):
+        if trace is not None:
+            self.__trace = trace
+            trace.resume()
+
+    def __pause_trace(self):
+        if self.__trace.enabled:
+            self.__trace.pause()
+            self.__trace = NULL_TRACE
+
+    def __end_trace(self, trace, result=None):
+        """
+        Passes a finished trace to the trace hook
+        :param trace: the QueryTrace, or None
+        :param result: the docIDs returned for the query, None if it failed
+        :return: nothing
+        """
+        if trace is None:
+            return
+        if trace.kind == "query":
+            trace.finish(results=len(result) if result is not None else None)
+        else:
+            trace.finish()
+        self.trace_hook(trace)
+
+    def score_components(self, query_string, expand=False, conjunctive=False):
+        """
+        Returns the components of the scores of the documents matching a query, so that its ranking can be recomputed
+        for any alpha (see sweep.py). In each clause, a document matching a single term scores its similarity, the
+        others -(alpha * -similarity - (1 - alpha) * proximity), and a Boolean query sums the scores of its clauses
+        (in clause order). Free text queries have a single clause. Proximity scores are computed for every document
+        matching several terms, as with rerank_depth unset.
+        :param query_string: contains the query
+        :param expand: whether use query expansion
+        :param conjunctive: see query
+        :return: a tuple of (query type, clauses, doc_ids, similarities, proximities, multi-hit flags), the last five
+            are arrays with a row per (clause, document), in clause order
         """
-        # tokenize and preprocess the query string
         query_container = self.parser.parse_query(query_string)
+        if query_container.q_type == "FreeText":
+            clauses = [query_container.data]
+        elif query_container.q_type == "Boolean":
+            clauses = query_container.data
+        else:
+            clauses = []
+        candidates = None
+        if conjunctive and query_container.q_type == "Boolean":
+            candidates = self.__match_boolean(clauses)
+            if not len(candidates):
+                clauses = []
+        rows = []
+        for clause_idx, clause in enumerate(clauses):
+            sorted_tokens, tfidfs = self.__get_query_tfidfs(self.__expand_query(clause) if expand else clause)
+            terms = self.__load_terms(sorted_tokens, tfidfs, candidates)
+            if not terms:
+                continue
+            ordinals = np.unique(np.concatenate([term[0] for term in terms]))
+            similarity, proximity, is_multi_hit = self.__rerank_components(terms, ordinals, len(sorted_tokens))
+            rows.append((np.full(len(ordinals), clause_idx, dtype=np.int64), self.doc_id_array[ordinals], similarity,
+                         proximity, is_multi_hit))
+        if not rows:
+            empty = np.zeros(0, dtype=np.int64)
+            return query_container.q_type, empty, empty, np.zeros(0), np.zeros(0), np.zeros(0, dtype=bool)
+        return (query_container.q_type,) + tuple(np.concatenate(column) for column in zip(*rows))
+
+    def __query_terms(self, query_container, expand, conjunctive=False):
+        """
+        Lists the terms whose postings lists a query uses
+        :param query_container: a parsed query
+        :param expand: whether use query expansion
+        :param conjunctive: whether phrases are matched exactly, with the biwords of the phrases if they are indexed
+        :return: set of terms
+        """
+        if query_container.q_type == "FreeText":
+            clauses = [query_container.data]
+        elif query_container.q_type == "Boolean":
+            clauses = query_container.data
+        else:
+            return set()
+        terms = set()
+        for clause in clauses:
+            terms.update(self.__expand_query(clause) if expand else clause)
+            if conjunctive and query_container.q_type == "Boolean" and len(clause) > 1:
+                pairs = phrase_biwords(clause)
+                if all(pair in self.dictionary for pair in pairs):
+                    terms.update(pairs)
+        return terms
+
+    def __evaluate(self, query_container, expand, top_k, conjunctive):
+        """
+        Evaluates a parsed query, see query
+        :return: a tuple of (doc_ids, scores)
+        """
         if query_container.q_type == "FreeText":
             if expand:
                 expanded_query = self.__expand_query(query_container.data)
-                print(expanded_query)
-                result, score = self.__free_text_query(expanded_query)
+                result, score = self.__free_text_query(expanded_query, top_k=top_k)
             else:
-                result, score = self.__free_text_query(query_container.data)
+                result, score = self.__free_text_query(query_container.data, top_k=top_k)
             # if len(result) > 100:
             #     print(len(result))
             #     rev_score = list(reversed(score))
             #     result = result[:len(result) - bisect.bisect(rev_score, score[0]*0.05)]
             # print(len(result))
-            return result
+            return result, score
         elif query_container.q_type == "Boolean":
             # Boolean query
             # relevant = set(self.dictionary.doc_ids)
 
+            candidates = None
+            if conjunctive:
+                candidates = self.__match_boolean(query_container.data)
+                if not len(candidates):
+                    return [], []
             relevant_dict = {}
             for query_element in query_container.data:
                 if expand:
                     expanded_query = self.__expand_query(query_element)
-                    result, score = self.__free_text_query(expanded_query, alpha=0.2)
+                    result, score = self.__free_text_query(expanded_query, alpha=0.2, candidates=candidates)
                 else:
-                    result, score = self.__free_text_query(query_element, alpha=0.2)
+                    result, score = self.__free_text_query(query_element, alpha=0.2, candidates=candidates)
                 # relevant.intersection_update(result)
                 for doc_id_idx, doc_id in enumerate(result):
                     old_score = relevant_dict.get(doc_id, 0)
                     relevant_dict[doc_id] = old_score + score[doc_id_idx]
             result = []
-            for doc_id in relevant_dict.keys():
-                result.append((relevant_dict[doc_id], doc_id))
-            result = sorted(result, reverse=True)
-            return [doc_id for (_, doc_id) in result]
+            with self.__trace.stage("sort"):
+                for doc_id in relevant_dict.keys():
+                    result.append((relevant_dict[doc_id], doc_id))
+                result = sorted(result, reverse=True)[:top_k]
+            return [doc_id for (_, doc_id) in result], [score for (score, _) in result]
         else:
             # ERROR!
             print("ERROR!")
-            return []
+            return [], []
 
     def close(self):
         """
-        Close the postings file
+        Release the postings file
         :return: nothing
         """
-        self.postings_file.close()
+        if self.postings_reader is not None:
+            self.postings_reader.close()
+            self.postings_reader = None
+            if self.postings_cache is not None:
+                self.postings_cache.clear()
+            self.dictionary.close()
+
+
+def format_result(query_result):
+    """
+    Formats the result of a query as a line of the output file
+    :param query_result: list of docIDs
+    :return: the docIDs separated by spaces, with a trailing newline
+    """
+    return " ".join(str(doc_id) for doc_id in query_result) + "\n"
+
+
+def merge_results(results, top_k=None, boolean=False, with_scores=False):
+    """
+    Merges the results of a query over several indexes of disjoint sets of documents (e.g. segments or shards), in the
+    order SearchEngine ranks the query
+    :param results: list of (doc_ids, scores) results
+    :param top_k: if given, only the top k documents are returned
+    :param boolean: whether the query is a Boolean query (ties are then broken by descending docID)
+    :param with_scores: also return the scores
+    :return: a list of doc_ids, or a tuple of (doc_ids, scores) if with_scores is set
+    """
+    ranked = [(score, doc_id) for doc_ids, scores in results for doc_id, score in zip(doc_ids, scores)]
+    if boolean:
+        ranked.sort(reverse=True)
+    else:
+        ranked.sort(key=lambda item: (-item[0], item[1]))
+    ranked = ranked[:top_k]
+    doc_ids = [doc_id for _, doc_id in ranked]
+    return (doc_ids, [score for score, _ in ranked]) if with_scores else doc_ids
+
+
+# search engine of the worker processes of the batch mode, each worker maps the same index files
+_worker_engine = None
+
+
+def _init_worker(dict_file, post_file, engine_args):
+    global _worker_engine
+    _worker_engine = SearchEngine(dict_file, post_file, **engine_args)
+
+
+def _run_queries(args):
+    """
+    Runs a batch of queries (runs in a worker process)
+    :param args: a tuple of (list of query strings, top_k, conjunctive), see SearchEngine.query_batch
+    :return: the formatted results, see format_result
+    """
+    query_strs, top_k, conjunctive = args
+    results = _worker_engine.query_batch(query_strs, expand=True, top_k=top_k, conjunctive=conjunctive)
+    return "".join(format_result(query_result) for query_result in results)
+
+
+def run_batch(dict_file, post_file, query_list, output_file, workers, top_k=None, conjunctive=False, **engine_args):
+    """
+    Runs a batch of queries on a pool of worker processes. Every worker opens its own SearchEngine, the index files are
+    memory-mapped so the workers share the same page cache pages. Queries are sent to the workers in batches of up to
+    BATCH_SIZE, results are written in input order, each batch as soon as it and all the batches before it are done.
+    :param query_list: list of query strings
+    :param output_file: path to the output file
+    :param workers: number of worker processes
+    :param engine_args: keyword arguments of the SearchEngine constructor
+    :return: nothing
+    """
+    # small batches keep results flowing to the output file and every worker busy
+    batch_size = max(1, min(BATCH_SIZE, len(query_list) // (workers * 8)))
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(dict_file, post_file, engine_args))
+    try:
+        with open(output_file, "w") as f:
+            jobs = ((query_list[i:i + batch_size], top_k, conjunctive) for i in range(0, len(query_list), batch_size))
+            for lines in pool.imap(_run_queries, jobs):
+                f.write(lines)
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 if __name__ == "__main__":
-    dictionary_file = postings_file = file_of_queries = file_of_output = None
+    dictionary_file = postings_file = file_of_queries = file_of_output = index_dir = None
+    top_k = None
+    rerank_depth = None
+    proximity = "pairwise"
+    conjunctive = False
+    cache_bytes = 64 * 2**20
+    cache_policy = "lru"
+    pinned_terms = 0
+    workers = 1
+    trace_file = None
+    slow_query_ms = 0
+    fast_tokenizer = False
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:')
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:k:r:m:bc:e:n:w:x:t:s:a')
     except getopt.GetoptError as err:
         usage()
         sys.exit(2)
@@ -296,10 +1071,38 @@ if __name__ == "__main__":
             file_of_queries = a
         elif o == '-o':
             file_of_output = a
+        elif o == '-k':
+            top_k = int(a)
+        elif o == '-r':
+            rerank_depth = int(a)
+        elif o == '-m':
+            proximity = a
+        elif o == '-b':
+            conjunctive = True
+        elif o == '-c':
+            cache_bytes = int(float(a) * 2**20)
+        elif o == '-e':
+            cache_policy = a
+        elif o == '-n':
+            pinned_terms = int(a)
+        elif o == '-w':
+            workers = int(a)
+        elif o == '-x':
+            index_dir = a
+        elif o == '-t':  # JSON-lines trace file
+            trace_file = a
+        elif o == '-s':  # only trace queries slower than this
+            slow_query_ms = float(a)
+        elif o == '-a':  # fast (regular expression) tokenizer, use it if the index was built with it
+            fast_tokenizer = True
         else:
             assert False, "unhandled option"
 
-    if not dictionary_file or not postings_file or not file_of_queries or not file_of_output :
+    if not (dictionary_file and postings_file or index_dir) or not file_of_queries or not file_of_output:
+        usage()
+        sys.exit(2)
+    if index_dir and workers > 1:
+        # query worker processes are only supported for a single index
         usage()
         sys.exit(2)
 
@@ -308,13 +1111,32 @@ if __name__ == "__main__":
     with open(file_of_queries, "r") as f:
         for line in f:
             query_list.append(line)
-    with SearchEngine(dictionary_file, postings_file) as engine:
-        with open(file_of_output, "w") as f:
-            for query_str in query_list:
-                query_result = engine.query(query_str, expand=True)
-                if query_result:
-                    for idx, res in enumerate(query_result[:-1]):
-                        f.write(str(res))
-                        f.write(" ")
-                    f.write(str(query_result[-1]))
-                f.write("\n")
+    engine_args = dict(rerank_depth=rerank_depth, proximity=proximity, cache_bytes=cache_bytes,
+                       cache_policy=cache_policy, pinned_terms=pinned_terms, fast_tokenizer=fast_tokenizer)
+    if trace_file:
+        engine_args["trace_hook"] = TraceWriter(trace_file, min_ms=slow_query_ms)
+    if workers > 1 and not index_dir:
+        run_batch(dictionary_file, postings_file, query_list, file_of_output, workers, top_k=top_k,
+                  conjunctive=conjunctive, **engine_args)
+    else:
+        if index_dir:
+            # imported here, segments and shards import this module
+            import shards
+            if os.path.exists(os.path.join(index_dir, shards.MANIFEST)):
+                engine = shards.ShardedSearchEngine(index_dir, **engine_args)
+            else:
+                from segments import SegmentedSearchEngine
+                engine = SegmentedSearchEngine(index_dir, **engine_args)
+        else:
+            engine = SearchEngine(dictionary_file, postings_file, **engine_args)
+        with engine:
+            with open(file_of_output, "w") as f:
+                for i in range(0, len(query_list), BATCH_SIZE):
+                    batch = query_list[i:i + BATCH_SIZE]
+                    for query_result in engine.query_batch(batch, expand=True, top_k=top_k, conjunctive=conjunctive):
+                        f.write(format_result(query_result))
+            stats = engine.cache_stats()
+            if stats is not None:
+                print("postings cache: {} hits, {} misses (hit rate {:.2%}), {} evictions, {} entries ({} pinned), "
+                      "{} / {} bytes".format(stats["hits"], stats["misses"], stats["hit_rate"], stats["evictions"],
+                                             stats["entries"], stats["pinned"], stats["bytes"], stats["max_bytes"]))
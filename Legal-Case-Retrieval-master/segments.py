@@ -0,0 +1,411 @@
+#!/usr/bin/python
+import os
+import sys
+import json
+import math
+import getopt
+import threading
+import numpy as np
+import postings_format
+from dictionary import Dictionary, load_dictionary
+from postings_reader import PostingsReader
+from query_parser import Parser
+from search import SearchEngine, merge_results
+from biwords import is_biword
+
+# A segmented index is a directory of independent segments (a dictionary file and a postings file each, as written by
+# Indexer) and a manifest listing the live segments and the deleted docIDs (tombstones) of each segment. New documents
+# are indexed into a new segment, a document added again replaces the older copies, and merge compacts segments into
+# one, dropping deleted documents.
+MANIFEST = "segments.json"
+DICT_SUFFIX = ".dict"
+POST_SUFFIX = ".post"
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -x segmented-index-directory [-a file-to-index.csv] [-r docID,docID,...] [-g] "
+                                    "[-e] [-q] [-b biword-min-df] [-t]")
+
+
+class SegmentedIndex(object):
+    """
+    Manages the segments and tombstones of a segmented index directory. Changes are made visible by atomically
+    replacing the manifest, so searchers opened before a change keep a consistent view.
+    """
+    def __init__(self, index_dir):
+        """
+        :param index_dir: the index directory, created if needed
+        """
+        self.index_dir = index_dir
+        self.lock = threading.RLock()
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        manifest_path = os.path.join(index_dir, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+        else:
+            manifest = {"next_segment": 0, "segments": []}
+        self.next_segment = manifest["next_segment"]
+        # list of {"name": segment name, "deleted": list of deleted docIDs}, oldest first
+        self.segments = manifest["segments"]
+
+    def __save_manifest(self):
+        manifest_path = os.path.join(self.index_dir, MANIFEST)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump({"next_segment": self.next_segment, "segments": self.segments}, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def paths(self, name):
+        """
+        :param name: a segment name
+        :return: a tuple of (dictionary file, postings file) of the segment
+        """
+        return os.path.join(self.index_dir, name + DICT_SUFFIX), os.path.join(self.index_dir, name + POST_SUFFIX)
+
+    def __new_segment_name(self):
+        with self.lock:
+            name = "segment_{:06d}".format(self.next_segment)
+            self.next_segment += 1
+            return name
+
+    def __segment_doc_ids(self, name):
+        """
+        :return: int64 array of the docIDs indexed in a segment (deleted ones included)
+        """
+        dictionary = load_dictionary(self.paths(name)[0])
+        doc_ids = np.array(dictionary.get_doc_arrays()[0])
+        dictionary.close()
+        return doc_ids
+
+    def add_documents(self, input_file, fast_tokenizer=False, **indexer_args):
+        """
+        Indexes the documents of a csv file into a new segment. Documents already in the index are replaced: their older
+        copies are deleted.
+        :param input_file: the csv file, in the format read by Indexer.index
+        :param fast_tokenizer: tokenize with fast_tokenizer (see Parser), unless indexer_args give preprocess
+        :param indexer_args: keyword arguments of the Indexer constructor
+        :return: the name of the new segment
+        """
+        # imported here: index loads the corpora used for indexing, which searchers never need
+        from index import Indexer
+        name = self.__new_segment_name()
+        dict_file, post_file = self.paths(name)
+        if "preprocess" not in indexer_args:
+            # normalize like the index.py command line, and like the queries
+            parser = Parser(fast_tokenizer=fast_tokenizer)
+            indexer_args = dict(indexer_args, preprocess=parser.iter_preprocess, tokenize=parser.iter_tokens)
+        indexer = Indexer(**indexer_args)
+        indexer.index(input_file)
+        indexer.save(post_file, dict_file)
+        new_doc_ids = np.array(sorted(indexer.dictionary.doc_ids), dtype=np.int64)
+        with self.lock:
+            for segment in self.segments:
+                replaced = self.__segment_doc_ids(segment["name"])
+                replaced = replaced[np.isin(replaced, new_doc_ids)].tolist()
+                if replaced:
+                    segment["deleted"] = sorted(set(segment["deleted"]).union(replaced))
+            self.segments.append({"name": name, "deleted": []})
+            self.__save_manifest()
+        return name
+
+    def delete_documents(self, doc_ids):
+        """
+        Deletes documents, by recording tombstones in the segments containing them
+        :param doc_ids: iterable of docIDs
+        :return: the number of documents deleted
+        """
+        doc_ids = np.array(sorted(set(doc_ids)), dtype=np.int64)
+        n_deleted = 0
+        with self.lock:
+            for segment in self.segments:
+                indexed = self.__segment_doc_ids(segment["name"])
+                deleted = set(segment["deleted"])
+                new = [doc_id for doc_id in indexed[np.isin(indexed, doc_ids)].tolist() if doc_id not in deleted]
+                if new:
+                    segment["deleted"] = sorted(deleted.union(new))
+                    n_deleted += len(new)
+            self.__save_manifest()
+        return n_deleted
+
+    def merge(self, names=None):
+        """
+        Merges segments into a new segment without their deleted documents. The merged segments are read from a
+        snapshot, documents deleted or replaced while merging are deleted from the new segment when it is swapped in, so
+        the merge can run in the background (see merge_in_background).
+        :param names: names of the segments to merge, all segments by default
+        :return: the name of the new segment, or None if there was nothing to merge
+        """
+        with self.lock:
+            snapshot = [dict(segment, deleted=list(segment["deleted"])) for segment in self.segments
+                        if names is None or segment["name"] in names]
+        if not snapshot:
+            return None
+        name = self.__new_segment_name()
+        self.__write_merged(name, snapshot)
+        merged_names = set(segment["name"] for segment in snapshot)
+        with self.lock:
+            # tombstones recorded since the snapshot
+            current = {segment["name"]: segment for segment in self.segments}
+            deleted = set()
+            for old in snapshot:
+                deleted.update(set(current[old["name"]]["deleted"]) - set(old["deleted"]))
+            position = min(idx for idx, segment in enumerate(self.segments) if segment["name"] in merged_names)
+            self.segments = [segment for segment in self.segments if segment["name"] not in merged_names]
+            self.segments.insert(position, {"name": name, "deleted": sorted(deleted)})
+            self.__save_manifest()
+        for old_name in merged_names:
+            # searchers still using the old files keep their mappings
+            for path in self.paths(old_name):
+                os.remove(path)
+        return name
+
+    def merge_in_background(self, names=None):
+        """
+        Runs merge in a background thread
+        :return: the started thread
+        """
+        thread = threading.Thread(target=self.merge, args=(names,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def __write_merged(self, name, segments):
+        """
+        Writes the union of the live documents of segments as a new segment
+        :param name: the name of the new segment
+        :param segments: list of segment entries, see self.segments
+        :return: nothing
+        """
+        dictionaries = []
+        readers = []
+        for segment in segments:
+            dict_file, post_file = self.paths(segment["name"])
+            dictionaries.append(load_dictionary(dict_file))
+            readers.append(PostingsReader(post_file))
+        try:
+            doc_ids = []
+            doc_len_dict = {}
+            for dictionary, segment in zip(dictionaries, segments):
+                seg_doc_ids, norms = dictionary.get_doc_arrays()
+                live = ~np.isin(seg_doc_ids, np.array(segment["deleted"], dtype=np.int64))
+                for doc_id, norm in zip(seg_doc_ids[live].tolist(), norms[live].tolist()):
+                    doc_ids.append(doc_id)
+                    doc_len_dict[doc_id] = norm
+            vocabulary = set()
+            for dictionary in dictionaries:
+                vocabulary.update(dictionary.get_token(idx) for idx in range(len(dictionary)))
+            # a biword missing from a segment may still occur in its documents (below the segment's min df), it is only
+            # complete in the merged segment if every merged segment has it
+            vocabulary = {term for term in vocabulary
+                          if not is_biword(term) or all(term in dictionary for dictionary in dictionaries)}
+            deleted = [np.array(segment["deleted"], dtype=np.int64) for segment in segments]
+
+            merged_vocabulary = []
+            df_dict = {}
+            cf_dict = {}
+            max_weights = {}
+            ptrs = {}
+            pos_ptrs = {}
+            dict_file, post_file = self.paths(name)
+            # the merged segment stores impacts if the merged ones do
+            store_impacts = all(reader.has_impacts for reader in readers)
+            with postings_format.PostingsWriter(post_file, impacts=store_impacts) as writer:
+                for term in sorted(vocabulary):
+                    term_doc_ids = []
+                    tfs = []
+                    positions = []
+                    for dictionary, reader, seg_deleted in zip(dictionaries, readers, deleted):
+                        fp = dictionary[term]
+                        if fp is None:
+                            continue
+                        pos_fp = dictionary.get_position_pointer(term)
+                        seg_term_doc_ids, _, seg_positions = reader.read(fp, pos_fp)
+                        for idx in np.flatnonzero(~np.isin(seg_term_doc_ids, seg_deleted)).tolist():
+                            term_doc_ids.append(int(seg_term_doc_ids[idx]))
+                            positions.append(seg_positions[idx].tolist())
+                            tfs.append(len(positions[-1]))
+                    if not term_doc_ids:
+                        # every document of the term was deleted
+                        continue
+                    term_id = len(merged_vocabulary)
+                    merged_vocabulary.append(term)
+                    df_dict[term] = len(term_doc_ids)
+                    cf_dict[term] = sum(tfs)
+                    weights = [(1 + math.log(tf, 10)) / doc_len_dict[doc_id] for tf, doc_id in zip(tfs, term_doc_ids)]
+                    impacts = None
+                    max_weights[term] = max(weights)
+                    if store_impacts:
+                        # requantized on the impact range of the merged postings
+                        impacts = postings_format.quantize_impacts(weights)
+                        max_weights[term] = postings_format.dequantize_impact(max(impacts[1]), *impacts[0])
+                    ptrs[term_id], pos_ptrs[term_id] = writer.add(term_id, term_doc_ids, tfs, positions, impacts)
+
+            dictionary = Dictionary(merged_vocabulary, doc_ids)
+            dictionary.add_dfs(df_dict)
+            dictionary.add_doc_len(doc_len_dict)
+            dictionary.add_cfs(cf_dict)
+            dictionary.add_max_weights(max_weights)
+            dictionary.add_pointers(ptrs)
+            dictionary.add_position_pointers(pos_ptrs)
+            tables = [seg_dictionary.synonym_table() for seg_dictionary in dictionaries]
+            if all(table is not None for table in tables):
+                # union of the synonym tables, restricted to the terms left
+                synonyms = {}
+                for table in tables:
+                    for stem, tokens in table.items():
+                        synonyms.setdefault(stem, set()).update(token for token in tokens if token in dictionary)
+                dictionary.add_synonyms({stem: tuple(sorted(dictionary.stoi[token] for token in tokens))
+                                         for stem, tokens in synonyms.items()})
+            dictionary.save(dict_file)
+        finally:
+            for dictionary, reader in zip(dictionaries, readers):
+                reader.close()
+                dictionary.close()
+
+
+class CollectionStats(object):
+    """
+    Collection-wide statistics of a segmented index (document frequencies, number of documents, vocabulary and
+    synonyms, deleted documents excluded), shared by the SearchEngine of every segment so that scores are those of a
+    single index over all the live documents.
+    """
+    def __init__(self):
+        self.engines = []
+        self.synonyms = {}
+
+    def get_df(self, token):
+        return sum(engine.get_df(token) for engine in self.engines)
+
+    def num_docs(self):
+        return sum(engine.num_docs() for engine in self.engines)
+
+    def __contains__(self, token):
+        return any(token in engine for engine in self.engines)
+
+    def get_synonyms(self, token):
+        """
+        :return: set of the synonyms of a term in any segment
+        """
+        synonyms = self.synonyms.get(token)
+        if synonyms is None:
+            synonyms = set()
+            for engine in self.engines:
+                synonyms.update(engine.get_synonyms(token))
+            self.synonyms[token] = synonyms
+        return synonyms
+
+
+class SegmentedSearchEngine(object):
+    """
+    Searches every segment of a segmented index and merges the results. Results are the same as a SearchEngine over an
+    index of all the live documents, except with rerank_depth (the proximity rerank then applies per segment).
+    """
+    def __init__(self, index_dir, **engine_args):
+        """
+        :param index_dir: the segmented index directory
+        :param engine_args: keyword arguments of the SearchEngine constructor
+        """
+        index = SegmentedIndex(index_dir)
+        self.stats = CollectionStats()
+        self.engines = []
+        for segment in index.segments:
+            dict_file, post_file = index.paths(segment["name"])
+            self.engines.append(SearchEngine(dict_file, post_file, deleted_doc_ids=segment["deleted"],
+                                             collection_stats=self.stats, **engine_args))
+        self.stats.engines = self.engines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __merge(self, query_string, results, top_k, with_scores):
+        """
+        Merges the (doc_ids, scores) results of the segments, in the order SearchEngine ranks the query
+        """
+        boolean = not self.engines or self.engines[0].parser.parse_query(query_string).q_type == "Boolean"
+        return merge_results(results, top_k, boolean, with_scores)
+
+    def query(self, query_string, expand=False, top_k=None, conjunctive=False, with_scores=False):
+        """
+        Returns the query result for a query string, see SearchEngine.query
+        """
+        results = [engine.query(query_string, expand, top_k, conjunctive, with_scores=True) for engine in self.engines]
+        return self.__merge(query_string, results, top_k, with_scores)
+
+    def query_batch(self, query_strings, expand=False, top_k=None, conjunctive=False, with_scores=False):
+        """
+        Returns the query results of a batch of query strings, see SearchEngine.query_batch
+        """
+        results = [engine.query_batch(query_strings, expand, top_k, conjunctive, with_scores=True)
+                   for engine in self.engines]
+        return [self.__merge(query_string, [engine_results[idx] for engine_results in results], top_k, with_scores)
+                for idx, query_string in enumerate(query_strings)]
+
+    def cache_stats(self):
+        """
+        :return: dict of postings cache statistics summed over the segments, or None if the cache is disabled
+        """
+        stats = [engine.cache_stats() for engine in self.engines]
+        if not stats or stats[0] is None:
+            return None
+        total = {key: sum(engine_stats[key] for engine_stats in stats) for key in stats[0]}
+        lookups = total["hits"] + total["misses"]
+        total["hit_rate"] = total["hits"] / lookups if lookups else 0
+        return total
+
+    def close(self):
+        for engine in self.engines:
+            engine.close()
+
+
+if __name__ == "__main__":
+    index_dir = input_file = None
+    delete = []
+    merge = False
+    synonyms = False
+    impacts = False
+    biword_min_df = None
+    fast_tokenizer = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'x:a:r:geqb:t')
+    except getopt.GetoptError as err:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-x':
+            index_dir = a
+        elif o == '-a':
+            input_file = a
+        elif o == '-r':
+            delete = [int(doc_id) for doc_id in a.split(",") if doc_id]
+        elif o == '-g':
+            merge = True
+        elif o == '-e':
+            synonyms = True
+        elif o == '-q':
+            impacts = True
+        elif o == '-b':
+            biword_min_df = int(a)
+        elif o == '-t':  # fast (regular expression) tokenizer, see fast_tokenizer
+            fast_tokenizer = True
+        else:
+            assert False, "unhandled option"
+
+    if not index_dir or not (input_file or delete or merge):
+        usage()
+        sys.exit(2)
+
+    segmented_index = SegmentedIndex(index_dir)
+    if input_file:
+        name = segmented_index.add_documents(input_file, fast_tokenizer, synonyms=synonyms, impacts=impacts,
+                                             biword_min_df=biword_min_df)
+        print("Indexed {} into {}".format(input_file, name))
+    if delete:
+        print("Deleted {} documents".format(segmented_index.delete_documents(delete)))
+    if merge:
+        print("Merged into {}".format(segmented_index.merge()))
@@ -0,0 +1,288 @@
+#!/usr/bin/python
+import sys
+import time
+import json
+import getopt
+import asyncio
+import collections
+import concurrent.futures
+from urllib.parse import urlsplit, parse_qs
+from search import SearchEngine
+from query_trace import TraceWriter
+
+# number of recent request latencies kept for the latency percentiles
+LATENCY_WINDOW = 10000
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file [-a host] [-n port] [-u unix-socket] "
+                                    "[-t timeout-seconds] [-l batch-window-ms] [-m max-batch-size] [-c cache-MB] "
+                                    "[-f trace-file] [-s slow-query-ms]")
+
+
+class Request(object):
+    def __init__(self, query_string, expand, top_k, conjunctive, future):
+        self.query_string = query_string
+        # requests are only batched with requests of the same options
+        self.options = (expand, top_k, conjunctive)
+        self.future = future
+
+
+class QueryServer(object):
+    """
+    Serves queries over HTTP (TCP or Unix socket) from a warm SearchEngine. Requests arriving within batch_window of
+    each other are evaluated together as a micro-batch (see SearchEngine.query_batch), on a single scoring thread so
+    the event loop keeps accepting requests meanwhile.
+        GET /search?q=<query>[&expand=1][&k=<top-k>][&conjunctive=1]  (or POST /search with the same fields as JSON)
+            -> {"results": [docIDs], "latency_ms": ...}
+        GET /metrics -> queue depth, request / batch counts and latency percentiles
+    """
+    def __init__(self, engine, timeout=10.0, batch_window=0.005, max_batch_size=32):
+        """
+        :param engine: the SearchEngine
+        :param timeout: seconds after which a request is answered with 504, it is not scored if still queued
+        :param batch_window: seconds to wait for more requests once one arrives
+        :param max_batch_size: maximum number of requests in a micro-batch
+        """
+        self.engine = engine
+        self.timeout = timeout
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.queue = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.requests = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    async def search(self, query_string, expand=False, top_k=None, conjunctive=False):
+        """
+        Queues a query for the next micro-batch and waits for its result
+        :return: list of docIDs
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(Request(query_string, expand, top_k, conjunctive, future))
+        return await asyncio.wait_for(future, self.timeout)
+
+    async def __batch_loop(self):
+        """
+        Collects requests into micro-batches and scores them, forever
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # requests that timed out while queued are dropped
+            batch = [request for request in batch if not request.future.done()]
+            groups = collections.OrderedDict()
+            for request in batch:
+                groups.setdefault(request.options, []).append(request)
+            for (expand, top_k, conjunctive), requests in groups.items():
+                query_strings = [request.query_string for request in requests]
+                self.batches += 1
+                self.batched_requests += len(requests)
+                try:
+                    results = await loop.run_in_executor(self.executor, lambda: self.engine.query_batch(
+                        query_strings, expand=expand, top_k=top_k, conjunctive=conjunctive))
+                except Exception as err:
+                    for request in requests:
+                        if not request.future.done():
+                            request.future.set_exception(err)
+                    continue
+                for request, result in zip(requests, results):
+                    if not request.future.done():
+                        request.future.set_result(result)
+
+    def metrics(self):
+        """
+        :return: dict of server metrics
+        """
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+
+        return {
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "requests": self.requests,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "batches": self.batches,
+            "mean_batch_size": self.batched_requests / self.batches if self.batches else 0,
+            "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99)},
+            "postings_cache": self.engine.cache_stats(),
+        }
+
+    async def __handle_search(self, params):
+        """
+        :param params: dict of request fields
+        :return: a tuple of (HTTP status, response object)
+        """
+        query_string = params.get("q")
+        if not query_string:
+            return 400, {"error": "missing query (q)"}
+        expand = str(params.get("expand", "0")).lower() in ("1", "true")
+        top_k = int(params["k"]) if params.get("k") else None
+        conjunctive = str(params.get("conjunctive", "0")).lower() in ("1", "true")
+        start = time.perf_counter()
+        self.requests += 1
+        try:
+            result = await self.search(query_string, expand=expand, top_k=top_k, conjunctive=conjunctive)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return 504, {"error": "timed out"}
+        except Exception as err:
+            self.errors += 1
+            return 500, {"error": str(err)}
+        latency = (time.perf_counter() - start) * 1000
+        self.latencies.append(latency)
+        return 200, {"results": result, "latency_ms": latency}
+
+    async def __handle_request(self, reader):
+        """
+        Reads one HTTP request and computes its response
+        :return: a tuple of (HTTP status, response object), None if the request line is malformed
+        """
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if len(request_line) < 2:
+            return None
+        method, url = request_line[0], urlsplit(request_line[1])
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if method == "POST" and int(headers.get("content-length", 0)):
+            body = await reader.readexactly(int(headers["content-length"]))
+            payload = json.loads(body.decode("utf-8"))
+            if not isinstance(payload, dict):
+                return 400, {"error": "request body must be a JSON object"}
+            params.update(payload)
+        if url.path == "/search" and method in ("GET", "POST"):
+            return await self.__handle_search(params)
+        if url.path == "/metrics" and method == "GET":
+            return 200, self.metrics()
+        return 404, {"error": "not found"}
+
+    async def __handle_connection(self, reader, writer):
+        """
+        Handles one HTTP request (connections are closed after the response)
+        """
+        try:
+            try:
+                reply = await self.__handle_request(reader)
+            except (ValueError, asyncio.IncompleteReadError) as err:
+                reply = 400, {"error": str(err)}
+            except Exception as err:
+                self.errors += 1
+                reply = 500, {"error": str(err)}
+            if reply is None:
+                return
+            status, response = reply
+            body = json.dumps(response).encode("utf-8")
+            reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error",
+                       504: "Gateway Timeout"}
+            writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+                         "Connection: close\r\n\r\n".format(status, reasons[status], len(body)).encode("latin-1"))
+            writer.write(body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=8080, unix_socket=None):
+        """
+        Starts listening and batching, on the running event loop
+        :param unix_socket: if given, listen on this Unix socket path instead of host:port
+        :return: the asyncio server
+        """
+        self.queue = asyncio.Queue()
+        asyncio.ensure_future(self.__batch_loop())
+        if unix_socket:
+            return await asyncio.start_unix_server(self.__handle_connection, path=unix_socket)
+        return await asyncio.start_server(self.__handle_connection, host, port)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+async def serve(server, host="127.0.0.1", port=8080, unix_socket=None):
+    """
+    Runs a QueryServer until cancelled
+    :param server: the QueryServer
+    :param unix_socket: if given, listen on this Unix socket path instead of host:port
+    """
+    listener = await server.start(host, port, unix_socket)
+    print("serving on {}".format(unix_socket or "http://{}:{}".format(host, port)))
+    async with listener:
+        await listener.serve_forever()
+
+
+if __name__ == "__main__":
+    dictionary_file = postings_file = unix_socket = None
+    host = "127.0.0.1"
+    port = 8080
+    timeout = 10.0
+    batch_window = 5
+    max_batch_size = 32
+    cache_bytes = 64 * 2**20
+    trace_file = None
+    slow_query_ms = 0
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:a:n:u:t:l:m:c:f:s:')
+    except getopt.GetoptError as err:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-d':
+            dictionary_file = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-a':
+            host = a
+        elif o == '-n':
+            port = int(a)
+        elif o == '-u':
+            unix_socket = a
+        elif o == '-t':
+            timeout = float(a)
+        elif o == '-l':
+            batch_window = float(a)
+        elif o == '-m':
+            max_batch_size = int(a)
+        elif o == '-c':
+            cache_bytes = int(float(a) * 2**20)
+        elif o == '-f':  # JSON-lines trace file
+            trace_file = a
+        elif o == '-s':  # only trace queries slower than this
+            slow_query_ms = float(a)
+        else:
+            assert False, "unhandled option"
+
+    if not dictionary_file or not postings_file:
+        usage()
+        sys.exit(2)
+
+    trace_hook = TraceWriter(trace_file, min_ms=slow_query_ms) if trace_file else None
+    with SearchEngine(dictionary_file, postings_file, cache_bytes=cache_bytes, trace_hook=trace_hook) as engine:
+        server = QueryServer(engine, timeout=timeout, batch_window=batch_window / 1000, max_batch_size=max_batch_size)
+        try:
+            asyncio.run(serve(server, host, port, unix_socket))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
@@ -0,0 +1,357 @@
+#!/usr/bin/python
+import os
+import sys
+import json
+import getopt
+import shutil
+import tempfile
+import multiprocessing
+import pandas as pd
+from nltk.corpus import wordnet as wn
+from dictionary import Dictionary, load_dictionary
+from query_parser import Parser
+from search import SearchEngine, merge_results
+
+# A sharded index is a directory of document-partitioned shards (a document goes to shard docID % number of shards),
+# each an independent index (dictionary and postings files) plus a copy of the collection-wide statistics (document
+# frequencies, number of documents and synonyms of the whole collection), so that every shard scores its documents
+# exactly as a single index over the whole collection would. The manifest lists the shards.
+MANIFEST = "shards.json"
+DICT_SUFFIX = ".dict"
+POST_SUFFIX = ".post"
+STATS_SUFFIX = ".stats"
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -i file-to-index.csv -x sharded-index-directory -n number-of-shards "
+                                    "[-w workers] [-e] [-q] [-b biword-min-df] [-a]")
+
+
+def shard_paths(index_dir, name):
+    """
+    :return: a tuple of (dictionary file, postings file, statistics file) of a shard
+    """
+    base = os.path.join(index_dir, name)
+    return base + DICT_SUFFIX, base + POST_SUFFIX, base + STATS_SUFFIX
+
+
+def _build_shard(args):
+    """
+    Indexes the documents of a shard (runs in a worker process)
+    :param args: a tuple of (csv file of the shard, dictionary file, postings file, whether to use the fast tokenizer,
+        Indexer keyword arguments)
+    :return: nothing
+    """
+    # imported here: index loads the corpora used for indexing, which searchers never need
+    from index import Indexer
+    input_file, dict_file, post_file, fast_tokenizer, indexer_args = args
+    if "preprocess" not in indexer_args:
+        # normalize like the index.py command line, and like the queries
+        parser = Parser(fast_tokenizer=fast_tokenizer)
+        indexer_args = dict(indexer_args, preprocess=parser.iter_preprocess, tokenize=parser.iter_tokens)
+    indexer = Indexer(**indexer_args)
+    indexer.index(input_file)
+    indexer.save(post_file, dict_file)
+
+
+def write_global_stats(dict_files, path):
+    """
+    Writes the collection-wide statistics of a set of shards, as a dictionary file (without postings pointers)
+    :param dict_files: the dictionary files of the shards
+    :param path: the statistics file
+    :return: nothing
+    """
+    df_dict = {}
+    cf_dict = {}
+    doc_len_dict = {}
+    tables = []
+    for dict_file in dict_files:
+        dictionary = load_dictionary(dict_file)
+        for idx in range(len(dictionary)):
+            term = dictionary.get_token(idx)
+            df_dict[term] = df_dict.get(term, 0) + int(dictionary.dfs[idx])
+            cf_dict[term] = cf_dict.get(term, 0) + int(dictionary.cfs[idx])
+        doc_ids, norms = dictionary.get_doc_arrays()
+        doc_len_dict.update(zip(doc_ids.tolist(), norms.tolist()))
+        tables.append(dictionary.synonym_table())
+        dictionary.close()
+    vocabulary = sorted(df_dict.keys())
+    stats = Dictionary(vocabulary, sorted(doc_len_dict.keys()))
+    stats.add_dfs(df_dict)
+    stats.add_cfs(cf_dict)
+    stats.add_doc_len(doc_len_dict)
+    stats.add_pointers({idx: -1 for idx in range(len(vocabulary))})
+    if all(table is not None for table in tables):
+        # union of the synonym tables
+        synonyms = {}
+        for table in tables:
+            for stem, tokens in table.items():
+                synonyms.setdefault(stem, set()).update(tokens)
+        stats.add_synonyms({stem: tuple(sorted(stats.stoi[token] for token in tokens))
+                            for stem, tokens in synonyms.items()})
+    stats.save(path)
+
+
+def build_shards(input_file, index_dir, n_shards, workers=None, fast_tokenizer=False, **indexer_args):
+    """
+    Builds a sharded index: splits the documents of a csv file into n_shards shards, indexes the shards in parallel,
+    then writes the collection-wide statistics next to every shard
+    :param input_file: the csv file, in the format read by Indexer.index
+    :param index_dir: the index directory, created if needed
+    :param n_shards: number of shards
+    :param workers: number of worker processes (defaults to the number of CPUs)
+    :param fast_tokenizer: tokenize with fast_tokenizer (see Parser), unless indexer_args give preprocess
+    :param indexer_args: keyword arguments of the Indexer constructor
+    :return: list of the shard names
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    names = ["shard_{:03d}".format(shard) for shard in range(n_shards)]
+    tmp_dir = tempfile.mkdtemp(dir=index_dir)
+    try:
+        shard_files = [os.path.join(tmp_dir, name + ".csv") for name in names]
+        written = [False] * n_shards
+        for chunk in pd.read_csv(input_file, chunksize=10000):
+            shards = chunk.document_id.astype(int) % n_shards
+            for shard, rows in chunk.groupby(shards):
+                rows.to_csv(shard_files[shard], mode="a", header=not written[shard], index=False)
+                written[shard] = True
+        for shard in range(n_shards):
+            if not written[shard]:
+                # no document falls in this shard, it is an empty index
+                pd.DataFrame(columns=["document_id", "content"]).to_csv(shard_files[shard], index=False)
+        jobs = [(shard_files[shard],) + shard_paths(index_dir, names[shard])[:2] + (fast_tokenizer, indexer_args)
+                for shard in range(n_shards)]
+        if workers == 1:
+            for job in jobs:
+                _build_shard(job)
+        else:
+            pool = multiprocessing.Pool(min(workers, n_shards))
+            try:
+                pool.map(_build_shard, jobs)
+            finally:
+                pool.terminate()
+                pool.join()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    stats_files = [shard_paths(index_dir, name)[2] for name in names]
+    write_global_stats([shard_paths(index_dir, name)[0] for name in names], stats_files[0])
+    for stats_file in stats_files[1:]:
+        shutil.copyfile(stats_files[0], stats_file)
+    with open(os.path.join(index_dir, MANIFEST), "w") as f:
+        json.dump({"shards": names}, f)
+    return names
+
+
+class GlobalStats(object):
+    """
+    Collection-wide statistics of a sharded index, read from a shard's statistics file. Used as the collection_stats
+    of the shard's SearchEngine (see segments.CollectionStats for the interface).
+    """
+    def __init__(self, path):
+        """
+        :param path: the statistics file
+        """
+        self.dictionary = load_dictionary(path)
+        self.parser = None
+        self.synonyms = {}
+
+    def get_df(self, token):
+        return self.dictionary.get_df(token)
+
+    def num_docs(self):
+        return self.dictionary.num_docs()
+
+    def __contains__(self, token):
+        return token in self.dictionary
+
+    def get_synonyms(self, token):
+        """
+        :return: set of the synonyms of a term in the whole collection, from the synonym tables of the shards if they
+            have an entry for it, otherwise from WordNet like SearchEngine
+        """
+        synonyms = self.synonyms.get(token)
+        if synonyms is not None:
+            return synonyms
+        table_synonyms = self.dictionary.get_synonyms(token)
+        if table_synonyms or (table_synonyms is not None and token in self.dictionary):
+            synonyms = set(table_synonyms)
+        else:
+            if self.parser is None:
+                self.parser = Parser()
+            synonyms = set()
+            for synset in wn.synsets(token):
+                name = self.parser.preprocess([synset.name().split(".")[0]])[0]
+                if name in self.dictionary:
+                    synonyms.add(name)
+        self.synonyms[token] = synonyms
+        return synonyms
+
+    def close(self):
+        self.dictionary.close()
+
+
+def _open_shard(dict_file, post_file, stats_file, engine_args):
+    return SearchEngine(dict_file, post_file, collection_stats=GlobalStats(stats_file), **engine_args)
+
+
+def _serve_shard(conn, dict_file, post_file, stats_file, engine_args):
+    """
+    Answers the method calls of the coordinator on a shard's SearchEngine, until it sends None (runs in a worker
+    process)
+    """
+    engine = _open_shard(dict_file, post_file, stats_file, engine_args)
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            method, args = message
+            try:
+                conn.send((True, getattr(engine, method)(*args)))
+            except Exception as err:
+                conn.send((False, err))
+    finally:
+        engine.close()
+        engine.collection_stats.close()
+        conn.close()
+
+
+class ShardedSearchEngine(object):
+    """
+    Coordinator of a sharded index: every query is sent to the SearchEngine of every shard, each in its own worker
+    process, and the per-shard results (top k lists with top_k) are merged. Results are the same as a SearchEngine over
+    an index of the whole collection, except with rerank_depth (the proximity rerank then applies per shard).
+    """
+    def __init__(self, index_dir, processes=True, **engine_args):
+        """
+        :param index_dir: the sharded index directory
+        :param processes: run every shard in a worker process, otherwise all shards are searched in this process
+        :param engine_args: keyword arguments of the SearchEngine constructor
+        """
+        with open(os.path.join(index_dir, MANIFEST), "r") as f:
+            names = json.load(f)["shards"]
+        self.parser = Parser(fast_tokenizer=engine_args.get("fast_tokenizer", False))
+        self.engines = []
+        self.workers = []
+        for name in names:
+            dict_file, post_file, stats_file = shard_paths(index_dir, name)
+            if not processes:
+                self.engines.append(_open_shard(dict_file, post_file, stats_file, engine_args))
+                continue
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve_shard,
+                                              args=(child_conn, dict_file, post_file, stats_file, engine_args))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self.workers.append((process, conn))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __scatter(self, method, *args):
+        """
+        Calls a SearchEngine method on every shard, in parallel when shards run in worker processes
+        :return: list of the results of the shards
+        """
+        if not self.workers:
+            return [getattr(engine, method)(*args) for engine in self.engines]
+        for _, conn in self.workers:
+            conn.send((method, args))
+        results = [conn.recv() for _, conn in self.workers]
+        for ok, result in results:
+            if not ok:
+                raise result
+        return [result for _, result in results]
+
+    def __is_boolean(self, query_string):
+        return self.parser.parse_query(query_string).q_type == "Boolean"
+
+    def query(self, query_string, expand=False, top_k=None, conjunctive=False, with_scores=False):
+        """
+        Returns the query result for a query string, see SearchEngine.query
+        """
+        results = self.__scatter("query", query_string, expand, top_k, conjunctive, True)
+        return merge_results(results, top_k, self.__is_boolean(query_string), with_scores)
+
+    def query_batch(self, query_strings, expand=False, top_k=None, conjunctive=False, with_scores=False):
+        """
+        Returns the query results of a batch of query strings, see SearchEngine.query_batch
+        """
+        results = self.__scatter("query_batch", query_strings, expand, top_k, conjunctive, True)
+        return [merge_results([shard_results[idx] for shard_results in results], top_k,
+                              self.__is_boolean(query_string), with_scores)
+                for idx, query_string in enumerate(query_strings)]
+
+    def cache_stats(self):
+        """
+        :return: dict of postings cache statistics summed over the shards, or None if the cache is disabled
+        """
+        stats = self.__scatter("cache_stats")
+        if not stats or stats[0] is None:
+            return None
+        total = {key: sum(shard_stats[key] for shard_stats in stats) for key in stats[0]}
+        lookups = total["hits"] + total["misses"]
+        total["hit_rate"] = total["hits"] / lookups if lookups else 0
+        return total
+
+    def close(self):
+        for engine in self.engines:
+            engine.close()
+            engine.collection_stats.close()
+        self.engines = []
+        for process, conn in self.workers:
+            conn.send(None)
+            conn.close()
+            process.join()
+        self.workers = []
+
+
+if __name__ == "__main__":
+    index_dir = input_file = None
+    n_shards = None
+    workers = None
+    synonyms = False
+    impacts = False
+    biword_min_df = None
+    fast_tokenizer = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:x:n:w:eqb:a')
+    except getopt.GetoptError as err:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-i':
+            input_file = a
+        elif o == '-x':
+            index_dir = a
+        elif o == '-n':
+            n_shards = int(a)
+        elif o == '-w':
+            workers = int(a)
+        elif o == '-e':
+            synonyms = True
+        elif o == '-q':
+            impacts = True
+        elif o == '-b':
+            biword_min_df = int(a)
+        elif o == '-a':  # fast (regular expression) tokenizer, see fast_tokenizer
+            fast_tokenizer = True
+        else:
+            assert False, "unhandled option"
+
+    if not input_file or not index_dir or not n_shards:
+        usage()
+        sys.exit(2)
+
+    names = build_shards(input_file, index_dir, n_shards, workers, fast_tokenizer, synonyms=synonyms, impacts=impacts,
+                         biword_min_df=biword_min_df)
+    print("Indexed {} into {} shards".format(input_file, len(names)))
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+import os
+import sys
+import json
+import time
+import getopt
+import numpy as np
+from search import SearchEngine
+from evaluate import average_metrics
+
+# Tunes the mix of cosine similarity and proximity (alpha) without re-running the queries for every value: the
+# similarity and proximity of every (query, clause, document) are computed once (see SearchEngine.score_components),
+# cached in a columnar .npz file, and recombined for every alpha of the grid, with the metrics of evaluate.py.
+# Free text queries use the free text alpha (0.8 in search.py), Boolean queries the Boolean one (0.2, per clause).
+DEFAULT_ALPHAS = [round(0.1 * i, 1) for i in range(11)]
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -a file-of-answers "
+                                    "-o results.json [-c components-cache.npz] [-f free-text-alphas] "
+                                    "[-g boolean-alphas] [-k top-k] [-b] [-n]")
+
+
+def compute_components(engine, query_list, expand=True, conjunctive=False):
+    """
+    Computes the score components of a list of queries
+    :param engine: the SearchEngine
+    :param query_list: list of query strings
+    :return: dict of columns: per row "query", "clause", "doc_id", "similarity", "proximity", "multi_hit", and per
+        query "boolean" (whether it is a Boolean query)
+    """
+    columns = {"query": [], "clause": [], "doc_id": [], "similarity": [], "proximity": [], "multi_hit": []}
+    boolean = []
+    for query_idx, query_string in enumerate(query_list):
+        q_type, clauses, doc_ids, similarity, proximity, multi_hit = engine.score_components(
+            query_string, expand=expand, conjunctive=conjunctive)
+        boolean.append(q_type == "Boolean")
+        columns["query"].append(np.full(len(doc_ids), query_idx, dtype=np.int64))
+        for name, column in (("clause", clauses), ("doc_id", doc_ids), ("similarity", similarity),
+                             ("proximity", proximity), ("multi_hit", multi_hit)):
+            columns[name].append(column)
+    components = {name: np.concatenate(column) if column else np.zeros(0) for name, column in columns.items()}
+    components["boolean"] = np.array(boolean, dtype=bool)
+    return components
+
+
+def save_components(path, components, key):
+    """
+    :param key: description of the queries, index and options the components were computed for
+    """
+    np.savez(path, key=np.array(json.dumps(key, sort_keys=True)), **components)
+
+
+def load_components(path, key):
+    """
+    :return: the cached components, or None if there are none for key
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as cache:
+        if str(cache["key"]) != json.dumps(key, sort_keys=True):
+            return None
+        return {name: cache[name] for name in cache.files if name != "key"}
+
+
+def query_scores(alphas, similarity, proximity, multi_hit):
+    """
+    Scores of the rows of a query for every alpha, computed like SearchEngine (same operations, same rounding)
+    :return: float array (alphas x rows)
+    """
+    alphas = np.asarray(alphas, dtype=float)[:, None]
+    return np.where(multi_hit, -(alphas * -similarity - (1 - alphas) * proximity), similarity)
+
+
+def query_metrics(alphas, rows, boolean, relevant, top_k=None):
+    """
+    Ranks the documents of a query for every alpha and scores the rankings
+    :param rows: dict of the component columns of the query's rows
+    :param boolean: whether the query is a Boolean query
+    :param relevant: set of relevant docIDs
+    :return: a tuple of float arrays (avg precisions, avg recalls, avg fscores), one value per alpha
+    """
+    if not len(rows["doc_id"]) or not relevant:
+        zeros = np.zeros(len(alphas))
+        return zeros, zeros, zeros
+    scores = query_scores(alphas, rows["similarity"], rows["proximity"], rows["multi_hit"])
+    doc_ids = rows["doc_id"]
+    if boolean:
+        # sum the clause scores of each document, in clause order
+        doc_ids, inverse = np.unique(doc_ids, return_inverse=True)
+        sums = np.zeros((len(alphas), len(doc_ids)))
+        for alpha_idx in range(len(alphas)):
+            np.add.at(sums[alpha_idx], inverse, scores[alpha_idx])
+        scores = sums
+    # ties are broken by ascending docID for free text queries, descending for Boolean ones (see SearchEngine.query)
+    tie_break = np.broadcast_to(-doc_ids if boolean else doc_ids, scores.shape)
+    order = np.lexsort((tie_break, -scores), axis=-1)
+    ranked_scores = np.take_along_axis(scores, order, axis=-1)
+    hits = np.isin(doc_ids, np.array(sorted(relevant), dtype=np.int64))[order] & (ranked_scores > 0)
+    if top_k is not None:
+        hits[:, top_k:] = False
+    return average_metrics(hits, len(relevant))
+
+
+def sweep(components, answers, free_alphas, boolean_alphas, top_k=None):
+    """
+    Evaluates every (free text alpha, Boolean alpha) pair of the grid
+    :param components: see compute_components
+    :param answers: list of sets of relevant docIDs, one per query
+    :param free_alphas: list of free text alphas
+    :param boolean_alphas: list of Boolean alphas
+    :param top_k: if given, only the top k documents of each query are evaluated
+    :return: list of dicts with the alphas and the precision, recall and F-score averaged over the queries
+    """
+    n_queries = len(components["boolean"])
+    totals = {False: np.zeros((3, len(free_alphas))), True: np.zeros((3, len(boolean_alphas)))}
+    bounds = np.searchsorted(components["query"], np.arange(n_queries + 1))
+    for query_idx in range(n_queries):
+        boolean = bool(components["boolean"][query_idx])
+        rows = {name: components[name][bounds[query_idx]:bounds[query_idx + 1]]
+                for name in ("doc_id", "similarity", "proximity", "multi_hit")}
+        alphas = boolean_alphas if boolean else free_alphas
+        totals[boolean] += np.array(query_metrics(alphas, rows, boolean, answers[query_idx], top_k))
+    # a grid point combines the free text queries at one alpha and the Boolean queries at another
+    grid = (totals[False][:, :, None] + totals[True][:, None, :]) / max(n_queries, 1)
+    results = []
+    for i, free_alpha in enumerate(free_alphas):
+        for j, boolean_alpha in enumerate(boolean_alphas):
+            results.append({"free_text_alpha": free_alpha, "boolean_alpha": boolean_alpha,
+                            "precision": float(grid[0, i, j]), "recall": float(grid[1, i, j]),
+                            "f_score": float(grid[2, i, j])})
+    return results
+
+
+def parse_alphas(text):
+    return [float(alpha) for alpha in text.split(",")]
+
+
+if __name__ == "__main__":
+    dictionary_file = postings_file = file_of_queries = file_of_answers = file_of_output = cache_file = None
+    free_alphas = DEFAULT_ALPHAS
+    boolean_alphas = DEFAULT_ALPHAS
+    top_k = None
+    conjunctive = False
+    expand = True
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:a:o:c:f:g:k:bn')
+    except getopt.GetoptError as err:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-d':
+            dictionary_file = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-q':
+            file_of_queries = a
+        elif o == '-a':  # relevant docIDs of each query, one line per query
+            file_of_answers = a
+        elif o == '-o':
+            file_of_output = a
+        elif o == '-c':
+            cache_file = a
+        elif o == '-f':  # comma separated free text alphas
+            free_alphas = parse_alphas(a)
+        elif o == '-g':  # comma separated Boolean alphas
+            boolean_alphas = parse_alphas(a)
+        elif o == '-k':
+            top_k = int(a)
+        elif o == '-b':
+            conjunctive = True
+        elif o == '-n':  # no query expansion
+            expand = False
+        else:
+            assert False, "unhandled option"
+
+    if not dictionary_file or not postings_file or not file_of_queries or not file_of_answers or not file_of_output:
+        usage()
+        sys.exit(2)
+
+    with open(file_of_queries, "r") as f:
+        query_list = [line for line in f]
+    with open(file_of_answers, "r") as f:
+        answers = [set(int(token) for token in line.split()) for line in f]
+    if len(answers) != len(query_list):
+        print("{} queries but {} lines of answers".format(len(query_list), len(answers)))
+        sys.exit(2)
+
+    start = time.perf_counter()
+    key = {"queries": query_list, "dictionary": os.path.abspath(dictionary_file),
+           "dictionary_mtime": os.path.getmtime(dictionary_file), "postings": os.path.abspath(postings_file),
+           "postings_mtime": os.path.getmtime(postings_file), "expand": expand, "conjunctive": conjunctive}
+    components = load_components(cache_file, key) if cache_file else None
+    if components is None:
+        with SearchEngine(dictionary_file, postings_file) as engine:
+            components = compute_components(engine, query_list, expand=expand, conjunctive=conjunctive)
+        if cache_file:
+            save_components(cache_file, components, key)
+        print("Computed score components of {} queries ({} rows) in {:.2f}s".format(
+            len(query_list), len(components["doc_id"]), time.perf_counter() - start))
+    else:
+        print("Loaded score components of {} queries from {}".format(len(query_list), cache_file))
+
+    start = time.perf_counter()
+    results = sweep(components, answers, free_alphas, boolean_alphas, top_k)
+    print("Evaluated {} settings in {:.2f}s".format(len(results), time.perf_counter() - start))
+    best = max(results, key=lambda result: result["f_score"])
+    print("Best F-score {:.4f}: free text alpha {}, Boolean alpha {} (precision {:.4f}, recall {:.4f})".format(
+        best["f_score"], best["free_text_alpha"], best["boolean_alpha"], best["precision"], best["recall"]))
+    with open(file_of_output, "w") as f:
+        json.dump({"best": best, "grid": results}, f, indent=2)
@@ -0,0 +1,26 @@
+import numpy as np
+from evaluate import relevant_hits, hit_metrics, average_metrics
+
+
+def test_relevant_hits_marks_first_occurrences():
+    assert relevant_hits([3, 5, 7, 9, 11], {5, 9}).tolist() == [False, True, False, True]
+
+
+def test_relevant_hits_ignores_duplicates():
+    hits = relevant_hits([5, 7, 5, 9], {5, 9})
+    assert hits.tolist() == [True, False, False, True]
+    precisions, recalls, fscores = (metric[0][hits] for metric in hit_metrics(hits, 2))
+    assert np.allclose(precisions, [1.0, 0.5])
+    assert np.allclose(recalls, [0.5, 1.0])
+    assert all(recall <= 1 for recall in recalls)
+
+
+def test_relevant_hits_without_relevant_documents():
+    assert relevant_hits([1, 2, 3], {5}).tolist() == []
+
+
+def test_average_metrics():
+    hits = np.array([[True, False, True, False], [False, False, False, False]])
+    precisions, recalls, fscores = average_metrics(hits, 4)
+    assert np.allclose(precisions, [(1 + 2 / 3) / 2, 0])
+    assert np.allclose(recalls, [(0.25 + 0.5) / 2, 0])
@@ -0,0 +1,77 @@
+import math
+import pytest
+import postings_format
+from postings_reader import PostingsReader
+
+# term_id -> (docIDs, tfs, positions), in docID order as written by the indexer
+POSTINGS = {
+    0: ([2, 7, 300], [1, 2, 3], [[0], [4, 9], [1, 128, 70000]]),
+    1: ([5], [1], [[3]]),
+    2: ([1, 2, 3, 4], [1, 1, 2, 1], [[1], [2], [3, 5], [200]]),
+}
+DOC_LEN = {1: 2.0, 2: 1.5, 3: 3.0, 4: 1.0, 5: 1.0, 7: 2.5, 300: 4.0}
+
+
+def weights(doc_ids, tfs):
+    return [(1 + math.log(tf, 10)) / DOC_LEN[doc_id] for tf, doc_id in zip(tfs, doc_ids)]
+
+
+def write(path, version, impacts):
+    ptrs = {}
+    with postings_format.PostingsWriter(path, version, impacts=impacts) as writer:
+        for term_id, (doc_ids, tfs, positions) in POSTINGS.items():
+            quantized = postings_format.quantize_impacts(weights(doc_ids, tfs)) if impacts else None
+            ptrs[term_id] = writer.add(term_id, doc_ids, tfs, positions, quantized)
+    return ptrs
+
+
+@pytest.mark.parametrize("version, impacts", [
+    (postings_format.VERSION_FIXED, False),
+    (postings_format.VERSION_VBYTE, False),
+    (postings_format.VERSION_VBYTE, True),
+    (postings_format.VERSION_SPLIT, False),
+    (postings_format.VERSION_SPLIT, True),
+])
+def test_reader_round_trip(tmp_path, version, impacts):
+    path = str(tmp_path / "postings")
+    ptrs = write(path, version, impacts)
+    reader = PostingsReader(path)
+    try:
+        assert reader.format_version == version and reader.has_impacts == impacts
+        for term_id, (fp, pos_fp) in ptrs.items():
+            doc_ids, tfs, positions = POSTINGS[term_id]
+            read_doc_ids, read_tfs, read_positions = reader.read(fp, pos_fp)
+            assert read_doc_ids.tolist() == doc_ids
+            if read_tfs is None:
+                # stored with the positions
+                assert version == postings_format.VERSION_SPLIT and impacts
+                read_tfs = read_positions.tfs
+            assert read_tfs.tolist() == tfs
+            assert len(read_positions) == len(doc_ids)
+            assert [read_positions[i].tolist() for i in range(len(doc_ids))] == positions
+            if impacts:
+                expected = weights(doc_ids, tfs)
+                read_weights = reader.read_impacts(fp)
+                assert read_weights.max() == pytest.approx(max(expected))
+                assert read_weights.tolist() == pytest.approx(expected, rel=0.02)
+    finally:
+        reader.close()
+
+
+@pytest.mark.parametrize("impacts", [False, True])
+def test_python_decoders(impacts):
+    for term_id in POSTINGS:
+        doc_ids, tfs, positions = POSTINGS[term_id]
+        quantized = postings_format.quantize_impacts(weights(doc_ids, tfs)) if impacts else None
+        entry = postings_format.encode_entry(*POSTINGS[term_id], impacts=quantized)
+        assert postings_format.decode_entry(entry[4:], impacts) == (doc_ids, tfs, positions)
+        entry, pos_entry = postings_format.encode_split_entry(*POSTINGS[term_id], impacts=quantized)
+        read_doc_ids, read_tfs = postings_format.decode_split_entry(entry[4:], impacts)
+        assert read_doc_ids == doc_ids
+        assert read_tfs == (None if impacts else tfs)
+        assert postings_format.decode_split_positions(pos_entry[4:], read_tfs, len(doc_ids)) == positions
+
+
+def test_vbyte_round_trip():
+    numbers = [0, 1, 127, 128, 16383, 16384, 2**35]
+    assert postings_format.vbyte_decode(postings_format.vbyte_encode(numbers)) == numbers
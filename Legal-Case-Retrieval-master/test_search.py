@@ -0,0 +1,38 @@
+import pytest
+import benchmark
+from index import Indexer
+from query_parser import Parser
+from search import SearchEngine
+
+nltk = pytest.importorskip("nltk")
+
+
+@pytest.fixture(scope="module")
+def index_paths(tmp_path_factory):
+    for resource in ("corpora/stopwords", "corpora/wordnet"):
+        try:
+            nltk.data.find(resource)
+        except LookupError:
+            pytest.skip("nltk data not installed: {}".format(resource))
+    directory = tmp_path_factory.mktemp("index")
+    input_file = str(directory / "corpus.csv")
+    vocabulary, samples = benchmark.generate_corpus(input_file, 200, doc_len=80, vocabulary_size=500)
+    parser = Parser(fast_tokenizer=True)
+    indexer = Indexer(preprocess=parser.iter_preprocess, tokenize=parser.iter_tokens)
+    indexer.index(input_file)
+    paths = str(directory / "index.dict"), str(directory / "index.post")
+    indexer.save(paths[1], paths[0])
+    return paths, benchmark.generate_queries(vocabulary, samples, 20, "free")
+
+
+@pytest.mark.parametrize("rerank_depth", [None, 5])
+@pytest.mark.parametrize("expand", [False, True])
+def test_top_k_is_head_of_exhaustive_ranking(index_paths, rerank_depth, expand):
+    (dictionary_path, postings_path), queries = index_paths
+    with SearchEngine(dictionary_path, postings_path, rerank_depth=rerank_depth, fast_tokenizer=True) as engine:
+        for query in queries + ["court appeal", "unknownword"]:
+            doc_ids, scores = engine.query(query, expand=expand, with_scores=True)
+            for top_k in (1, 10, 50, 1000):
+                top_doc_ids, top_scores = engine.query(query, expand=expand, top_k=top_k, with_scores=True)
+                assert top_doc_ids == doc_ids[:top_k]
+                assert top_scores == pytest.approx(scores[:top_k], rel=1e-12)
@@ -0,0 +1,53 @@
+import json
+import asyncio
+from server import QueryServer
+
+
+async def request(port, method, path, body=b""):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    request_head = "{} {} HTTP/1.1\r\nContent-Length: {}\r\n\r\n".format(method, path, len(body))
+    writer.write(request_head.encode("latin-1") + body)
+    await writer.drain()
+    data = await reader.read()
+    writer.close()
+    head, _, body = data.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(body)
+
+
+def run_requests(requests):
+    """
+    Sends requests to a QueryServer without an index: only requests rejected before scoring are answered properly
+    :param requests: list of (method, path, body)
+    :return: list of (HTTP status, response object)
+    """
+    async def run():
+        server = QueryServer(None)
+        listener = await server.start("127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            return [await request(port, *args) for args in requests]
+        finally:
+            listener.close()
+            server.close()
+    return asyncio.run(run())
+
+
+def test_rejects_invalid_requests():
+    responses = run_requests([
+        ("POST", "/search", b"[1, 2]"),
+        ("POST", "/search", b"\"car\""),
+        ("POST", "/search", b"{not json"),
+        ("GET", "/search?q=car&k=x", b""),
+        ("GET", "/search", b""),
+    ])
+    assert [status for status, _ in responses] == [400] * 5
+    assert all("error" in response for _, response in responses)
+
+
+def test_unknown_path():
+    assert run_requests([("GET", "/nope", b"")]) == [(404, {"error": "not found"})]
+
+
+def test_scoring_errors_return_500():
+    (status, response), = run_requests([("POST", "/search", b"{\"q\": \"car\"}")])
+    assert status == 500 and "error" in response
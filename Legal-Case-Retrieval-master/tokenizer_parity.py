@@ -0,0 +1,118 @@
+#!/usr/bin/python
+import sys
+import time
+import getopt
+import difflib
+import pandas as pd
+import nltk
+import fast_tokenizer
+from query_parser import Parser
+
+# Compares fast_tokenizer with nltk.word_tokenize on the documents of a csv file and/or a file of queries: token
+# agreement, the first differences found, and for queries whether Parser.parse_query gives the same query (the
+# phrases and terms searched for).
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " [-i file-of-documents.csv] [-q file-of-queries] [-n max-documents] "
+                                    "[-m mismatches-shown]")
+
+
+def compare(texts, max_shown=10):
+    """
+    Tokenizes texts with both tokenizers and compares the tokens
+    :param texts: iterable of texts
+    :param max_shown: number of differences printed
+    :return: dict of counts and timings
+    """
+    stats = {"texts": 0, "identical": 0, "tokens": 0, "fast_tokens": 0, "tokens_differing": 0, "nltk_s": 0.0,
+             "fast_s": 0.0}
+    shown = 0
+    for text in texts:
+        start = time.perf_counter()
+        expected = nltk.word_tokenize(text)
+        stats["nltk_s"] += time.perf_counter() - start
+        start = time.perf_counter()
+        tokens = fast_tokenizer.tokenize(text)
+        stats["fast_s"] += time.perf_counter() - start
+        stats["texts"] += 1
+        stats["tokens"] += len(expected)
+        stats["fast_tokens"] += len(tokens)
+        if tokens == expected:
+            stats["identical"] += 1
+            continue
+        matcher = difflib.SequenceMatcher(None, expected, tokens, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                continue
+            stats["tokens_differing"] += max(i2 - i1, j2 - j1)
+            if shown < max_shown:
+                shown += 1
+                print("  nltk {} / fast {} (after {})".format(expected[i1:i2], tokens[j1:j2],
+                                                              " ".join(expected[max(i1 - 3, 0):i1])))
+    return stats
+
+
+def compare_queries(query_list):
+    """
+    :return: list of the queries parsed differently with the fast tokenizer, as (query, nltk query, fast query)
+    """
+    nltk_parser = Parser()
+    fast_parser = Parser(fast_tokenizer=True)
+    differences = []
+    for query_string in query_list:
+        expected = nltk_parser.parse_query(query_string)
+        query = fast_parser.parse_query(query_string)
+        if (query.q_type, query.data) != (expected.q_type, expected.data):
+            differences.append((query_string, expected, query))
+    return differences
+
+
+def report(name, stats):
+    print("{}: {} of {} identical ({:.2%}), {} of {} nltk tokens differ ({:.4%}), {} fast tokens".format(
+        name, stats["identical"], stats["texts"], stats["identical"] / max(stats["texts"], 1),
+        stats["tokens_differing"], stats["tokens"], stats["tokens_differing"] / max(stats["tokens"], 1),
+        stats["fast_tokens"]))
+    print("  nltk {:.2f}s, fast {:.2f}s ({:.1f}x)".format(stats["nltk_s"], stats["fast_s"],
+                                                          stats["nltk_s"] / max(stats["fast_s"], 1e-9)))
+
+
+if __name__ == "__main__":
+    input_file = file_of_queries = None
+    max_documents = None
+    max_shown = 10
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:q:n:m:')
+    except getopt.GetoptError as err:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-i':
+            input_file = a
+        elif o == '-q':
+            file_of_queries = a
+        elif o == '-n':
+            max_documents = int(a)
+        elif o == '-m':
+            max_shown = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if not input_file and not file_of_queries:
+        usage()
+        sys.exit(2)
+
+    if input_file:
+        documents = pd.read_csv(input_file, nrows=max_documents).content.astype(str)
+        report("documents", compare(documents, max_shown))
+    if file_of_queries:
+        with open(file_of_queries, "r") as f:
+            query_list = [line for line in f]
+        report("queries", compare(query_list, max_shown))
+        differences = compare_queries(query_list)
+        print("queries: {} of {} parsed differently".format(len(differences), len(query_list)))
+        for query_string, expected, query in differences[:max_shown]:
+            print("  {!r}: nltk {} {} / fast {} {}".format(query_string.strip(), expected.q_type, expected.data,
+                                                          query.q_type, query.data))
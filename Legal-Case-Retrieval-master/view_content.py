@@ -1,9 +1,10 @@
-import pandas as pd
+import sys
 import pprint
+from doc_store import DocumentStore
 
-data = pd.read_csv("./dataset/dataset.csv")
-print("Finished reading dataset.")
+# document store written by index.py -o
+store = DocumentStore(sys.argv[1] if len(sys.argv) > 1 else "./dataset/documents.store")
+print("Opened document store ({} documents).".format(len(store)))
 while(True):
 	number = int(input())
-	content = data.loc[data['document_id'] == number].content
-	pprint.pprint(list(content.values)[0])
+	pprint.pprint(store.get_document(number))